@@ -0,0 +1,311 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import json
+import logging
+import argparse
+from collections import OrderedDict
+import numpy as np
+
+sys.path.append("./")
+
+from inference.estimator import ParameterizedRatioEstimator
+from simulation.wrapper import augmented_data
+from simulation.proposal import GridProposal, proposal_weights
+from simulation.reweighting import effective_sample_size
+
+logger = logging.getLogger(__name__)
+
+KEYS = ["theta", "theta_alt", "x", "t_xz", "t_xz_alt", "log_r_xz", "log_r_xz_alt", "z", "pop"]
+
+
+def active_learning(
+    method,
+    alpha,
+    data_dir,
+    sample_name,
+    n_rounds=5,
+    n_per_round=10000,
+    n_models=2,
+    n_eval=100,
+    prior_fraction=0.5,
+    resolution=25,
+    tolerance=None,
+    n_thetas_marginal=1000,
+    fixm=False,
+    fixz=False,
+    fixalign=False,
+    n_workers=1,
+    architecture="resnet",
+    log_input=False,
+    batch_size=128,
+    n_epochs=5,
+    initial_lr=1.0e-4,
+    final_lr=1.0e-6,
+):
+    """
+    Generates a training sample in rounds. After every round, an ensemble of quick estimators is trained on all
+    samples so far and evaluated on a fixed set of images from the prior for the parameter points on a grid. The next
+    round draws its parameter points from a GridProposal that is proportional to the disagreement of the ensemble,
+    mixed with the prior. All samples are weighted back to the prior with `proposal_weights()`, so training on the
+    sample with these weights (train.py --weights) has the same objective as training on a sample from the prior.
+
+    The sample is saved in {data_dir}/samples/{key}_{sample_name}.npy together with the weights in
+    w_{sample_name}.npy and a summary of the rounds in active_learning_{sample_name}.json, the ensemble models in
+    {data_dir}/models/{sample_name}_round{r}_model{i}.
+    """
+
+    if n_models < 2:
+        raise ValueError("The ensemble disagreement requires at least two models")
+
+    sample_folder = "{}/samples".format(data_dir)
+    model_folder = "{}/models".format(data_dir)
+
+    proposal = GridProposal(resolution=resolution)
+    data = OrderedDict([(key, []) for key in KEYS])
+    proposals, n_samples, summary = [], [], []
+    x_eval = None
+
+    for i_round in range(n_rounds):
+        logger.info("Active learning round %s / %s", i_round + 1, n_rounds)
+
+        # Simulate
+        results = simulate_round(proposal, n_per_round, n_thetas_marginal, fixm, fixz, fixalign, n_workers)
+        for key in KEYS:
+            data[key].append(results[key])
+        proposals.append(proposal)
+        n_samples.append(n_per_round)
+        if x_eval is None:
+            x_eval = results["x"][:n_eval]
+
+        # Weights
+        sample = OrderedDict([(key, np.concatenate(values, axis=0)) for key, values in data.items()])
+        weights = proposal_weights(sample["theta"], proposals, n_samples, theta_alt=sample["theta_alt"])
+        n_eff = effective_sample_size(weights)
+        logger.info(
+            "%s samples with an effective sample size of %.1f (%.1f%%)",
+            len(weights),
+            n_eff,
+            100.0 * n_eff / len(weights),
+        )
+        save_sample(sample_folder, sample_name, sample, weights)
+
+        # Train ensemble and find the parameter regions where it disagrees
+        estimators = []
+        for i_model in range(n_models):
+            logger.info("Training model %s / %s of the ensemble", i_model + 1, n_models)
+            estimator = train_model(
+                sample, weights, method, alpha, architecture, log_input, batch_size, n_epochs, initial_lr, final_lr
+            )
+            estimator.save("{}/{}_round{}_model{}".format(model_folder, sample_name, i_round, i_model))
+            estimators.append(estimator)
+
+        disagreement = ensemble_disagreement(estimators, x_eval, proposal.cell_centers())
+        mean_disagreement = float(np.mean(disagreement))
+        logger.info(
+            "Ensemble disagreement in log r: mean %.3f, max %.3f at f_sub = %.3f, beta = %.2f",
+            mean_disagreement,
+            np.max(disagreement),
+            *proposal.cell_centers()[np.argmax(disagreement)]
+        )
+
+        summary.append(
+            OrderedDict(
+                [
+                    ("round", i_round),
+                    ("n_samples", int(np.sum(n_samples))),
+                    ("effective_sample_size", float(n_eff)),
+                    ("mean_disagreement", mean_disagreement),
+                    ("prior_fraction", proposal.prior_fraction),
+                    ("disagreement", disagreement.tolist()),
+                ]
+            )
+        )
+        with open("{}/active_learning_{}.json".format(sample_folder, sample_name), "w") as f:
+            json.dump(summary, f, indent=2)
+
+        if tolerance is not None and mean_disagreement < tolerance:
+            logger.info("Ensemble disagreement is below the tolerance %s, stopping", tolerance)
+            break
+
+        proposal = GridProposal(disagreement, resolution=resolution, prior_fraction=prior_fraction)
+
+    logger.info(
+        "Generated %s samples. Train the final model with: train.py %s %s <name> --weights %s",
+        int(np.sum(n_samples)),
+        method,
+        sample_name,
+        sample_name,
+    )
+
+
+def simulate_round(proposal, n, n_thetas_marginal, fixm, fixz, fixalign, n_workers):
+    """ Simulates n training samples with parameter points drawn from the proposal. As in simulate.py, the alternate
+    parameter points are the parameter points of the other half of the sample. """
+
+    theta = proposal.rvs(n)
+    theta_alt = np.vstack((theta[n // 2 :], theta[: n // 2]))
+
+    return augmented_data(
+        f_sub=theta[:, 0],
+        beta=theta[:, 1],
+        f_sub_alt=theta_alt[:, 0],
+        beta_alt=theta_alt[:, 1],
+        n_images=n,
+        n_thetas_marginal=n_thetas_marginal,
+        outputs=["x", "gold", "z", "pop"],
+        draw_host_mass=not fixm,
+        draw_host_redshift=not fixz,
+        draw_alignment=not fixalign,
+        n_workers=n_workers,
+    )
+
+
+def train_model(sample, weights, method, alpha, architecture, log_input, batch_size, n_epochs, initial_lr, final_lr):
+    estimator = ParameterizedRatioEstimator(
+        resolution=64, n_parameters=2, n_aux=0, architecture=architecture, log_input=log_input, rescale_inputs=True
+    )
+    estimator.train(
+        method,
+        x=sample["x"],
+        theta=sample["theta"],
+        theta_alt=sample["theta_alt"],
+        log_r_xz=sample["log_r_xz"],
+        log_r_xz_alt=sample["log_r_xz_alt"],
+        t_xz=sample["t_xz"],
+        t_xz_alt=sample["t_xz_alt"],
+        sample_weights=weights,
+        alpha=alpha,
+        n_epochs=n_epochs,
+        batch_size=batch_size,
+        initial_lr=initial_lr,
+        final_lr=final_lr,
+        validation_split=0.25,
+        early_stopping=True,
+        verbose="some",
+    )
+    return estimator
+
+
+def ensemble_disagreement(estimators, x, thetas):
+    """ Standard deviation of the estimated log likelihood ratios between the models of the ensemble, averaged over
+    the images x, for every parameter point in thetas """
+
+    log_r = np.array([estimator.log_likelihood_ratio(x=x, theta=thetas)[0] for estimator in estimators])
+    return np.mean(np.std(log_r, axis=0), axis=1)
+
+
+def save_sample(folder, name, sample, weights):
+    for key, value in sample.items():
+        np.save("{}/{}_{}.npy".format(folder, key, name), value)
+    np.save("{}/w_{}.npy".format(folder, name), weights)
+    logger.info("Saved sample %s and its weights in %s", name, folder)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generates a training sample in rounds, concentrating the simulations in the parameter regions "
+        "where an ensemble of quickly trained estimators disagrees. The samples are weighted back to the prior."
+    )
+
+    parser.add_argument(
+        "method", help='Inference method: "carl", "rolr", "alice", "cascal", "rascal", "alices".'
+    )
+    parser.add_argument("sample", type=str, help='Sample name, like "train_al".')
+    parser.add_argument(
+        "--dir",
+        type=str,
+        default=".",
+        help="Directory. The sample will be saved in the data/samples subfolder, the models in data/models.",
+    )
+
+    # Active learning options
+    parser.add_argument("--rounds", type=int, default=5, help="Maximal number of rounds. Default: 5.")
+    parser.add_argument("-n", type=int, default=10000, help="Images per round. Default: 10000.")
+    parser.add_argument("--models", type=int, default=2, help="Number of models in the ensemble. Default: 2.")
+    parser.add_argument(
+        "--neval",
+        type=int,
+        default=100,
+        help="Number of images from the first round on which the ensemble disagreement is evaluated. Default: 100.",
+    )
+    parser.add_argument(
+        "--priorfraction",
+        type=float,
+        default=0.5,
+        help="Fraction of the parameter points of every round that are drawn from the prior. Default: 0.5.",
+    )
+    parser.add_argument(
+        "--resolution", type=int, default=25, help="Cells of the proposal grid along each parameter. Default: 25."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="Stop when the mean ensemble disagreement in log r is below this value. Default: run all rounds.",
+    )
+    parser.add_argument("--fixm", action="store_true", help="Fix host halo mass")
+    parser.add_argument("--fixz", action="store_true", help="Fix lens redshift")
+    parser.add_argument("--fixalign", action="store_true", help="Fix alignment between lens and source")
+    parser.add_argument("--workers", type=int, default=1, help="Number of simulator processes. Default: 1.")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed.")
+
+    # Training options of the ensemble
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=0.0002,
+        help="alpha parameter weighting the score MSE in the loss function of the SCANDAL, RASCAL, and"
+        "and ALICES inference methods. Default: 0.0002",
+    )
+    parser.add_argument("--vgg", action="store_true", help="Usee VGG rather than ResNet.")
+    parser.add_argument("--log", action="store_true", help="Whether the log of the input is taken.")
+    parser.add_argument("--epochs", type=int, default=5, help="Number of epochs per model. Default: 5.")
+    parser.add_argument("--batchsize", type=int, default=128, help="Batch size. Default: 128.")
+    parser.add_argument("--lr", type=float, default=1.0e-4, help="Initial learning rate. Default: 0.0001")
+    parser.add_argument(
+        "--lrdecay", type=float, default=1.0e-2, help="Learning rate decay (final LR / initial LR). Default: 0.01"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    logging.info("Hi!")
+
+    args = parse_args()
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    active_learning(
+        method=args.method,
+        alpha=args.alpha,
+        data_dir="{}/data/".format(args.dir),
+        sample_name=args.sample,
+        n_rounds=args.rounds,
+        n_per_round=args.n,
+        n_models=args.models,
+        n_eval=args.neval,
+        prior_fraction=args.priorfraction,
+        resolution=args.resolution,
+        tolerance=args.tolerance,
+        fixm=args.fixm,
+        fixz=args.fixz,
+        fixalign=args.fixalign,
+        n_workers=args.workers,
+        architecture="vgg" if args.vgg else "resnet",
+        log_input=args.log,
+        batch_size=args.batchsize,
+        n_epochs=args.epochs,
+        initial_lr=args.lr,
+        final_lr=args.lrdecay * args.lr,
+    )
+
+    logging.info("All done! Have a nice day!")
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+import json
+import argparse
+import logging
+from collections import OrderedDict
+import numpy as np
+from scipy.special import logsumexp
+
+sys.path.append("./")
+
+from simulation.gold import log_r_from_log_probs
+
+logger = logging.getLogger(__name__)
+
+
+def reference_log_r(log_probs, i, n_thetas_marginal):
+    """ Joint log likelihood ratios calculated image by image in extended precision (np.longdouble, float128 on most
+    platforms), like augmented_data() did before it used log_r_from_log_probs() """
+
+    log_r = []
+    for log_probs_image in log_probs:
+        log_p_xz_from_marginal = np.delete(log_probs_image, i, axis=0)
+        delta_log = np.asarray(
+            log_p_xz_from_marginal - log_probs_image[i] - np.log(float(n_thetas_marginal)), dtype=np.longdouble
+        )
+        log_r.append(-1.0 * logsumexp(delta_log))
+    return np.array(log_r, dtype=np.longdouble)
+
+
+def compare(n_images, n_thetas, scale):
+    """ Compares log_r_from_log_probs() to the extended-precision reference on a random log probability matrix with
+    entries of the given scale, for the numerator hypotheses in both the first and second column """
+
+    log_probs = scale * np.random.normal(size=(n_images, n_thetas))
+
+    max_abs_deviation, max_rel_deviation, seconds, seconds_reference = 0.0, 0.0, 0.0, 0.0
+    for i in [0, 1]:
+        time_before = time.time()
+        log_r = log_r_from_log_probs(log_probs, i, n_thetas)
+        seconds += time.time() - time_before
+
+        time_before = time.time()
+        log_r_reference = reference_log_r(log_probs, i, n_thetas)
+        seconds_reference += time.time() - time_before
+
+        deviation = np.abs(log_r - log_r_reference)
+        max_abs_deviation = max(max_abs_deviation, float(np.max(deviation)))
+        max_rel_deviation = max(max_rel_deviation, float(np.max(deviation / np.maximum(np.abs(log_r_reference), 1.0))))
+
+    return OrderedDict(
+        [
+            ("scale", scale),
+            ("max_abs_deviation", max_abs_deviation),
+            ("max_rel_deviation", max_rel_deviation),
+            ("seconds", seconds),
+            ("seconds_reference", seconds_reference),
+        ]
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Checks that the batched float64 joint likelihood ratios of simulation.gold.log_r_from_log_probs "
+        "agree with an image-by-image calculation in extended precision on random log probability matrices. Exits "
+        "with status 1 if the relative deviation is above the tolerance for any scale."
+    )
+
+    parser.add_argument("--output", type=str, default=None, help="JSON file in which the results are saved.")
+    parser.add_argument("--images", type=int, default=500, help="Number of images. Default: 500.")
+    parser.add_argument(
+        "--thetas", type=int, default=1000, help="Number of parameter points in the marginal. Default: 1000."
+    )
+    parser.add_argument(
+        "--scales",
+        type=float,
+        nargs="+",
+        default=[1.0, 1.0e2, 1.0e4],
+        help="Scales of the random log probabilities. Default: 1 100 10000.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.0e-12,
+        help="Maximal deviation relative to max(|log r|, 1). Default: 1e-12.",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed. Default: 1.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    args = parse_args()
+    np.random.seed(args.seed)
+
+    logger.info(
+        "Comparing to %s precision on %s images with %s parameter points",
+        np.finfo(np.longdouble).dtype,
+        args.images,
+        args.thetas,
+    )
+
+    results = []
+    n_failures = 0
+    for scale in args.scales:
+        result = compare(args.images, args.thetas, scale)
+        result["passed"] = result["max_rel_deviation"] <= args.tolerance
+        results.append(result)
+
+        logger.info(
+            "Scale %8.1f: max deviation %.1e (relative %.1e), %.3fs vs %.3fs  %s",
+            scale,
+            result["max_abs_deviation"],
+            result["max_rel_deviation"],
+            result["seconds"],
+            result["seconds_reference"],
+            "ok" if result["passed"] else "FAILED",
+        )
+        if not result["passed"]:
+            n_failures += 1
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Saved results at %s", args.output)
+
+    if n_failures > 0:
+        logger.error("log_r_from_log_probs deviates from the reference for %s scales", n_failures)
+        sys.exit(1)
+
+    logger.info("All done! Have a nice day!")
@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+from collections import OrderedDict
+import numpy as np
+
+sys.path.append("./")
+
+logger = logging.getLogger(__name__)
+
+# Entry points with their startup budget in seconds. The budgets are for importing the module (i.e. everything a
+# script does before it parses its arguments), measured on a laptop, with some headroom.
+BUDGETS = OrderedDict(
+    [
+        ("simulate", 0.6),
+        ("train", 0.6),
+        ("test", 0.6),
+        ("calibrate", 0.5),
+        ("combine_samples", 0.5),
+        ("workqueue", 0.5),
+        ("active_learning", 0.6),
+        ("simulation.wrapper", 0.6),
+        ("inference.estimator", 0.5),
+    ]
+)
+
+# Heavy packages that must not be imported at startup, only when they are first used
+FORBIDDEN_MODULES = ["torch", "astropy", "autograd", "scipy.stats"]
+
+# Runs in a fresh interpreter, so that modules cached by earlier measurements do not distort the result
+MEASUREMENT = """
+import sys, time, json
+sys.path.insert(0, {root!r})
+time_before = time.time()
+import {module}
+seconds = time.time() - time_before
+heavy = [name for name in {forbidden!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy_modules": heavy}}))
+"""
+
+
+def measure(module, n_repeat=5):
+    """ Imports a module in n_repeat fresh interpreters and returns the median import time and the heavy packages
+    that have been imported """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = MEASUREMENT.format(root=root, module=module, forbidden=FORBIDDEN_MODULES)
+
+    seconds, heavy_modules = [], []
+    for _ in range(n_repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root).decode()
+        result = json.loads(output.strip().split("\n")[-1])
+        seconds.append(result["seconds"])
+        heavy_modules = result["heavy_modules"]
+
+    return OrderedDict(
+        [
+            ("seconds_median", float(np.median(seconds))),
+            ("seconds_min", float(np.min(seconds))),
+            ("seconds_max", float(np.max(seconds))),
+            ("heavy_modules", heavy_modules),
+        ]
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measures the startup time of the entry points and checks it against a budget. Exits with status "
+        "1 if an entry point is over budget or imports one of the heavy packages torch, astropy, autograd, or "
+        "scipy.stats at startup."
+    )
+
+    parser.add_argument("--output", type=str, default=None, help="JSON file in which the results are saved.")
+    parser.add_argument("-n", type=int, default=5, help="Number of measurements per entry point. Default: 5.")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Factor by which all budgets are multiplied, for slow machines."
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    args = parse_args()
+
+    results = OrderedDict()
+    n_failures = 0
+    for module, budget in BUDGETS.items():
+        result = measure(module, args.n)
+        result["budget"] = budget * args.scale
+        result["passed"] = result["seconds_median"] <= result["budget"] and len(result["heavy_modules"]) == 0
+        results[module] = result
+
+        logger.info(
+            "%-25s %6.2fs (budget %.2fs) %s%s",
+            module,
+            result["seconds_median"],
+            result["budget"],
+            "ok" if result["passed"] else "FAILED",
+            "" if len(result["heavy_modules"]) == 0 else ", imports " + ", ".join(result["heavy_modules"]),
+        )
+        if not result["passed"]:
+            n_failures += 1
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("Saved results at %s", args.output)
+
+    if n_failures > 0:
+        logger.error("%s entry points are over their startup budget", n_failures)
+        sys.exit(1)
+
+    logger.info("All done! Have a nice day!")
@@ -0,0 +1,289 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import json
+import socket
+import platform
+import argparse
+import logging
+import subprocess
+from collections import OrderedDict
+import numpy as np
+
+sys.path.append("./")
+
+from simulation.units import M_s
+from simulation.population_sim import LensingObservationWithSubhalos, SubhaloPopulation
+from simulation.profiles import MassProfileNFW
+from simulation.lensing_sim import LensingSim
+from simulation.prior import draw_params_from_prior
+
+logger = logging.getLogger(__name__)
+
+# Host settings, named like the simulate.py flags
+HOST_SETTINGS = OrderedDict(
+    [
+        ("full", {"draw_host_mass": True, "draw_host_redshift": True, "draw_alignment": True}),
+        ("fixm", {"draw_host_mass": False, "draw_host_redshift": True, "draw_alignment": True}),
+        ("fixz", {"draw_host_mass": True, "draw_host_redshift": False, "draw_alignment": True}),
+        ("fixalign", {"draw_host_mass": True, "draw_host_redshift": True, "draw_alignment": False}),
+    ]
+)
+
+# Number of parameter points in the reference marginal when mining gold, None means no gold
+N_THETAS_MARGINAL = [None, 100, 1000]
+
+# Subhalo numbers for the synthetic lensing benchmark
+N_SUBS = [0, 10, 100, 500, 1000, 2000]
+
+# Settings of the simulator as used by simulation.wrapper.augmented_data()
+SIMULATOR_SETTINGS = {
+    "m_200_min_sub": 1.0e7 * M_s,
+    "m_200_max_sub_div_M_hst": 0.01,
+    "m_min_calib": 1.0e7 * M_s,
+    "m_max_sub_div_M_hst_calib": 0.01,
+}
+F_SUB, BETA = 0.05, -1.9
+
+
+def benchmark_cases(n_images, n_images_dx_dm, n_images_synthetic):
+    """ Returns the list of benchmark cases as (name, function, kwargs, n_images) """
+
+    cases = []
+    for host_name, host_settings in HOST_SETTINGS.items():
+        for n_thetas_marginal in N_THETAS_MARGINAL:
+            gold_name = "nogold" if n_thetas_marginal is None else "gold{}".format(n_thetas_marginal)
+            kwargs = dict(host_settings, n_thetas_marginal=n_thetas_marginal, calculate_dx_dm=False)
+            cases.append(("simulator_{}_{}".format(host_name, gold_name), simulate_image, kwargs, n_images))
+
+    kwargs = dict(HOST_SETTINGS["full"], n_thetas_marginal=None, calculate_dx_dm=True)
+    cases.append(("simulator_full_nogold_dxdm", simulate_image, kwargs, n_images_dx_dm))
+
+    for n_sub in N_SUBS:
+        cases.append(("synthetic_nsub{}".format(n_sub), synthetic_image, {"n_sub": n_sub}, n_images_synthetic))
+
+    return cases
+
+
+def simulate_image(i, n_thetas_marginal=None, calculate_dx_dm=False, **host_settings):
+    """ Simulates one image with LensingObservationWithSubhalos """
+
+    params_eval = None
+    if n_thetas_marginal is not None:
+        f_sub_eval, beta_eval = draw_params_from_prior(n_thetas_marginal + 1)
+        params_eval = np.vstack((f_sub_eval, beta_eval)).T
+
+    LensingObservationWithSubhalos(
+        f_sub=F_SUB,
+        beta=BETA,
+        params_eval=params_eval,
+        calculate_joint_score=n_thetas_marginal is not None,
+        calculate_msub_derivatives=calculate_dx_dm,
+        seed=[0, i],
+        **dict(SIMULATOR_SETTINGS, **host_settings)
+    )
+
+
+def synthetic_image(i, n_sub):
+    """ Lenses an image with a fixed number of subhalos, drawn from the SHMF and uniformly in the ROI around a typical
+    host, and applies Poisson noise and the PSF. This isolates the cost of the lensing calculation per subhalo. """
+
+    sim = _reference_host()
+    np.random.seed([1, i])
+
+    m_subs = SubhaloPopulation._draw_m_sub(n_sub, 1.0e7 * M_s, 0.01 * sim.M_200_hst, BETA)
+    theta_xs, theta_ys = SubhaloPopulation._draw_sub_coordinates(n_sub, r_max=2.0 * sim.theta_E)
+
+    lens_list = [sim.hst_param_dict]
+    for m, theta_x, theta_y in zip(m_subs, theta_xs, theta_ys):
+        c = MassProfileNFW.c_200_SCP(m)
+        r_s, rho_s = MassProfileNFW.get_r_s_rho_s_NFW(m, c)
+        lens_list.append(
+            {"profile": "NFW", "theta_x_0": theta_x, "theta_y_0": theta_y, "M_200": m, "r_s": r_s, "rho_s": rho_s}
+        )
+
+    lsi = LensingSim(lens_list, _reference_host.src_list, _reference_host.global_dict, _reference_host.obs_dict)
+    image = lsi.lensed_image()
+    image_poiss = np.random.poisson(image)
+    sim._convolve_psf(image_poiss, sim.fwhm_psf, sim.pixel_size)
+
+
+def _reference_host():
+    """ Typical host without substructure, simulated once and reused by all synthetic benchmarks """
+
+    if _reference_host.sim is None:
+        sim = LensingObservationWithSubhalos(
+            f_sub=F_SUB,
+            beta=BETA,
+            draw_host_mass=False,
+            draw_host_redshift=False,
+            draw_alignment=False,
+            seed=[0, 0],
+            **SIMULATOR_SETTINGS
+        )
+        _reference_host.sim = sim
+        _reference_host.src_list = [
+            {
+                "profile": "Sersic",
+                "theta_x_0": sim.theta_x_0,
+                "theta_y_0": sim.theta_y_0,
+                "S_tot": sim.S_tot,
+                "theta_e": sim.theta_s_e,
+                "n_srsc": 1,
+            }
+        ]
+        _reference_host.global_dict = {"z_s": sim.z_s, "z_l": sim.z_l, "D_s": sim.host["D_s"], "D_l": sim.D_l}
+        _reference_host.obs_dict = {
+            "n_x": sim.n_xy,
+            "n_y": sim.n_xy,
+            "theta_x_lims": (-sim.coordinate_limit, sim.coordinate_limit),
+            "theta_y_lims": (-sim.coordinate_limit, sim.coordinate_limit),
+            "exposure": sim.exposure,
+            "f_iso": sim.f_iso,
+        }
+    return _reference_host.sim
+
+
+_reference_host.sim = None
+
+
+def run_case(function, kwargs, n_images, n_warmup=1):
+    """ Runs a benchmark case and returns a dict with throughput and latency percentiles """
+
+    for i in range(n_warmup):
+        function(n_images + i, **kwargs)
+
+    latencies = []
+    for i in range(n_images):
+        time_before = time.time()
+        function(i, **kwargs)
+        latencies.append(time.time() - time_before)
+
+    latencies = np.array(latencies)
+    return OrderedDict(
+        [
+            ("n_images", n_images),
+            ("images_per_second", float(n_images / np.sum(latencies))),
+            ("latency_mean", float(np.mean(latencies))),
+            ("latency_p50", float(np.percentile(latencies, 50.0))),
+            ("latency_p90", float(np.percentile(latencies, 90.0))),
+            ("latency_p99", float(np.percentile(latencies, 99.0))),
+            ("latency_max", float(np.max(latencies))),
+        ]
+    )
+
+
+def machine_info():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return OrderedDict(
+        [
+            ("hostname", socket.gethostname()),
+            ("platform", platform.platform()),
+            ("processor", platform.processor()),
+            ("cpu_count", os.cpu_count()),
+            ("python", platform.python_version()),
+            ("numpy", np.__version__),
+            ("commit", commit),
+            ("date", time.strftime("%Y-%m-%d %H:%M:%S")),
+        ]
+    )
+
+
+def compare(results, baseline):
+    """ Logs the throughput of every case relative to a baseline """
+
+    if baseline["machine"]["hostname"] != results["machine"]["hostname"]:
+        logger.warning(
+            "Baseline was recorded on %s, not on this machine (%s)",
+            baseline["machine"]["hostname"],
+            results["machine"]["hostname"],
+        )
+
+    logger.info(
+        "Comparison to baseline from %s (commit %s):", baseline["machine"]["date"], baseline["machine"]["commit"]
+    )
+    for name, result in results["cases"].items():
+        if "error" in result:
+            logger.info("  %-40s    failed", name)
+            continue
+        if name not in baseline["cases"] or "error" in baseline["cases"][name]:
+            logger.info("  %-40s       new", name)
+            continue
+        ratio = result["images_per_second"] / baseline["cases"][name]["images_per_second"]
+        logger.info("  %-40s %8.2fx images / s", name, ratio)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measures the throughput and per-image latency of the strong lensing simulator for different "
+        "settings"
+    )
+
+    parser.add_argument("output", type=str, help="JSON file in which the results are saved.")
+    parser.add_argument("-n", type=int, default=20, help="Number of images per simulator benchmark. Default: 20.")
+    parser.add_argument("--ndxdm", type=int, default=2, help="Number of images with dx/dm. Default: 2.")
+    parser.add_argument(
+        "--nsynthetic", type=int, default=10, help="Number of images per synthetic benchmark. Default: 10."
+    )
+    parser.add_argument(
+        "--cases", type=str, default=None, help="Only run the benchmark cases whose names contain this string."
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="JSON file with results of an earlier run on the same machine to compare against.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    for key in logging.Logger.manager.loggerDict:
+        if "simulation" in key:
+            logging.getLogger(key).setLevel(logging.WARNING)
+    args = parse_args()
+
+    np.random.seed(1234)
+    results = OrderedDict([("machine", machine_info()), ("cases", OrderedDict())])
+
+    for name, function, kwargs, n_images in benchmark_cases(args.n, args.ndxdm, args.nsynthetic):
+        if args.cases is not None and args.cases not in name:
+            continue
+        try:
+            results["cases"][name] = run_case(function, kwargs, n_images)
+        except Exception as e:
+            logger.warning("Benchmark %s failed: %s", name, str(e).split("\n")[0][:200])
+            results["cases"][name] = {"error": str(e)[:1000]}
+            continue
+        logger.info(
+            "%-40s %8.2f images / s, latency p50 %.3fs, p90 %.3fs, p99 %.3fs",
+            name,
+            results["cases"][name]["images_per_second"],
+            results["cases"][name]["latency_p50"],
+            results["cases"][name]["latency_p90"],
+            results["cases"][name]["latency_p99"],
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info("Saved results at %s", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+    logger.info("All done! Have a nice day!")
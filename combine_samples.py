@@ -2,11 +2,17 @@
 
 from __future__ import absolute_import, division, print_function
 
+import sys
 import argparse
 import logging
 import os
 import numpy as np
 import re
+from collections import OrderedDict
+
+sys.path.append("./")
+
+from simulation.storage import completed_samples, is_sharded, ShardedArray, ShardedWriter, sharded_folder
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -16,7 +22,7 @@ logging.basicConfig(
 )
 
 
-def shuffle_and_combine(dir, input_samples, output_sample, regex=False):
+def shuffle_and_combine(dir, input_samples, output_sample, regex=False, buffer_size=2 ** 28, shard_size=None):
     logger.info("Starting shuffling and combining")
     logger.info("  Folder:              %s", dir)
     logger.info("  Input samples:       %s", input_samples[0])
@@ -24,10 +30,12 @@ def shuffle_and_combine(dir, input_samples, output_sample, regex=False):
         logger.info("                       %s", sample)
     logger.info("  Output sample:       %s", output_sample)
     logger.info("  Regular expressions: %s", regex)
+    logger.info("  Buffer size:         %s MB", buffer_size // 2 ** 20)
+    logger.info("  Output format:       %s", "npy" if shard_size is None else "shards of {}".format(shard_size))
 
     # Path and filenames
     folder = "{}/data/samples/".format(dir)
-    filenames = ["theta", "theta_alt", "x", "t_xz", "t_xz_alt", "log_r_xz", "log_r_xz_alt", "z"]
+    filenames = ["theta", "theta_alt", "x", "t_xz", "t_xz_alt", "log_r_xz", "log_r_xz_alt", "z", "pop", "group"]
 
     # Parse regular expressions
     if regex:
@@ -55,74 +63,165 @@ def shuffle_and_combine(dir, input_samples, output_sample, regex=False):
                         logging.debug("  Found input sample %s", input_sample)
                         input_samples.append(input_sample)
 
+            # Samples in the sharded format
+            for input_sample in sorted(os.listdir(folder)):
+                if re.fullmatch(expr, input_sample) and is_sharded(folder, input_sample):
+                    if input_sample not in input_samples:
+                        logging.debug("  Found sharded input sample %s", input_sample)
+                        input_samples.append(input_sample)
+
         if len(input_samples) == 0:
             logging.warning("  No matching input samples found!")
             return
 
-    # Combine samples
+    # Open the input samples, which can be stored as .npy files or in the sharded format. The .npy files are
+    # memory-mapped, shards are read when they are needed.
+    inputs = OrderedDict()
     n_samples = None
-    permutation = None
-
     for filename in filenames:
-
-        # Load individual files
         try:
-            individuals = [
-                np.load(folder + "/" + filename + "_" + input_sample + ".npy")
-                for input_sample in input_samples
-            ]
+            individuals = [_open_sample(folder, filename, input_sample) for input_sample in input_samples]
         except FileNotFoundError:
             logger.info(
                 "Object %s does not exist for (some of the) input samples", filename
             )
             continue
 
-        # Combine
-        try:
-            combined = np.concatenate(individuals, axis=0)
-        except ValueError:
+        if len(set(individual.shape[1:] for individual, _ in individuals)) > 1:
             logging.warning(
                 "Object %s: individual results do not have matching shapes!", filename
             )
-            for input_sample, individual in zip(input_samples, individuals):
+            for input_sample, (individual, rows) in zip(input_samples, individuals):
                 logging.warning(
-                    "  %s: %s has shape %s", input_sample, filename, individual.shape
+                    "  %s: %s has shape %s", input_sample, filename, (len(rows),) + individual.shape[1:]
                 )
             continue
-        logger.info(
-            "Combined %s %s files, combined shape: %s",
-            len(individuals),
-            filename,
-            combined.shape,
-        )
-
-        # Shuffle
-        if n_samples is None or permutation is None:
-            n_samples = combined.shape[0]
-            permutation = np.random.permutation(n_samples)
+
+        n_combined = sum(len(rows) for _, rows in individuals)
+        if n_samples is None:
+            n_samples = n_combined
+        elif n_samples != n_combined:
+            logging.error("Inconsistent shapes!")
+            raise RuntimeError("Inconsistent shapes!")
+
+        # Group indices (images with several noise realizations) have to stay unique across the input samples
+        if filename == "group":
+            offsets = _group_offsets(individuals)
         else:
-            if n_samples != combined.shape[0]:
-                logging.error("Inconsistent shapes!")
-                raise RuntimeError("Inconsistent shapes!")
+            offsets = [0 for _ in individuals]
+
+        inputs[filename] = (individuals, offsets)
+
+    if n_samples is None:
+        logging.warning("  No input data found!")
+        return
+
+    # Shuffle: the i-th row of the combined inputs ends up at destinations[i] of the output
+    permutation = np.random.permutation(n_samples)
+
+    if shard_size is None:
+        destinations = np.empty(n_samples, dtype=np.int64)
+        destinations[permutation] = np.arange(n_samples)
+        for filename, (individuals, offsets) in inputs.items():
+            _scatter(folder, filename, output_sample, individuals, offsets, destinations, buffer_size)
+    else:
+        _write_shards(folder, output_sample, inputs, permutation, shard_size)
+
+
+def _scatter(folder, filename, output_sample, individuals, offsets, destinations, buffer_size):
+    """ Scatters the rows of the inputs to their shuffled positions in a preallocated output file, in chunks of at
+    most buffer_size bytes, so the memory use does not grow with the size of the samples """
+
+    n_samples = len(destinations)
+    shape = (n_samples,) + individuals[0][0].shape[1:]
+    dtype = np.result_type(*[individual.dtype for individual, _ in individuals])
+
+    output_filename = folder + "/" + filename + "_" + output_sample + ".npy"
+    combined = np.lib.format.open_memmap(output_filename, mode="w+", dtype=dtype, shape=shape)
+    row_bytes = max(dtype.itemsize * int(np.prod(shape[1:])), 1)
+    chunk_size = max(buffer_size // row_bytes, 1)
+
+    i_combined = 0
+    for (individual, rows), offset in zip(individuals, offsets):
+        for i_start in range(0, len(rows), chunk_size):
+            rows_chunk = rows[i_start : i_start + chunk_size]
+            values = np.asarray(individual[rows_chunk])
+            if offset != 0:
+                values = values + offset
+            combined[destinations[i_combined : i_combined + len(rows_chunk)]] = values
+            i_combined += len(rows_chunk)
+    combined.flush()
+    logger.info(
+        "Shuffled and combined %s %s files, combined shape: %s",
+        len(individuals),
+        filename,
+        combined.shape,
+    )
 
-        combined = combined[permutation]
-        logger.info("Shuffled combined %s results", filename)
+    # np.savez_compressed() writes arrays to the zip file in buffered chunks, so the memmap is not loaded at once
+    np.savez_compressed(folder + "/" + filename + "_" + output_sample + ".npz", combined)
+    del combined
+    logger.info("Saved file %s", output_filename)
 
-        # Save
-        try:
-            np.save(folder + "/" + filename + "_" + output_sample + ".npy", combined)
-            np.savez_compressed(
-                folder + "/" + filename + "_" + output_sample + ".npz", combined
-            )
-        except FileExistsError:
-            logging.warning(
-                "File %s already exists, cannot save results!",
-                folder + "/" + filename + "_" + output_sample + ".npy",
-            )
-            continue
-        logger.info(
-            "Saved file %s", folder + "/" + filename + "_" + output_sample + ".npy"
-        )
+
+def _write_shards(folder, output_sample, inputs, permutation, shard_size):
+    """ Writes the shuffled samples in the sharded format, gathering the rows of every shard from the inputs """
+
+    writer = ShardedWriter(folder, output_sample, shard_size=shard_size)
+    for i_start in range(0, len(permutation), shard_size):
+        chunk = OrderedDict()
+        for filename, (individuals, offsets) in inputs.items():
+            chunk[filename] = _gather(individuals, offsets, permutation[i_start : i_start + shard_size])
+        writer.write(chunk)
+        logger.info("Wrote %s / %s samples", min(i_start + shard_size, len(permutation)), len(permutation))
+    writer.close()
+    logger.info(
+        "Saved %s samples with %s in %s shards in %s",
+        writer.n_samples,
+        ", ".join(inputs.keys()),
+        len(writer.shards),
+        sharded_folder(folder, output_sample),
+    )
+
+
+def _gather(individuals, offsets, indices):
+    """ Returns the rows with the given indices of the combined inputs """
+
+    input_starts = np.cumsum([0] + [len(rows) for _, rows in individuals])
+    i_inputs = np.searchsorted(input_starts, indices, side="right") - 1
+    dtype = np.result_type(*[individual.dtype for individual, _ in individuals])
+
+    values = np.empty((len(indices),) + individuals[0][0].shape[1:], dtype=dtype)
+    for i_input in np.unique(i_inputs):
+        individual, rows = individuals[i_input]
+        selected = i_inputs == i_input
+        values[selected] = np.asarray(individual[rows[indices[selected] - input_starts[i_input]]])
+        values[selected] += offsets[i_input]
+    return values
+
+
+def _open_sample(folder, filename, input_sample):
+    """ Memory-maps {filename}_{input_sample}.npy, or opens a ShardedArray for samples in the sharded format, and
+    returns it together with the indices of the rows that are available, which excludes unfinished chunks of
+    incomplete samples (see simulation.storage.load_sample()) """
+
+    if is_sharded(folder, input_sample):
+        individual = ShardedArray(folder, input_sample, filename)
+    else:
+        individual = np.load("{}/{}_{}.npy".format(folder, filename, input_sample), mmap_mode="r")
+    done = completed_samples(folder, input_sample)
+    rows = np.arange(individual.shape[0]) if done is None else np.flatnonzero(done)
+    return individual, rows
+
+
+def _group_offsets(individuals):
+    offsets = []
+    offset = 0
+    for individual, rows in individuals:
+        offsets.append(offset)
+        if len(rows) > 0:
+            offset += int(np.max(np.asarray(individual[rows]))) + 1
+    return offsets
 
 
 def remove_infs_and_nans(folder, filenames, input_sample):
@@ -182,6 +281,20 @@ def parse_args():
         default=".",
         help="Directory. Samples will be looked for / saved in the data/samples subfolder.",
     )
+    parser.add_argument(
+        "--buffer",
+        type=int,
+        default=256,
+        help="Memory in MB for the rows that are copied at once. The memory use does not depend on the sample size. "
+        "Default: 256.",
+    )
+    parser.add_argument(
+        "--shardsize",
+        type=int,
+        default=None,
+        help="Save the combined sample in the sharded format with this many samples per shard, in the folder "
+        "data/samples/{output}/ with a manifest, instead of as .npy and .npz files.",
+    )
 
     return parser.parse_args()
 
@@ -189,6 +302,8 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
 
-    shuffle_and_combine(args.dir, args.inputs, args.output, args.regex)
+    shuffle_and_combine(
+        args.dir, args.inputs, args.output, args.regex, buffer_size=args.buffer * 2 ** 20, shard_size=args.shardsize
+    )
 
     logger.info("All done! Have a nice day!")
@@ -5,11 +5,8 @@ import os
 import json
 import numpy as np
 from collections import OrderedDict
-import torch
 
-from inference.models.vgg import VGGRatioEstimator
-from inference.models.resnet import ResNetRatioEstimator
-from inference.trainer import RatioTrainer
+# torch, the models, and the trainer are slow to import and are imported where they are needed
 from inference.utils import create_missing_folders, load_and_check, get_optimizer
 from inference.utils import get_loss, clean_log_r, clean_t
 from inference.utils import restrict_samplesize
@@ -51,13 +48,18 @@ class ParameterizedRatioEstimator(object):
         self,
         method,
         x,
-        theta,
-        theta_alt,
+        theta=None,
+        theta_alt=None,
         aux=None,
         log_r_xz=None,
         log_r_xz_alt=None,
         t_xz=None,
         t_xz_alt=None,
+        pop=None,
+        theta_alt_sampler=None,
+        sample_weights=None,
+        group=None,
+        augment=False,
         alpha=1.0,
         optimizer="adam",
         n_epochs=50,
@@ -74,6 +76,24 @@ class ParameterizedRatioEstimator(object):
         validation_loss_before=None,
     ):
 
+        # Samples spread over several files: the images are read from the files when they are needed, the other keys
+        # are taken from the dataset unless they are given explicitly
+        from inference.trainer import MultiFileDataset
+
+        if isinstance(x, MultiFileDataset):
+            dataset = x
+            x = dataset.array("x")
+            theta = dataset.load("theta") if theta is None else theta
+            theta_alt = dataset.load("theta_alt") if theta_alt is None else theta_alt
+            if log_r_xz is None and "log_r_xz" in dataset.keys:
+                log_r_xz, log_r_xz_alt = dataset.load("log_r_xz"), dataset.load("log_r_xz_alt")
+            if t_xz is None and "t_xz" in dataset.keys:
+                t_xz, t_xz_alt = dataset.load("t_xz"), dataset.load("t_xz_alt")
+            if pop is None and theta_alt_sampler is not None:
+                pop = dataset.load("pop")
+            if group is None and "group" in dataset.keys:
+                group = dataset.load("group")
+
         logger.info("Starting training")
         logger.info("  Method:                 %s", method)
         if method in ["cascal", "rascal", "alices"]:
@@ -95,6 +115,10 @@ class ParameterizedRatioEstimator(object):
         else:
             logger.info("  Samples:                %s", limit_samplesize)
         logger.info("  Update x rescaling:     %s", update_input_rescaling)
+        logger.info("  Resample theta_alt:     %s", theta_alt_sampler is not None)
+        logger.info("  Sample weights:         %s", sample_weights is not None)
+        logger.info("  Group-aware split:      %s", group is not None)
+        logger.info("  Symmetry augmentation:  %s", augment)
 
         # Load training data
         logger.info("Loading training data")
@@ -106,6 +130,12 @@ class ParameterizedRatioEstimator(object):
         t_xz = load_and_check(t_xz, memmap=False)
         t_xz_alt = load_and_check(t_xz_alt, memmap=False)
         aux = load_and_check(aux, memmap=False)
+        pop = load_and_check(pop, memmap=False)
+        sample_weights = load_and_check(sample_weights, memmap=False)
+        group = load_and_check(group, memmap=False)
+
+        if theta_alt_sampler is not None and pop is None:
+            raise RuntimeError("Resampling theta_alt requires the population statistics pop")
 
         self._check_required_data(method, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt)
         if update_input_rescaling:
@@ -121,6 +151,12 @@ class ParameterizedRatioEstimator(object):
         log_r_xz_alt = clean_log_r(log_r_xz_alt)
         t_xz = clean_t(t_xz)
         t_xz_alt = clean_t(t_xz_alt)
+        if sample_weights is not None:
+            sample_weights = sample_weights.reshape((-1, 1))
+            logger.info(
+                "Effective sample size of weighted training data: %s",
+                np.sum(sample_weights) ** 2 / np.sum(sample_weights ** 2),
+            )
 
         # Rescale aux, theta, and t_xz
         aux = self._transform_aux(aux)
@@ -167,9 +203,10 @@ class ParameterizedRatioEstimator(object):
             logger.info(
                 "Only using %s of %s training samples", limit_samplesize, n_samples
             )
-            x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux = restrict_samplesize(
-                limit_samplesize, x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux
+            x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux, pop, sample_weights = restrict_samplesize(
+                limit_samplesize, x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux, pop, sample_weights
             )
+            group = restrict_samplesize(limit_samplesize, group)[0]
 
         # Check consistency of input with model
         if n_parameters != self.n_parameters:
@@ -179,14 +216,18 @@ class ParameterizedRatioEstimator(object):
                 )
             )
         if resolution != self.resolution:
-            raise RuntimeError(
-                "Number of observables does not match model: {} vs {}".format(
-                    resolution, self.resolution
-                )
+            logger.info(
+                "Image resolution %s differs from model resolution %s, images will be interpolated",
+                resolution,
+                self.resolution,
             )
 
         # Data
         data = self._package_training_data(method, x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux)
+        if theta_alt_sampler is not None:
+            data["pop"] = pop
+        if sample_weights is not None:
+            data["w"] = sample_weights
 
         # Losses
         loss_functions, loss_labels, loss_weights = get_loss(method, alpha)
@@ -196,7 +237,14 @@ class ParameterizedRatioEstimator(object):
 
         # Train model
         logger.info("Training model")
-        trainer = RatioTrainer(self.model, run_on_gpu=True)
+        from inference.trainer import RatioTrainer
+
+        trainer = RatioTrainer(
+            self.model,
+            run_on_gpu=True,
+            theta_alt_sampler=None if theta_alt_sampler is None else self._wrap_theta_alt_sampler(theta_alt_sampler),
+            augment=augment,
+        )
         result = trainer.train(
             data=data,
             loss_functions=loss_functions,
@@ -213,6 +261,98 @@ class ParameterizedRatioEstimator(object):
             early_stopping=early_stopping,
             verbose=verbose,
             validation_loss_before=validation_loss_before,
+            groups=group,
+        )
+        return result
+
+    def train_online(
+        self,
+        method,
+        stream,
+        alpha=1.0,
+        optimizer="adam",
+        n_epochs=50,
+        batch_size=256,
+        initial_lr=0.001,
+        final_lr=0.0001,
+        nesterov_momentum=None,
+        validation_split=0.25,
+        early_stopping=True,
+        verbose="some",
+        update_input_rescaling=True,
+        n_eval=1000,
+        augment=False,
+    ):
+        """ Trains on a SimulationStream, i.e. on data that is simulated while training. The stream has to provide
+        the keys "x", "theta", "theta_alt", and, depending on the method, "log_r_xz", "log_r_xz_alt", "t_xz",
+        "t_xz_alt", as well as "aux" if the model has auxiliary inputs. The validation set (validation_split times the
+        samples per epoch) is simulated first and is also used to initialize the input rescaling. """
+
+        logger.info("Starting online training")
+        logger.info("  Method:                 %s", method)
+        if method in ["cascal", "rascal", "alices"]:
+            logger.info("  alpha:                  %s", alpha)
+        logger.info("  Batch size:             %s", batch_size)
+        logger.info("  Optimizer:              %s", optimizer)
+        logger.info("  Epochs:                 %s", n_epochs)
+        logger.info("  Learning rate:          %s initially, decaying to %s", initial_lr, final_lr)
+        if optimizer == "sgd":
+            logger.info("  Nesterov momentum:      %s", nesterov_momentum)
+        logger.info("  Validation split:       %s", validation_split)
+        logger.info("  Early stopping:         %s", early_stopping)
+        logger.info("  Samples per epoch:      %s", stream.samples_per_epoch)
+        logger.info("  Simulator processes:    %s", stream.n_workers)
+        logger.info("  Replay buffer:          %s samples, each used %s times", stream.buffer_size, stream.n_reuse)
+        logger.info("  Update x rescaling:     %s", update_input_rescaling)
+        logger.info("  Symmetry augmentation:  %s", augment)
+
+        # Validation data
+        n_validation = 0 if validation_split is None else int(np.floor(validation_split * stream.samples_per_epoch))
+        logger.info("Simulating %s validation samples", max(n_validation, n_eval))
+        validation_data = stream.take(max(n_validation, n_eval))
+
+        self._check_required_data(
+            method,
+            validation_data.get("log_r_xz"),
+            validation_data.get("log_r_xz_alt"),
+            validation_data.get("t_xz"),
+            validation_data.get("t_xz_alt"),
+        )
+        if update_input_rescaling:
+            self._initialize_input_transform(validation_data["x"][:n_eval], validation_data.get("aux"))
+
+        def preprocess(data):
+            return self._prepare_online_data(method, data)
+
+        stream.preprocess = preprocess
+        validation_data = preprocess(validation_data) if n_validation > 0 else None
+
+        # Losses
+        loss_functions, loss_labels, loss_weights = get_loss(method, alpha)
+
+        # Optimizer
+        opt, opt_kwargs = get_optimizer(optimizer, nesterov_momentum)
+
+        # Train model
+        logger.info("Training model")
+        from inference.trainer import RatioTrainer
+
+        trainer = RatioTrainer(self.model, run_on_gpu=True, augment=augment)
+        result = trainer.train(
+            data=stream,
+            loss_functions=loss_functions,
+            loss_weights=loss_weights,
+            loss_labels=loss_labels,
+            epochs=n_epochs,
+            batch_size=batch_size,
+            optimizer=opt,
+            optimizer_kwargs=opt_kwargs,
+            initial_lr=initial_lr,
+            final_lr=final_lr,
+            validation_split=validation_split,
+            early_stopping=early_stopping,
+            verbose=verbose,
+            validation_data=validation_data,
         )
         return result
 
@@ -364,6 +504,8 @@ class ParameterizedRatioEstimator(object):
         run_on_gpu,
         double_precision,
     ):
+        import torch
+
         # CPU or GPU?
         run_on_gpu = run_on_gpu and torch.cuda.is_available()
         device = torch.device("cuda" if run_on_gpu else "cpu")
@@ -440,6 +582,8 @@ class ParameterizedRatioEstimator(object):
         return s, log_r, t, x_grad
 
     def save(self, filename, save_model=False):
+        import torch
+
         if self.model is None:
             raise ValueError("No model -- train or load model before saving!")
 
@@ -463,6 +607,8 @@ class ParameterizedRatioEstimator(object):
             torch.save(self.model, filename + "_model.pt")
 
     def load(self, filename):
+        import torch
+
         # Load settings and create model
         logger.debug("Loading settings from %s_settings.json", filename)
         with open(filename + "_settings.json", "r") as f:
@@ -488,6 +634,9 @@ class ParameterizedRatioEstimator(object):
             "  Weight initialization:  %s", "zero bias" if zero_bias else "default"
         )
 
+        from inference.models.vgg import VGGRatioEstimator
+        from inference.models.resnet import ResNetRatioEstimator
+
         if self.architecture in ["resnet", "resnet18"]:
             self.model = ResNetRatioEstimator(
                 n_parameters=self.n_parameters,
@@ -497,6 +646,7 @@ class ParameterizedRatioEstimator(object):
                 input_mean=self.x_scaling_mean,
                 input_std=self.x_scaling_std,
                 zero_bias=zero_bias,
+                resolution=self.resolution,
             )
 
         elif self.architecture == "resnet50":
@@ -509,6 +659,7 @@ class ParameterizedRatioEstimator(object):
                 input_mean=self.x_scaling_mean,
                 input_std=self.x_scaling_std,
                 zero_bias=zero_bias,
+                resolution=self.resolution,
             )
 
         elif self.architecture == "vgg":
@@ -517,6 +668,7 @@ class ParameterizedRatioEstimator(object):
                 log_input=self.log_input,
                 input_mean=self.x_scaling_mean,
                 input_std=self.x_scaling_std,
+                resolution=self.resolution,
             )
 
         else:
@@ -528,6 +680,13 @@ class ParameterizedRatioEstimator(object):
         return sum(p.numel() for p in self.model.parameters() if p.requires_grad)
 
     def _initialize_input_transform(self, x, aux=None, n_eval=1000):
+        # Images that are simulated on demand are only evaluated for the first n_eval samples
+        if not isinstance(x, np.ndarray):
+            x = np.asarray(x[:n_eval])
+        # Images with another resolution are rescaled to the counts per model pixel, as in the model preprocessing
+        if x.shape[-1] != self.resolution:
+            x = x[:n_eval] * (x.shape[-1] / self.resolution) ** 2
+
         if self.rescale_inputs and self.log_input:
             self.x_scaling_mean = np.mean(np.log(1. + x[:n_eval]))
             self.x_scaling_std = np.maximum(np.std(np.log(1. + x[:n_eval])), 1.0e-6)
@@ -564,6 +723,28 @@ class ParameterizedRatioEstimator(object):
             theta = theta / self.theta_std[np.newaxis, :]
         return theta
 
+    def _inverse_transform_theta(self, theta):
+        if self.rescale_theta:
+            theta = theta * self.theta_std[np.newaxis, :]
+            theta = theta + self.theta_mean[np.newaxis, :]
+        return theta
+
+    def _wrap_theta_alt_sampler(self, theta_alt_sampler):
+        """ Lets a theta_alt sampler in physical units act on rescaled theta and cleans up the augmented data """
+
+        def sampler(theta, pop):
+            theta = self._inverse_transform_theta(theta)
+            theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt = theta_alt_sampler(theta, pop)
+
+            theta_alt = self._transform_theta(theta_alt.reshape((-1, 2)))
+            log_r_xz = clean_log_r(log_r_xz.reshape((-1, 1)))
+            log_r_xz_alt = clean_log_r(log_r_xz_alt.reshape((-1, 1)))
+            t_xz = self._transform_t_xz(clean_t(t_xz))
+            t_xz_alt = self._transform_t_xz(clean_t(t_xz_alt))
+            return theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt
+
+        return sampler
+
     def _transform_t_xz(self, t_xz):
         if self.rescale_theta:
             t_xz = t_xz * self.theta_std[np.newaxis, :]
@@ -621,6 +802,34 @@ class ParameterizedRatioEstimator(object):
                 "Method {} requires joint likelihood ratio information".format(method)
             )
 
+    def _prepare_online_data(self, method, data):
+        """ Cleans and rescales a chunk of simulated data like train() does for training data loaded from files """
+
+        x = data["x"]
+        aux = data.get("aux")
+        n_aux = 0 if aux is None else aux.shape[1]
+        if n_aux != self.n_aux:
+            raise RuntimeError(
+                "Number of auxiliary variables found in data ({}) does not match number of"
+                "auxiliary variables in model ({})".format(n_aux, self.n_aux)
+            )
+        if x.shape[1] != x.shape[2]:
+            raise RuntimeError("Currently only supports square images, but found resolution {}".format(x.shape[1:]))
+
+        log_r_xz, log_r_xz_alt = data.get("log_r_xz"), data.get("log_r_xz_alt")
+        t_xz, t_xz_alt = data.get("t_xz"), data.get("t_xz_alt")
+        if log_r_xz is not None:
+            log_r_xz = clean_log_r(log_r_xz.reshape((-1, 1)))
+            log_r_xz_alt = clean_log_r(log_r_xz_alt.reshape((-1, 1)))
+        if t_xz is not None:
+            t_xz = self._transform_t_xz(clean_t(t_xz))
+            t_xz_alt = self._transform_t_xz(clean_t(t_xz_alt))
+        aux = self._transform_aux(aux)
+        theta = self._transform_theta(data["theta"].reshape((-1, 2)))
+        theta_alt = self._transform_theta(data["theta_alt"].reshape((-1, 2)))
+
+        return self._package_training_data(method, x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux)
+
     @staticmethod
     def _package_training_data(method, x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, aux=None):
         data = OrderedDict()
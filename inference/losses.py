@@ -4,30 +4,36 @@ import torch
 from torch.nn import BCELoss, MSELoss
 
 
-def mse_r0(s_hat, log_r_hat, t_hat, y, log_r, t):
+def _mse(prediction, target, w=None):
+    if w is None:
+        return MSELoss()(prediction, target)
+    return torch.mean(w * (prediction - target) ** 2)
+
+
+def mse_r0(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
     inv_r_hat = torch.exp(-log_r_hat)
     inv_r = torch.exp(-log_r)
-    return MSELoss()((1.0 - y) * inv_r_hat, (1.0 - y) * inv_r)
+    return _mse((1.0 - y) * inv_r_hat, (1.0 - y) * inv_r, w)
 
 
-def mse_r1(s_hat, log_r_hat, t_hat, y, log_r, t):
+def mse_r1(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
     r_hat = torch.exp(log_r_hat)
     r = torch.exp(log_r)
-    return MSELoss()(y * r_hat, y * r)
+    return _mse(y * r_hat, y * r, w)
 
 
-def mse_r(s_hat, log_r_hat, t_hat, y, log_r, t):
-    return mse_r0(s_hat, log_r_hat, t_hat, y, log_r, t) + mse_r1(s_hat, log_r_hat, t_hat, y, log_r, t)
+def mse_r(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
+    return mse_r0(s_hat, log_r_hat, t_hat, y, log_r, t, w) + mse_r1(s_hat, log_r_hat, t_hat, y, log_r, t, w)
 
 
-def mse_t0(s_hat, log_r_hat, t_hat, y, log_r, t):
-    return MSELoss()((1.0 - y) * t_hat, (1.0 - y) * t)
+def mse_t0(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
+    return _mse((1.0 - y) * t_hat, (1.0 - y) * t, w)
 
 
-def xe(s_hat, log_r_hat, t_hat, y, log_r, t):
-    return BCELoss()(s_hat, y)
+def xe(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
+    return BCELoss(weight=w)(s_hat, y)
 
 
-def augmented_xe(s_hat, log_r_hat, t_hat, y, log_r, t):
+def augmented_xe(s_hat, log_r_hat, t_hat, y, log_r, t, w=None):
     s = 1.0 / (1.0 + torch.exp(log_r))
-    return BCELoss()(s_hat, s)
+    return BCELoss(weight=w)(s_hat, s)
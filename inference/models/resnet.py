@@ -97,12 +97,13 @@ class Bottleneck(nn.Module):
 
 
 class ResNetRatioEstimator(nn.Module):
-    def __init__(self, n_parameters, n_aux=0, cfg=18, n_hidden=512, input_mean=None, input_std=None, log_input=False, zero_init_residual=False, norm_layer=None, zero_bias=False):
+    def __init__(self, n_parameters, n_aux=0, cfg=18, n_hidden=512, input_mean=None, input_std=None, log_input=False, zero_init_residual=False, norm_layer=None, zero_bias=False, resolution=None):
         super(ResNetRatioEstimator, self).__init__()
 
         self.input_mean = input_mean
         self.input_std = input_std
         self.log_input = log_input
+        self.resolution = resolution
 
         block, layers = self._load_cfg(cfg)
 
@@ -234,10 +235,19 @@ class ResNetRatioEstimator(nn.Module):
         return nn.Sequential(*layers)
 
     def _preprocess(self, x):
+        # Images with another resolution than the network, like low-fidelity simulations, are rescaled to the same
+        # counts per model pixel and interpolated to the model resolution
+        rescale = self.resolution is not None and x.size(-1) != self.resolution
+        if rescale:
+            x = x * (x.size(-1) / self.resolution) ** 2
         if self.log_input:
             x = torch.log(1.0 + x)
         if self.input_mean is not None and self.input_std is not None:
             x = x - self.input_mean
             x = x / self.input_std
         x = x.unsqueeze(1)
+        if rescale:
+            x = nn.functional.interpolate(
+                x, size=(self.resolution, self.resolution), mode="bilinear", align_corners=False
+            )
         return x
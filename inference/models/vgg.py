@@ -9,12 +9,13 @@ logger = logging.getLogger(__name__)
 
 
 class VGGRatioEstimator(nn.Module):
-    def __init__(self, n_parameters, cfg="A", input_mean=None, input_std=None, log_input=False, batch_norm=True, init_weights=True):
+    def __init__(self, n_parameters, cfg="A", input_mean=None, input_std=None, log_input=False, batch_norm=True, init_weights=True, resolution=None):
         super(VGGRatioEstimator, self).__init__()
 
         self.input_mean = input_mean
         self.input_std = input_std
         self.log_input = log_input
+        self.resolution = resolution
 
         self.features = self._make_layers(cfg, batch_norm)
         self.avgpool = nn.AdaptiveAvgPool2d((7, 7))
@@ -60,12 +61,21 @@ class VGGRatioEstimator(nn.Module):
         return s, log_r, t, x_gradient
 
     def _preprocess(self, x):
+        # Images with another resolution than the network, like low-fidelity simulations, are rescaled to the same
+        # counts per model pixel and interpolated to the model resolution
+        rescale = self.resolution is not None and x.size(-1) != self.resolution
+        if rescale:
+            x = x * (x.size(-1) / self.resolution) ** 2
         if self.log_input:
             x = torch.log(1.0 + x)
         if self.input_mean is not None and self.input_std is not None:
             x = x - self.input_mean
             x = x / self.input_std
         x = x.unsqueeze(1)
+        if rescale:
+            x = nn.functional.interpolate(
+                x, size=(self.resolution, self.resolution), mode="bilinear", align_corners=False
+            )
         return x
 
     def _initialize_weights(self):
@@ -1,7 +1,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import six
+import os
+import copy
+import glob
 import logging
+import multiprocessing
 from collections import OrderedDict
 import numpy as np
 import time
@@ -11,6 +15,8 @@ from torch.utils.data import Dataset, DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.nn.utils import clip_grad_norm_
 
+from simulation.storage import completed_samples
+
 logger = logging.getLogger(__name__)
 
 
@@ -23,33 +29,40 @@ class NanException(Exception):
 
 
 class NumpyDataset(Dataset):
-    """ Dataset for numpy arrays with explicit memmap support """
+    """ Dataset for numpy arrays with explicit memmap support. dtype can be a single dtype or one dtype per array.
+    Array-like objects that are not numpy arrays, like the images of a compact sample that are simulated on demand
+    (simulation.compact.RegeneratedImages), are treated like memmaps: they are only indexed in __getitem__, i.e. in the
+    data loader workers. """
 
     def __init__(self, *arrays, dtype=torch.float):
-        self.dtype = dtype
+        if isinstance(dtype, (list, tuple)):
+            assert len(dtype) == len(arrays)
+            self.dtypes = list(dtype)
+        else:
+            self.dtypes = [dtype for _ in arrays]
         self.memmap = []
         self.data = []
         self.n = None
 
-        for array in arrays:
+        for array, dtype in zip(arrays, self.dtypes):
             if self.n is None:
                 self.n = array.shape[0]
             assert array.shape[0] == self.n
 
-            if isinstance(array, np.memmap):
+            if isinstance(array, np.memmap) or not isinstance(array, np.ndarray):
                 self.memmap.append(True)
                 self.data.append(array)
             else:
                 self.memmap.append(False)
-                tensor = torch.from_numpy(array).to(self.dtype)
+                tensor = torch.from_numpy(array).to(dtype)
                 self.data.append(tensor)
 
     def __getitem__(self, index):
         items = []
-        for memmap, array in zip(self.memmap, self.data):
+        for memmap, array, dtype in zip(self.memmap, self.data, self.dtypes):
             if memmap:
                 tensor = np.array(array[index])
-                items.append(torch.from_numpy(tensor).to(self.dtype))
+                items.append(torch.from_numpy(tensor).to(dtype))
             else:
                 items.append(array[index])
         return tuple(items)
@@ -58,9 +71,399 @@ class NumpyDataset(Dataset):
         return self.n
 
 
+class MultiFileArray:
+    """
+    Array-like concatenation of several .npy files along the first axis, without copying them. The files are
+    memory-mapped when they are first accessed, and global indices are mapped to (file, row) with the prefix sums of
+    the file lengths. Indexing with an integer returns the row as numpy array, indexing with a slice or an index array
+    returns another MultiFileArray for these rows, and np.asarray() reads all of them.
+
+    If the key is given, the files are taken to be {key}_{name}.npy files of samples written by
+    simulation.storage.ChunkedWriter, and only the rows in finished chunks of incomplete samples are used.
+    """
+
+    def __init__(self, filenames, key=None):
+        self.filenames = list(filenames)
+        if len(self.filenames) == 0:
+            raise FileNotFoundError("No files to concatenate")
+
+        lengths, shapes, dtypes = [], set(), set()
+        self.rows = []
+        for filename in self.filenames:
+            array = np.load(filename, mmap_mode="r")
+            done = None if key is None else self._completed_samples(filename, key)
+            if done is not None and len(done) != array.shape[0]:
+                raise RuntimeError("Manifest of {} does not match its {} samples".format(filename, array.shape[0]))
+            self.rows.append(None if done is None else np.where(done)[0])
+            lengths.append(array.shape[0] if done is None else int(np.sum(done)))
+            shapes.add(array.shape[1:])
+            dtypes.add(array.dtype)
+        if len(shapes) > 1:
+            raise ValueError("Files {} have different shapes {}".format(self.filenames, shapes))
+
+        self.row_shape = shapes.pop()
+        self.file_dtype = np.result_type(*dtypes)
+        self.offsets = np.cumsum([0] + lengths)
+        self.indices = np.arange(self.offsets[-1])
+        self._files = {}
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.row_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.file_dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            i = self.indices[index]
+            i_file = np.searchsorted(self.offsets, i, side="right") - 1
+            return np.array(self._file(i_file)[self._rows(i_file, i - self.offsets[i_file])])
+
+        view = copy.copy(self)
+        view.indices = self.indices[index]
+        view._files = {}
+        return view
+
+    def __array__(self, dtype=None):
+        result = np.empty(self.shape, dtype=self.dtype)
+        i_files = np.searchsorted(self.offsets, self.indices, side="right") - 1
+        for i_file in np.unique(i_files):
+            selected = i_files == i_file
+            result[selected] = self._file(i_file)[self._rows(i_file, self.indices[selected] - self.offsets[i_file])]
+        return result if dtype is None else result.astype(dtype)
+
+    def __getstate__(self):
+        # Memory maps are not sent to data loader workers, every worker opens the files again
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        return state
+
+    def _file(self, i_file):
+        if i_file not in self._files:
+            self._files[i_file] = np.load(self.filenames[i_file], mmap_mode="r")
+        return self._files[i_file]
+
+    def _rows(self, i_file, i):
+        """ Maps indices within the used rows of a file to rows of the file """
+        return i if self.rows[i_file] is None else self.rows[i_file][i]
+
+    @staticmethod
+    def _completed_samples(filename, key):
+        folder, basename = os.path.split(filename)
+        prefix = "{}_".format(key)
+        if not (basename.startswith(prefix) and basename.endswith(".npy")):
+            return None
+        return completed_samples(folder, basename[len(prefix) : -len(".npy")])
+
+
+class MultiFileDataset(Dataset):
+    """
+    Dataset that concatenates samples that are stored in several files per key, for instance the outputs of several
+    simulate.py runs, without combining them on disk first (see combine_samples.py). Every key is a MultiFileArray.
+    The files of all keys have to be in the same order and have the same lengths. Of incomplete samples written by
+    simulation.storage.ChunkedWriter, only the finished chunks are used.
+
+    ParameterizedRatioEstimator.train() accepts a MultiFileDataset as x: the images are then read from the files when
+    they are needed, and the other keys are taken from the dataset unless they are given explicitly.
+    """
+
+    # Keys that are looked for when files are given as one pattern
+    default_keys = ["x", "theta", "theta_alt", "log_r_xz", "log_r_xz_alt", "t_xz", "t_xz_alt", "z", "pop", "group"]
+
+    def __init__(self, files, keys=None, dtype=torch.float):
+        """
+        :param files: Either a glob pattern with the placeholder {key}, like "data/samples/{key}_train_*.npy", or a
+            dict that maps keys to a list of filenames or a glob pattern. Glob patterns are sorted.
+        :param keys: Keys for a pattern with {key}. Default: all of default_keys for which files exist.
+        :param dtype: dtype of the tensors returned by __getitem__
+        """
+
+        if isinstance(files, six.string_types):
+            pattern = files
+            files = OrderedDict()
+            for key in self.default_keys if keys is None else keys:
+                filenames = sorted(glob.glob(pattern.format(key=key)))
+                if filenames or keys is not None:
+                    files[key] = filenames
+
+        self.arrays = OrderedDict()
+        for key, filenames in files.items():
+            if isinstance(filenames, six.string_types):
+                filenames = sorted(glob.glob(filenames))
+            try:
+                self.arrays[key] = MultiFileArray(filenames, key=key)
+            except FileNotFoundError:
+                raise FileNotFoundError("No files found for key {}".format(key))
+
+        if len(self.arrays) == 0:
+            raise FileNotFoundError("No files found for {}".format(files))
+        reference_key, reference = next(iter(self.arrays.items()))
+        for key, array in self.arrays.items():
+            if not np.array_equal(array.offsets, reference.offsets):
+                raise ValueError(
+                    "Files for {} and {} do not match: {} vs {}".format(
+                        key, reference_key, array.filenames, reference.filenames
+                    )
+                )
+
+        self.dtype = dtype
+        logger.info(
+            "Concatenated %s samples from %s files per key for %s",
+            len(reference),
+            len(reference.filenames),
+            ", ".join(self.arrays.keys()),
+        )
+
+    @property
+    def keys(self):
+        return list(self.arrays.keys())
+
+    def array(self, key):
+        """ Returns the MultiFileArray for a key, which reads from the files when it is indexed """
+        return self.arrays[key]
+
+    def load(self, key):
+        """ Reads all samples of a key into memory. Group indices (see simulation.wrapper.augmented_data()) are offset
+        so that they stay unique across the files. """
+
+        array = self.arrays[key]
+        values = np.asarray(array)
+        if key == "group":
+            offset = 0
+            for i_start, i_end in zip(array.offsets[:-1], array.offsets[1:]):
+                values[i_start:i_end] += offset
+                if i_end > i_start:
+                    offset = int(np.max(values[i_start:i_end])) + 1
+        return values
+
+    def __getitem__(self, index):
+        return tuple(torch.from_numpy(np.asarray(array[index])).to(self.dtype) for array in self.arrays.values())
+
+    def __len__(self):
+        return len(next(iter(self.arrays.values())))
+
+
+def random_dihedral_transform(x):
+    """ Applies one of the 8 rotations and reflections of the square pixel grid, drawn independently for every image,
+    to a batch of images x with shape (batch, ..., n, n). The images with the same transformation are transformed
+    together. """
+
+    elements = torch.randint(8, (x.size(0),), device=x.device)
+    x_transformed = torch.empty_like(x)
+    for element in range(8):
+        indices = (elements == element).nonzero().view(-1)
+        if len(indices) == 0:
+            continue
+        x_element = x[indices]
+        if element >= 4:
+            x_element = torch.flip(x_element, dims=(-1,))
+        x_transformed[indices] = torch.rot90(x_element, element % 4, dims=(-2, -1))
+    return x_transformed
+
+
+class SimulationStream(object):
+    """
+    Training data that is simulated while the network is trained. Background worker processes call the simulator with
+    their own seeds and put the results into a bounded queue. The samples are added to a replay buffer, from which the
+    training samples are drawn at random. Every sample is used `n_reuse` times before it is removed from the buffer,
+    which lets the training run faster than the simulation. Iterating over the stream yields the samples of one epoch,
+    StreamBatches collects them into batches.
+
+    The simulator has to be a picklable function that maps an integer seed to an OrderedDict of numpy arrays, the first
+    dimension running over samples, for instance a functools.partial of simulation.wrapper.augmented_data(). The
+    optional `preprocess` function is applied to these dicts in the main process before the samples enter the buffer.
+    """
+
+    def __init__(
+        self,
+        simulator,
+        preprocess=None,
+        n_workers=1,
+        seed=None,
+        buffer_size=10000,
+        n_reuse=1,
+        samples_per_epoch=10000,
+        queue_size=4,
+        timeout=600.0,
+    ):
+        """
+        :param simulator: Function seed -> OrderedDict of arrays
+        :param preprocess: Optional function OrderedDict of arrays -> OrderedDict of arrays
+        :param n_workers: Number of simulator processes
+        :param seed: Seed from which the seeds of the simulator calls are derived. If None, it is drawn from numpy's
+            global random state.
+        :param buffer_size: The replay buffer is refilled with new simulations until it has at least this many samples
+        :param n_reuse: Number of times every sample is used for training
+        :param samples_per_epoch: Number of samples per training epoch
+        :param queue_size: Maximal number of finished simulator calls waiting in the queue
+        :param timeout: Seconds to wait for new simulations before checking that the workers are still alive
+        """
+
+        self.simulator = simulator
+        self.preprocess = preprocess
+        self.n_workers = n_workers
+        self.seed = np.random.randint(0, 2 ** 31) if seed is None else seed
+        self.buffer_size = buffer_size
+        self.n_reuse = n_reuse
+        self.samples_per_epoch = samples_per_epoch
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.dtypes = {}
+
+        self.labels = None
+        self._queue = None
+        self._workers = []
+        self._buffer = []
+        self._uses_left = []
+        self.n_simulated = 0
+        self.n_used = 0
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def __iter__(self):
+        for _ in range(self.samples_per_epoch):
+            # Refill the buffer, but only wait for the simulation when it is empty
+            while len(self._buffer) < self.buffer_size:
+                data = self._get(block=len(self._buffer) == 0)
+                if data is None:
+                    break
+                self._add_to_buffer(data)
+
+            i = np.random.randint(len(self._buffer))
+            sample = self._buffer[i]
+            self._uses_left[i] -= 1
+            if self._uses_left[i] <= 0:
+                self._buffer[i], self._uses_left[i] = self._buffer[-1], self._uses_left[-1]
+                del self._buffer[-1]
+                del self._uses_left[-1]
+
+            self.n_used += 1
+            yield sample
+
+    def take(self, n):
+        """ Returns n new samples that do not enter the replay buffer (e.g. for validation) as OrderedDict of arrays,
+        before preprocessing """
+
+        results = OrderedDict()
+        n_taken = 0
+        while n_taken < n:
+            data = self._get(block=True)
+            for key, value in data.items():
+                results.setdefault(key, []).append(value[: n - n_taken])
+            n_taken += min(len(next(iter(data.values()))), n - n_taken)
+        return OrderedDict([(key, np.concatenate(value, axis=0)) for key, value in results.items()])
+
+    def close(self):
+        """ Stops the simulator processes """
+
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._queue = None
+        logger.info("Simulated %s samples online and used them %s times for training", self.n_simulated, self.n_used)
+
+    def _start(self):
+        self._queue = multiprocessing.Queue(self.queue_size)
+        self._workers = [
+            multiprocessing.Process(
+                target=_simulation_worker, args=(self.simulator, self.seed, i, self.n_workers, self._queue)
+            )
+            for i in range(self.n_workers)
+        ]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+        logger.info("Started %s simulator processes with seed %s", self.n_workers, self.seed)
+
+    def _get(self, block=True):
+        """ Returns the results of the next simulator call, or None if none is ready and block is False """
+
+        if self._queue is None:
+            self._start()
+
+        while True:
+            try:
+                data = self._queue.get(block=block, timeout=self.timeout if block else None)
+            except six.moves.queue.Empty:
+                if not block:
+                    return None
+                if not any(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError("All simulator processes have stopped")
+                logger.warning("No new simulations after %s seconds", self.timeout)
+                continue
+            self.n_simulated += len(next(iter(data.values())))
+            return data
+
+    def _add_to_buffer(self, data):
+        if self.preprocess is not None:
+            data = self.preprocess(data)
+        if self.labels is None:
+            self.labels = list(data.keys())
+
+        tensors = [
+            torch.from_numpy(np.ascontiguousarray(data[key])).to(self.dtypes.get(key, torch.float))
+            for key in self.labels
+        ]
+        for i in range(tensors[0].shape[0]):
+            self._buffer.append(tuple(tensor[i] for tensor in tensors))
+            self._uses_left.append(self.n_reuse)
+
+
+class StreamBatches(object):
+    """ Batches of the samples of a SimulationStream, which takes the place of a DataLoader for the training data. The
+    stream manages its own worker processes, so the batches are put together in the main process. """
+
+    def __init__(self, stream, batch_size):
+        self.stream = stream
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(self.stream.samples_per_epoch / self.batch_size))
+
+    def __iter__(self):
+        batch = []
+        for sample in self.stream:
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield self._collate(batch)
+                batch = []
+        if len(batch) > 0:
+            yield self._collate(batch)
+
+    @staticmethod
+    def _collate(batch):
+        return [torch.stack(tensors) for tensors in zip(*batch)]
+
+
+def _simulation_worker(simulator, seed, i_worker, n_workers, queue):
+    """ Loop of a SimulationStream worker process. The k-th simulator call gets a seed derived from [seed, k], so the
+    simulated samples do not depend on the number of workers (only their order does). """
+
+    i_call = i_worker
+    while True:
+        np.random.seed([seed, i_call])
+        queue.put(simulator(np.random.randint(0, 2 ** 31)))
+        i_call += n_workers
+
+
 class Trainer(object):
     """ Trainer class. Any subclass has to implement the forward_pass() function. """
 
+    # Data keys that are always kept in double precision
+    double_precision_keys = []
+
     def __init__(self, model, run_on_gpu=True, double_precision=False):
         self._init_timer()
         self._timer(start="ALL")
@@ -100,19 +503,33 @@ class Trainer(object):
         clip_gradient=None,
         verbose="some",
         validation_loss_before=None,
+        validation_data=None,
+        groups=None,
     ):
+        """ data is either an OrderedDict of arrays or a SimulationStream. For a SimulationStream, validation_data is
+        an optional OrderedDict of arrays with a fixed validation set. If it is None, validation_split times the number
+        of samples per epoch are taken from the stream for validation. groups is an optional array with a group index
+        for every sample of data, for instance the image index of noise realizations of the same image. All samples of a
+        group end up on the same side of the train / validation split. """
+
         self._timer(start="ALL")
         self._timer(start="check data")
 
         logger.debug("Initialising training data")
-        self.check_data(data)
-        self.report_data(data)
-        self._timer(stop="check data", start="make dataset")
-        data_labels, dataset = self.make_dataset(data)
-        self._timer(stop="make dataset", start="make dataloader")
-        train_loader, val_loader = self.make_dataloaders(
-            dataset, validation_split, batch_size, seed=validation_split_seed
-        )
+        if isinstance(data, SimulationStream):
+            self._timer(stop="check data", start="make dataloader")
+            data_labels, train_loader, val_loader = self.make_online_dataloaders(
+                data, validation_data, validation_split, batch_size
+            )
+        else:
+            self.check_data(data)
+            self.report_data(data)
+            self._timer(stop="check data", start="make dataset")
+            data_labels, dataset = self.make_dataset(data)
+            self._timer(stop="make dataset", start="make dataloader")
+            train_loader, val_loader = self.make_dataloaders(
+                dataset, validation_split, batch_size, seed=validation_split_seed, groups=groups
+            )
 
         self._timer(stop="make dataloader", start="setup optimizer")
         logger.debug("Setting up optimizer")
@@ -222,6 +639,9 @@ class Trainer(object):
             )
             self._timer(stop="report epoch")
 
+        if isinstance(data, SimulationStream):
+            data.close()
+
         self._timer(start="early stopping")
         if early_stopping and len(losses_val) > 0:
             self.wrap_up_early_stopping(best_model, loss_val, best_loss, best_epoch)
@@ -238,6 +658,9 @@ class Trainer(object):
     def report_data(data):
         logger.debug("Training data:")
         for key, value in six.iteritems(data):
+            if not isinstance(value, np.ndarray):
+                logger.debug("  %s: shape %s, calculated on demand", key, value.shape)
+                continue
             logger.debug(
                 "  %s: shape %s, first %s, mean %s, min %s, max %s",
                 key,
@@ -255,13 +678,15 @@ class Trainer(object):
     def make_dataset(self, data):
         data_arrays = []
         data_labels = []
+        data_dtypes = []
         for key, value in six.iteritems(data):
             data_labels.append(key)
             data_arrays.append(value)
-        dataset = NumpyDataset(*data_arrays, dtype=self.dtype)
+            data_dtypes.append(torch.double if key in self.double_precision_keys else self.dtype)
+        dataset = NumpyDataset(*data_arrays, dtype=data_dtypes)
         return data_labels, dataset
 
-    def make_dataloaders(self, dataset, validation_split, batch_size, seed=None):
+    def make_dataloaders(self, dataset, validation_split, batch_size, seed=None, groups=None):
         if validation_split is None or validation_split <= 0.0:
             train_loader = DataLoader(
                 dataset,
@@ -278,12 +703,15 @@ class Trainer(object):
             )
 
             n_samples = len(dataset)
-            indices = list(range(n_samples))
             split = int(np.floor(validation_split * n_samples))
             if seed is not None:
                 np.random.seed(seed)
-            np.random.shuffle(indices)
-            train_idx, valid_idx = indices[split:], indices[:split]
+            if groups is None:
+                indices = list(range(n_samples))
+                np.random.shuffle(indices)
+                train_idx, valid_idx = indices[split:], indices[:split]
+            else:
+                train_idx, valid_idx = self.split_groups(groups, split)
 
             train_sampler = SubsetRandomSampler(train_idx)
             val_sampler = SubsetRandomSampler(valid_idx)
@@ -305,6 +733,61 @@ class Trainer(object):
 
         return train_loader, val_loader
 
+    @staticmethod
+    def split_groups(groups, n_validation):
+        """ Splits the samples into training and validation indices, keeping the samples of every group together. Whole
+        groups are drawn at random until there are at least n_validation validation samples. """
+
+        groups = np.asarray(groups).flatten()
+        unique_groups, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+        permutation = np.random.permutation(len(unique_groups))
+        if n_validation > 0:
+            n_validation_groups = np.searchsorted(np.cumsum(counts[permutation]), n_validation) + 1
+            n_validation_groups = min(n_validation_groups, len(unique_groups))
+        else:
+            n_validation_groups = 0
+
+        is_validation = np.isin(inverse, permutation[:n_validation_groups])
+        train_idx, valid_idx = list(np.where(~is_validation)[0]), list(np.where(is_validation)[0])
+        logger.debug(
+            "Split %s groups into %s training and %s validation groups with %s and %s samples",
+            len(unique_groups),
+            len(unique_groups) - n_validation_groups,
+            n_validation_groups,
+            len(train_idx),
+            len(valid_idx),
+        )
+        return train_idx, valid_idx
+
+    def make_online_dataloaders(self, stream, validation_data, validation_split, batch_size):
+        """ Data loaders for a SimulationStream: the training batches come from the stream, the validation batches from
+        a fixed set of samples that are never used for training """
+
+        stream.dtypes = {key: torch.double for key in self.double_precision_keys}
+        if validation_data is None and validation_split is not None and validation_split > 0.0:
+            n_validation = int(np.floor(validation_split * stream.samples_per_epoch))
+            logger.info("Simulating %s validation samples", n_validation)
+            validation_data = stream.take(n_validation)
+            if stream.preprocess is not None:
+                validation_data = stream.preprocess(validation_data)
+
+        if validation_data is not None:
+            self.check_data(validation_data)
+            self.report_data(validation_data)
+            data_labels, val_dataset = self.make_dataset(validation_data)
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, pin_memory=self.run_on_gpu, num_workers=8)
+            stream.labels = data_labels
+        else:
+            # Wait for the first simulation to find out which data the stream provides
+            stream._add_to_buffer(stream._get(block=True))
+            data_labels = stream.labels
+            self.check_data(OrderedDict([(key, None) for key in data_labels]))
+            val_loader = None
+
+        train_loader = StreamBatches(stream, batch_size)
+
+        return data_labels, train_loader, val_loader
+
     @staticmethod
     def calculate_lr(i_epoch, n_epochs, initial_lr, final_lr):
         if n_epochs == 1:
@@ -564,11 +1047,26 @@ class Trainer(object):
 
 
 class RatioTrainer(Trainer):
-    def __init__(self, model, run_on_gpu=True, double_precision=False):
+    double_precision_keys = ["pop"]
+
+    def __init__(self, model, run_on_gpu=True, double_precision=False, theta_alt_sampler=None, augment=False):
+        """
+        theta_alt_sampler is an optional function that maps numpy arrays (theta, pop) for a batch to
+        (theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt). If it is given, every training batch is paired with fresh
+        theta_alt values and the corresponding augmented data. This requires the population statistics "pop" in the
+        training data. Validation batches always use the stored theta_alt.
+
+        With augment, every training image is rotated and reflected with a random symmetry of the square pixel grid
+        (see random_dihedral_transform()) whenever it is used. The lens system is statistically invariant under
+        these, so the augmented data, parameters, and aux variables are unchanged. Validation batches are not
+        augmented.
+        """
         super(RatioTrainer, self).__init__(
             model, run_on_gpu, double_precision
         )
         self.calculate_model_score = True
+        self.theta_alt_sampler = theta_alt_sampler
+        self.augment = augment
 
     def check_data(self, data):
         data_keys = list(data.keys())
@@ -578,15 +1076,47 @@ class RatioTrainer(Trainer):
             )
 
         for key in data_keys:
-            if key not in ["x", "theta", "theta_alt", "log_r_xz", "log_r_xz_alt", "t_xz", "t_xz_alt", "aux"]:
+            if key not in ["x", "theta", "theta_alt", "log_r_xz", "log_r_xz_alt", "t_xz", "t_xz_alt", "aux", "pop", "w"]:
                 logger.warning("Unknown key %s in training data! Ignoring it.", key)
 
+        if self.theta_alt_sampler is not None and "pop" not in data_keys:
+            raise ValueError("Resampling theta_alt requires the population statistics 'pop' in the training data!")
+
         self.calculate_model_score = "t_xz" in data_keys
         if self.calculate_model_score:
             logger.debug("Model score will be calculated")
         else:
             logger.debug("Model score will not be calculated")
 
+    def batch_train(
+        self, batch_data, loss_functions, loss_weights, optimizer, clip_gradient=None
+    ):
+        if self.theta_alt_sampler is not None:
+            self._timer(start="resample theta_alt")
+            batch_data = self._resample_theta_alt(batch_data)
+            self._timer(stop="resample theta_alt")
+        if self.augment:
+            self._timer(start="augment x")
+            batch_data["x"] = random_dihedral_transform(batch_data["x"])
+            self._timer(stop="augment x")
+
+        return super(RatioTrainer, self).batch_train(
+            batch_data, loss_functions, loss_weights, optimizer, clip_gradient
+        )
+
+    def _resample_theta_alt(self, batch_data):
+        theta = batch_data["theta"].numpy().astype(np.float64)
+        pop = batch_data["pop"].numpy()
+        theta_alt, log_r_xz, log_r_xz_alt, _, t_xz_alt = self.theta_alt_sampler(theta, pop)
+
+        batch_data["theta_alt"] = torch.from_numpy(theta_alt).to(self.dtype)
+        if "log_r_xz" in batch_data:
+            batch_data["log_r_xz"] = torch.from_numpy(log_r_xz).to(self.dtype)
+            batch_data["log_r_xz_alt"] = torch.from_numpy(log_r_xz_alt).to(self.dtype)
+        if "t_xz_alt" in batch_data:
+            batch_data["t_xz_alt"] = torch.from_numpy(t_xz_alt).to(self.dtype)
+        return batch_data
+
     def forward_pass(self, batch_data, loss_functions):
         self._timer(start="fwd: move data")
         theta = batch_data["theta"].to(self.device, self.dtype, non_blocking=True)
@@ -612,8 +1142,12 @@ class RatioTrainer(Trainer):
             aux = batch_data["aux"].to(self.device, self.dtype, non_blocking=True)
         except KeyError:
             aux = None
+        try:
+            w = batch_data["w"].to(self.device, self.dtype, non_blocking=True)
+        except KeyError:
+            w = None
         self._timer(stop="fwd: move data", start="fwd: check for nans")
-        self._check_for_nans("Training data", theta, x, theta_alt, aux)
+        self._check_for_nans("Training data", theta, x, theta_alt, aux, w)
         self._check_for_nans("Augmented training data", log_r_xz, log_r_xz_alt, t_xz, t_xz_alt)
         self._timer(start="fwd: model.forward", stop="fwd: check for nans")
 
@@ -642,8 +1176,8 @@ class RatioTrainer(Trainer):
         self._timer(start="fwd: calculate losses", stop="fwd: check for nans")
 
         losses = [
-            (loss_function(s_hat, log_r_hat, t_hat, torch.zeros_like(s_hat), log_r_xz, t_xz)
-            + loss_function(s_hat_alt, log_r_hat_alt, t_hat_alt, torch.ones_like(s_hat_alt), log_r_xz_alt, t_xz_alt))
+            (loss_function(s_hat, log_r_hat, t_hat, torch.zeros_like(s_hat), log_r_xz, t_xz, w=w)
+            + loss_function(s_hat_alt, log_r_hat_alt, t_hat_alt, torch.ones_like(s_hat_alt), log_r_xz_alt, t_xz_alt, w=w))
             for loss_function in loss_functions
         ]
         self._timer(stop="fwd: calculate losses", start="fwd: check for nans")
@@ -3,16 +3,16 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import six
 import os
 import numpy as np
-import torch
-from torch import nn, optim
 import logging
 
-from inference import losses
+# torch is slow to import and is imported in the functions that need it
 
 logger = logging.getLogger(__name__)
 
 
 def get_activation_function(activation):
+    from torch import nn
+
     if activation == "relu":
         return nn.ReLU()
     elif activation == "tanh":
@@ -36,6 +36,8 @@ def sigmoid(x):
 
 
 def check_for_nans_in_parameters(model, check_gradients=True):
+    import torch
+
     for param in model.parameters():
         if torch.any(torch.isnan(param)):
             return True
@@ -107,6 +109,10 @@ def load_and_check(filename, warning_threshold=1.0e9, memmap=False):
     if filename is None:
         return None
 
+    # Array-like objects that calculate their entries on demand are used as they are
+    if hasattr(filename, "shape") and not isinstance(filename, (np.ndarray, six.string_types)):
+        return filename
+
     # Don't load image files > 1 GB into memory
     memmap = (
         memmap
@@ -254,6 +260,8 @@ def create_missing_folders(folders):
 
 
 def get_loss(method, alpha):
+    from inference import losses
+
     if method in ["carl"]:
         loss_functions = [losses.xe]
         loss_weights = [1.0]
@@ -284,6 +292,8 @@ def get_loss(method, alpha):
 
 
 def get_optimizer(optimizer, nesterov_momentum):
+    from torch import optim
+
     opt_kwargs = None
     if optimizer == "adam":
         opt = optim.Adam
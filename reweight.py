@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import argparse
+import logging
+import numpy as np
+from scipy.stats import uniform
+
+sys.path.append("./")
+
+from simulation.reweighting import prior_weights, effective_sample_size
+from simulation.storage import load_sample
+
+logger = logging.getLogger(__name__)
+
+
+def reweight(dir, sample, output, f_sub_range, beta_range, pairs=True):
+    logger.info("Reweighting sample %s to new prior", sample)
+    logger.info("  Folder:              %s", dir)
+    logger.info("  f_sub prior:         uniform between %s and %s", f_sub_range[0], f_sub_range[1])
+    logger.info("  beta prior:          uniform between %s and %s", beta_range[0], beta_range[1])
+    logger.info("  Weight pairs:        %s", pairs)
+
+    # Like in train.py, incomplete samples only consist of their finished chunks, and sharded samples are supported
+    folder = "{}/data/samples".format(dir)
+    theta = load_sample(folder, "theta", sample)
+    theta_alt = load_sample(folder, "theta_alt", sample) if pairs else None
+
+    f_sub_prior = uniform(f_sub_range[0], f_sub_range[1] - f_sub_range[0])
+    beta_prior = uniform(beta_range[0], beta_range[1] - beta_range[0])
+    weights = prior_weights(theta, f_sub_prior, beta_prior, theta_alt=theta_alt)
+
+    n_samples = len(weights)
+    n_eff = effective_sample_size(weights)
+    logger.info(
+        "Effective sample size: %.1f out of %s samples (%.1f%%), %s samples with zero weight",
+        n_eff,
+        n_samples,
+        100.0 * n_eff / n_samples,
+        np.sum(weights <= 0.0),
+    )
+
+    filename = "{}/w_{}.npy".format(folder, output)
+    np.save(filename, weights)
+    logger.info("Saved weights at %s", filename)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Calculates importance weights that reweight an existing sample to a new prior"
+    )
+
+    parser.add_argument("sample", type=str, help='Sample name, like "train".')
+    parser.add_argument(
+        "output", type=str, help="Name of the weights. They will be saved in data/samples/w_{output}.npy."
+    )
+    parser.add_argument(
+        "--fsub",
+        type=float,
+        nargs=2,
+        default=(0.001, 0.2),
+        help="Range of the new uniform prior on f_sub. Default: 0.001 0.2.",
+    )
+    parser.add_argument(
+        "--beta",
+        type=float,
+        nargs=2,
+        default=(-2.5, -1.5),
+        help="Range of the new uniform prior on beta. Default: -2.5 -1.5.",
+    )
+    parser.add_argument(
+        "--single",
+        action="store_true",
+        help="Only reweight theta, not theta_alt (e.g. when theta_alt is resampled during training).",
+    )
+    parser.add_argument(
+        "--dir",
+        type=str,
+        default=".",
+        help="Directory. Samples will be looked for / saved in the data/samples subfolder.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    logger.info("Hi!")
+
+    args = parse_args()
+
+    reweight(args.dir, args.sample, args.output, args.fsub, args.beta, pairs=not args.single)
+
+    logger.info("All done! Have a nice day!")
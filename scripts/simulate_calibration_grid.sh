@@ -0,0 +1,16 @@
+#!/bin/bash
+
+#SBATCH --job-name=sim-cal-g
+#SBATCH --output=log_simulate_calibration_grid.log
+#SBATCH --nodes=1
+#SBATCH --cpus-per-task=32
+#SBATCH --mem=64GB
+#SBATCH --time=7-00:00:00
+
+source activate lensing
+cd /scratch/jb6504/StrongLensing-Inference/
+
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calibrate-grid --fixz --fixm --fixalign -n 5000 --name calibrate_fix_grid --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calibrate-grid --fixz --fixalign -n 5000 --name calibrate_mass_grid --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calibrate-grid --fixz --fixm -n 5000 --name calibrate_align_grid --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calibrate-grid -n 5000 --name calibrate_full_grid --dir /scratch/jb6504/recycling_strong_lensing
@@ -3,14 +3,14 @@
 #SBATCH --job-name=sim-calref
 #SBATCH --output=log_simulate_calibration_ref4.log
 #SBATCH --nodes=1
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=8
 #SBATCH --mem=16GB
 #SBATCH --time=5-00:00:00
 
 source activate lensing
 cd /scratch/jb6504/StrongLensing-Inference/
 
-python -u simulate.py --calref --fixz --fixm --fixalign -n 10000 --name calibrate_fix_ref --dir /scratch/jb6504/StrongLensing-Inference
-python -u simulate.py --calref --fixz --fixalign -n 10000 --name calibrate_mass_ref --dir /scratch/jb6504/StrongLensing-Inference
-python -u simulate.py --calref --fixz --fixm -n 10000 --name calibrate_align_ref --dir /scratch/jb6504/StrongLensing-Inference
-python -u simulate.py --calref -n 10000 --name calibrate_full_ref --dir /scratch/jb6504/StrongLensing-Inference
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calref --fixz --fixm --fixalign -n 10000 --name calibrate_fix_ref --dir /scratch/jb6504/StrongLensing-Inference
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calref --fixz --fixalign -n 10000 --name calibrate_mass_ref --dir /scratch/jb6504/StrongLensing-Inference
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calref --fixz --fixm -n 10000 --name calibrate_align_ref --dir /scratch/jb6504/StrongLensing-Inference
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --calref -n 10000 --name calibrate_full_ref --dir /scratch/jb6504/StrongLensing-Inference
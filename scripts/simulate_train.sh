@@ -3,7 +3,7 @@
 #SBATCH --job-name=slr-s-tr
 #SBATCH --output=log_simulate_train_%a.log
 #SBATCH --nodes=1
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=8
 #SBATCH --mem=32GB
 #SBATCH --time=7-00:00:00
 # #SBATCH --gres=gpu:1
@@ -11,7 +11,7 @@
 source activate lensing
 cd /scratch/jb6504/recycling_strong_lensing/
 
-python -u simulate.py --fixz --fixm --fixalign -n 2000 --name train_fix_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
-python -u simulate.py --fixz --fixalign -n 2000 --name train_mass_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
-python -u simulate.py --fixz --fixm -n 2000 --name train_align_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
-python -u simulate.py -n 2000 --name train_full_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --fixz --fixm --fixalign -n 2000 --name train_fix_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --fixz --fixalign -n 2000 --name train_mass_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume --fixz --fixm -n 2000 --name train_align_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
+python -u simulate.py --workers ${SLURM_CPUS_PER_TASK} --resume -n 2000 --name train_full_${SLURM_ARRAY_TASK_ID} --dir /scratch/jb6504/recycling_strong_lensing
@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# Simulates and evaluates the calibration grid with the file-based work queue instead of SLURM arrays. The queue
+# folder has to be on a filesystem shared by all workers. Workers can be started on any number of nodes (for instance
+# by running the last command on every node), each with as many processes as the node has cores.
+
+base=/scratch/jb6504/recycling_strong_lensing
+queue=$base/queues/calibration
+cd $base
+
+./workqueue.py $queue/simulate add "python -u simulate.py --resume --calibrate --theta {i} -n 5000 --name calibrate_full_theta_{i} --dir $base" --range 0 625
+./workqueue.py $queue/evaluate add "python -u test.py alices_full calibrate_full_theta_{i} alices_full_calibrate_theta_{i} --dir $base --igrid {i}" --range 0 625
+
+./workqueue.py $queue/simulate work --workers $(nproc)
+./workqueue.py $queue/evaluate work --workers 1
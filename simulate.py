@@ -2,22 +2,48 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-import sys, os
+import sys
 import argparse
 import logging
+from collections import OrderedDict
+from multiprocessing import Pool
 
 logger = logging.getLogger(__name__)
 sys.path.append("./")
 
 from simulation.units import *
-from simulation.wrapper import augmented_data
+from simulation.wrapper import augmented_data, augmented_data_chunks, augmented_data_grid
+from simulation.storage import ChunkedWriter, read_manifest
+from simulation.cache import SimulationCache
+from simulation.compact import verify_compact_sample
+from simulation.timing import enable_timing, timing_enabled, pop_timer, merge_timer, report_timer, save_timer
 from simulation.prior import draw_params_from_prior, get_reference_point, get_grid_point
 
 
 def simulate_train(
-    n=10000, n_thetas_marginal=1000, fixm=False, fixz=False, fixalign=False
+    n=10000,
+    n_thetas_marginal=1000,
+    fixm=False,
+    fixz=False,
+    fixalign=False,
+    n_workers=1,
+    seed=None,
+    skip_chunks=None,
+    n_noise_realizations=1,
+    compact=False,
+    fidelity="high",
 ):
+    """ Yields chunks of training data. With `compact`, the images are not simulated, instead the seeds from which they
+    can be simulated again are returned (see simulation.compact). `fidelity` is one of the fidelities of the simulator
+    in simulation.wrapper.FIDELITIES. """
+
     logger.info("Generating training data with %s images", n)
+    if n_noise_realizations > 1:
+        logger.info("Every image is observed with %s noise realizations", n_noise_realizations)
+    if compact:
+        logger.info("Compact sample: storing seeds instead of images")
+    if fidelity != "high":
+        logger.info("Simulating with %s fidelity", fidelity)
 
     # Parameter points from prior
     f_sub, beta = draw_params_from_prior(n)
@@ -26,32 +52,33 @@ def simulate_train(
 
     # Samples from numerator
     logger.info("Generating %s images", n)
-    theta, theta_alt, x, t_xz, t_xz_alt, log_r_xz, log_r_xz_alt, _, z = augmented_data(
+    for i_start, chunk in augmented_data_chunks(
         f_sub=f_sub,
         beta=beta,
         f_sub_alt=f_sub_alt,
         beta_alt=beta_alt,
         n_images=n,
         n_thetas_marginal=n_thetas_marginal,
-        mine_gold=True,
+        outputs=["seed" if compact else "x", "gold", "z", "pop"],
         draw_host_mass=not fixm,
         draw_host_redshift=not fixz,
         draw_alignment=not fixalign,
-    )
-    results = {}
-    results["theta"] = theta
-    results["theta_alt"] = theta_alt
-    results["x"] = x
-    results["t_xz"] = t_xz
-    results["t_xz_alt"] = t_xz_alt
-    results["log_r_xz"] = log_r_xz
-    results["log_r_xz_alt"] = log_r_xz_alt
-    results["z"] = z
-
-    return results
+        n_workers=n_workers,
+        seed=seed,
+        n_noise_realizations=n_noise_realizations,
+        skip_chunks=skip_chunks,
+        fidelity=fidelity,
+    ):
+        keys = ["theta", "theta_alt", "seed" if compact else "x"]
+        keys += ["t_xz", "t_xz_alt", "log_r_xz", "log_r_xz_alt", "z", "pop"]
+        if n_noise_realizations > 1:
+            keys.append("group")
+        yield i_start, _select(chunk, keys)
 
 
-def simulate_calibration(i_theta, n=1000, fixm=False, fixz=False, fixalign=False):
+def simulate_calibration(
+    i_theta, n=1000, fixm=False, fixz=False, fixalign=False, n_workers=1, seed=None, skip_chunks=None
+):
     f_sub, beta = get_grid_point(i_theta)
     logger.info(
         "Generating calibration data with %s images at theta %s / 625: f_sub = %s, beta = %s",
@@ -60,42 +87,154 @@ def simulate_calibration(i_theta, n=1000, fixm=False, fixz=False, fixalign=False
         f_sub,
         beta,
     )
-    theta, x, _, _, _, z = augmented_data(
+    for i_start, chunk in augmented_data_chunks(
         f_sub=f_sub,
         beta=beta,
         n_images=n,
-        mine_gold=False,
+        outputs=["x", "z", "pop"],
         draw_host_mass=not fixm,
         draw_host_redshift=not fixz,
         draw_alignment=not fixalign,
-    )
-    results = {}
-    results["theta"] = theta
-    results["x"] = x
-    results["z"] = z
-    return results
+        n_workers=n_workers,
+        seed=seed,
+        skip_chunks=skip_chunks,
+    ):
+        yield i_start, _select(chunk, ["theta", "x", "z", "pop"])
+
+
+def simulate_calibration_grid(
+    grid_indices,
+    n=1000,
+    fixm=False,
+    fixz=False,
+    fixalign=False,
+    n_workers=1,
+    seed=None,
+    skip_chunks=None,
+    cache_dir=None,
+    cache_size=None,
+    group_size=1,
+):
+    """ Simulates calibration data for several grid points in one process pool. Yields (i_row, results) for every
+    finished grid point, where i_row is the position of the grid point in `grid_indices` and the results have an
+    additional first dimension of length 1. As the image seeds only depend on the image index, all grid points share
+    common random numbers. If `cache_dir` is not None, the results for every grid point are looked up in and added to
+    a SimulationCache with disk-size budget `cache_size` (in bytes).
+
+    With `group_size` > 1, groups of that many grid points are simulated together with augmented_data_grid(), which
+    draws the host of every image and calculates its deflection map only once for all grid points of the group. The
+    results are the same, but they are only yielded when the whole group is finished. The cache is not used then. """
+
+    logger.info("Generating calibration data with %s images at %s grid points", n, len(grid_indices))
+    if group_size > 1 and cache_dir is not None:
+        raise ValueError("The simulation cache can only be used for grid points that are simulated one by one")
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+
+    rows = [i_row for i_row in range(len(grid_indices)) if skip_chunks is None or i_row not in skip_chunks]
+    tasks = [
+        (
+            [(i_row, grid_indices[i_row]) for i_row in rows[i_start : i_start + group_size]],
+            n,
+            fixm,
+            fixz,
+            fixalign,
+            seed,
+            cache_dir,
+            cache_size,
+            timing_enabled(),
+        )
+        for i_start in range(0, len(rows), group_size)
+    ]
+
+    if n_workers > 1:
+        pool = Pool(n_workers)
+        results = pool.imap_unordered(_simulate_calibration_points, tasks)
+    else:
+        pool = None
+        results = map(_simulate_calibration_points, tasks)
+
+    try:
+        for group_results, timings in results:
+            merge_timer(timings)
+            for i_row, result in group_results:
+                logger.info("Finished grid point %s", grid_indices[i_row])
+                yield i_row, result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _simulate_calibration_points(args):
+    """ Simulates a group of grid points for simulate_calibration_grid() and returns a list of (i_row, results) """
+
+    points, n, fixm, fixz, fixalign, seed, cache_dir, cache_size, timing = args
+    enable_timing(timing)
+    previous_timings = pop_timer()
+
+    if len(points) > 1:
+        data = augmented_data_grid(
+            [get_grid_point(i_grid) for _, i_grid in points],
+            n,
+            seed=seed,
+            draw_host_mass=not fixm,
+            draw_host_redshift=not fixz,
+            draw_alignment=not fixalign,
+        )
+    else:
+        # The results of a grid point should not depend on which worker simulated which grid points before
+        np.random.seed([seed, points[0][1]])
+        simulate = augmented_data if cache_dir is None else SimulationCache(cache_dir, cache_size).augmented_data
+        f_sub, beta = get_grid_point(points[0][1])
+        data = simulate(
+            f_sub=f_sub,
+            beta=beta,
+            n_images=n,
+            outputs=["x", "z", "pop"],
+            draw_host_mass=not fixm,
+            draw_host_redshift=not fixz,
+            draw_alignment=not fixalign,
+            seed=seed,
+        )
+        data = OrderedDict([(key, data[key][np.newaxis, ...]) for key in ["theta", "x", "z", "pop"]])
 
+    group_results = []
+    for i, (i_row, i_grid) in enumerate(points):
+        results = OrderedDict()
+        results["i_grid"] = np.array([i_grid])
+        for key in ["theta", "x", "z", "pop"]:
+            results[key] = data[key][i : i + 1]
+        group_results.append((i_row, results))
 
-def simulate_calibration_ref(n=1000, fixm=False, fixz=False, fixalign=False):
+    timings = pop_timer()
+    merge_timer(previous_timings)
+    return group_results, timings
+
+
+def simulate_calibration_ref(
+    n=1000, fixm=False, fixz=False, fixalign=False, n_workers=1, seed=None, skip_chunks=None
+):
     logger.info("Generating calibration data with %s images from prior", n)
     f_sub, beta = draw_params_from_prior(n)
-    theta, x, _, _, _, z = augmented_data(
+    for i_start, chunk in augmented_data_chunks(
         f_sub=f_sub,
         beta=beta,
         n_images=n,
-        mine_gold=False,
+        outputs=["x", "z", "pop"],
         draw_host_mass=not fixm,
         draw_host_redshift=not fixz,
         draw_alignment=not fixalign,
-    )
-    results = {}
-    results["theta"] = theta
-    results["x"] = x
-    results["z"] = z
-    return results
+        n_workers=n_workers,
+        seed=seed,
+        skip_chunks=skip_chunks,
+    ):
+        yield i_start, _select(chunk, ["theta", "x", "z", "pop"])
 
 
-def simulate_test_point(n=1000, fixm=False, fixz=False, fixalign=False):
+def simulate_test_point(
+    n=1000, fixm=False, fixz=False, fixalign=False, n_workers=1, seed=None, skip_chunks=None
+):
     f_sub, beta = get_reference_point()
     logger.info(
         "Generating point test data with %s images at f_sub = %s, beta = %s",
@@ -103,53 +242,99 @@ def simulate_test_point(n=1000, fixm=False, fixz=False, fixalign=False):
         f_sub,
         beta,
     )
-    theta, x, _, _, _, z = augmented_data(
+    for i_start, chunk in augmented_data_chunks(
         f_sub=f_sub,
         beta=beta,
         n_images=n,
-        mine_gold=False,
+        outputs=["x", "z", "pop"],
         draw_host_mass=not fixm,
         draw_host_redshift=not fixz,
         draw_alignment=not fixalign,
-    )
-    results = {}
-    results["theta"] = theta
-    results["x"] = x
-    results["z"] = z
-    return results
+        n_workers=n_workers,
+        seed=seed,
+        skip_chunks=skip_chunks,
+    ):
+        yield i_start, _select(chunk, ["theta", "x", "z", "pop"])
 
 
-def simulate_test_prior(n=1000, fixm=False, fixz=False, fixalign=False):
+def simulate_test_prior(
+    n=1000, fixm=False, fixz=False, fixalign=False, n_workers=1, seed=None, skip_chunks=None
+):
     logger.info("Generating prior test data with %s images", n)
     f_sub, beta = draw_params_from_prior(n)
-    theta, x, _, _, _, z = augmented_data(
+    for i_start, chunk in augmented_data_chunks(
         f_sub=f_sub,
         beta=beta,
         n_images=n,
-        mine_gold=False,
+        outputs=["x", "z", "pop"],
         draw_host_mass=not fixm,
         draw_host_redshift=not fixz,
         draw_alignment=not fixalign,
-    )
-    results = {}
-    results["theta"] = theta
-    results["x"] = x
-    results["z"] = z
-    return results
+        n_workers=n_workers,
+        seed=seed,
+        skip_chunks=skip_chunks,
+    ):
+        yield i_start, _select(chunk, ["theta", "x", "z", "pop"])
+
 
+def _select(chunk, keys):
+    return OrderedDict([(key, chunk[key]) for key in keys])
 
-def save(data_dir, name, data):
-    logger.info("Saving results with name %s", name)
 
-    if not os.path.exists(data_dir):
-        os.mkdir(data_dir)
-    if not os.path.exists("{}/data".format(data_dir)):
-        os.mkdir("{}/data".format(data_dir))
-    if not os.path.exists("{}/data/samples".format(data_dir)):
-        os.mkdir("{}/data/samples".format(data_dir))
+def sample_name(args):
+    if args.name is not None:
+        return args.name
+    if args.test:
+        return "test"
+    if args.calibrate:
+        return "calibrate_theta{}".format(args.theta)
+    if args.calibrate_grid:
+        return "calibrate_grid"
+    if args.calref:
+        return "calibrate_ref"
+    return "train"
+
 
-    for key, value in data.items():
-        np.save("{}/data/samples/{}_{}.npy".format(data_dir, key, name), value)
+def open_output(data_dir, name, n, seed=None, settings=None, resume=False, simulator=None):
+    """ Prepares the output files in data/samples. When resuming, the random seed is taken from the manifest of the
+    interrupted run, so that the missing chunks are simulated exactly as in an uninterrupted run. The simulator
+    settings are stored in the manifest as well, so that samples can be simulated again from their seeds. Returns the
+    ChunkedWriter and the seed. """
+
+    folder = "{}/data/samples".format(data_dir)
+    manifest = read_manifest(folder, name) if resume else {}
+
+    if manifest:
+        metadata = manifest["metadata"]
+        if settings is not None and metadata["settings"] != settings:
+            raise RuntimeError(
+                "Cannot resume sample {}, settings {} differ from original settings {}".format(
+                    name, settings, metadata["settings"]
+                )
+            )
+        if seed is not None and seed != metadata["seed"]:
+            raise RuntimeError(
+                "Cannot resume sample {} with seed {}, original seed was {}".format(name, seed, metadata["seed"])
+            )
+        seed = metadata["seed"]
+    elif seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+
+    metadata = {"seed": seed, "settings": settings, "simulator": simulator}
+    writer = ChunkedWriter(folder, name, n, metadata=metadata, resume=resume)
+    return writer, seed
+
+
+def save(writer, chunks):
+    """ Streams the chunks of results to data/samples/{key}_{name}.npy while they are being simulated """
+
+    logger.info("Saving results with name %s", writer.name)
+
+    try:
+        for i_start, chunk in chunks:
+            writer.write(i_start, chunk)
+    finally:
+        writer.close()
 
 
 def parse_args():
@@ -163,6 +348,28 @@ def parse_args():
         action="store_true",
         help="Generate calibration rather than train data.",
     )
+    parser.add_argument(
+        "--calibrate-grid",
+        action="store_true",
+        help="Generate calibration data for all (or a range of) grid points in one run. The results are saved in one "
+        "consolidated file per key with shape (n_grid, n, ...), together with the grid indices in i_grid_{name}.npy.",
+    )
+    parser.add_argument(
+        "--gridrange",
+        type=int,
+        nargs=2,
+        default=[0, 625],
+        metavar=("START", "STOP"),
+        help="Range of grid indices for --calibrate-grid. Default: 0 625.",
+    )
+    parser.add_argument(
+        "--gridgroup",
+        type=int,
+        default=1,
+        help="Number of grid points that are simulated together with --calibrate-grid. Within a group, the host of "
+        "every image is drawn and its deflection map calculated only once. The results do not depend on it, but they "
+        "are only saved when a whole group is finished. Cannot be combined with --cache. Default: 1.",
+    )
     parser.add_argument(
         "--calref",
         action="store_true",
@@ -180,6 +387,27 @@ def parse_args():
         default=10000,
         help="Number of samples to generate. Default is 10k.",
     )
+    parser.add_argument(
+        "--realizations",
+        type=int,
+        default=1,
+        help="Number of noise realizations per simulated training image. Every realization is saved as a separate "
+        "sample, so n times this number samples are generated, together with the image index of every sample in "
+        "group_{name}.npy. Default is 1.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Generate a compact training sample: instead of the images, the seeds in seed_{name}.npy are saved, from "
+        "which train.py simulates the images again when they are needed. A few samples are regenerated after the "
+        "simulation and compared to the stored latents.",
+    )
+    parser.add_argument(
+        "--lowfidelity",
+        action="store_true",
+        help="Generate a cheap low-fidelity training sample with 32 x 32 pixels, only subhalos above 1e8 solar masses, "
+        "and no PSF, for pretraining with train.py --pretrain. Only for training samples.",
+    )
     parser.add_argument("--fixm", action="store_true", help="Fix host halo mass")
     parser.add_argument("--fixz", action="store_true", help="Fix lens redshift")
     parser.add_argument(
@@ -200,9 +428,49 @@ def parse_args():
         default=".",
         help="Base directory. Results will be saved in the data/samples subfolder.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for the simulation. Default is 1.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed. Results only depend on the seed, not on the number of workers.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run with the same name, only simulating the chunks that are missing or corrupted.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="Cache directory for --calibrate-grid. Grid points that were already simulated with the same settings, "
+        "seed, and code version are loaded from there instead of simulated again.",
+    )
+    parser.add_argument(
+        "--cachesize",
+        type=float,
+        default=None,
+        help="Disk-size budget of the cache in GB. When it is exceeded, the least recently used entries are deleted. "
+        "Default: no limit.",
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Measure the time spent in the stages of the simulation and save a summary in "
+        "data/samples/timing_{name}.json.",
+    )
     parser.add_argument("--debug", action="store_true", help="Prints debug output.")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.lowfidelity and (args.test or args.calibrate or args.calibrate_grid or args.calref):
+        parser.error("--lowfidelity is only meant for training samples (see train.py --pretrain)")
+    return args
 
 
 if __name__ == "__main__":
@@ -215,34 +483,109 @@ if __name__ == "__main__":
     )
     logger.info("Hi!")
 
+    # Output files and random seed
+    name = sample_name(args)
+    settings = vars(args).copy()
+    for key in ["dir", "name", "seed", "workers", "resume", "cache", "cachesize", "gridgroup", "timing", "debug"]:
+        del settings[key]
+    grid_indices = list(range(*args.gridrange))
+    n_rows = len(grid_indices) if args.calibrate_grid else args.n
+    if not (args.test or args.calibrate or args.calibrate_grid or args.calref):
+        n_rows *= args.realizations
+    simulator = {
+        "draw_host_mass": not args.fixm,
+        "draw_host_redshift": not args.fixz,
+        "draw_alignment": not args.fixalign,
+        "roi_size": 2.0,
+        "fidelity": "low" if args.lowfidelity else "high",
+    }
+    writer, seed = open_output(
+        args.dir, name, n_rows, seed=args.seed, settings=settings, resume=args.resume, simulator=simulator
+    )
+    skip_chunks = writer.completed_chunks
+    logger.info("Random seed: %s", seed)
+    np.random.seed(seed)
+    enable_timing(args.timing)
+
     if args.test:
-        name = "test" if args.name is None else args.name
         if args.point:
             results = simulate_test_point(
-                args.n, fixm=args.fixm, fixz=args.fixz, fixalign=args.fixalign
+                args.n,
+                fixm=args.fixm,
+                fixz=args.fixz,
+                fixalign=args.fixalign,
+                n_workers=args.workers,
+                seed=seed,
+                skip_chunks=skip_chunks,
             )
         else:
             results = simulate_test_prior(
-                args.n, fixm=args.fixm, fixz=args.fixz, fixalign=args.fixalign
+                args.n,
+                fixm=args.fixm,
+                fixz=args.fixz,
+                fixalign=args.fixalign,
+                n_workers=args.workers,
+                seed=seed,
+                skip_chunks=skip_chunks,
             )
     elif args.calibrate:
         assert args.theta is not None, "Please provide --theta"
-        name = (
-            "calibrate_theta{}".format(args.theta) if args.name is None else args.name
-        )
         results = simulate_calibration(
-            args.theta, args.n, fixm=args.fixm, fixz=args.fixz, fixalign=args.fixalign
+            args.theta,
+            args.n,
+            fixm=args.fixm,
+            fixz=args.fixz,
+            fixalign=args.fixalign,
+            n_workers=args.workers,
+            seed=seed,
+            skip_chunks=skip_chunks,
+        )
+    elif args.calibrate_grid:
+        results = simulate_calibration_grid(
+            grid_indices,
+            args.n,
+            fixm=args.fixm,
+            fixz=args.fixz,
+            fixalign=args.fixalign,
+            n_workers=args.workers,
+            seed=seed,
+            skip_chunks=skip_chunks,
+            cache_dir=args.cache,
+            cache_size=None if args.cachesize is None else args.cachesize * 1.0e9,
+            group_size=args.gridgroup,
         )
     elif args.calref:
-        name = "calibrate_ref" if args.name is None else args.name
         results = simulate_calibration_ref(
-            args.n, fixm=args.fixm, fixz=args.fixz, fixalign=args.fixalign
+            args.n,
+            fixm=args.fixm,
+            fixz=args.fixz,
+            fixalign=args.fixalign,
+            n_workers=args.workers,
+            seed=seed,
+            skip_chunks=skip_chunks,
         )
     else:
-        name = "train" if args.name is None else args.name
         results = simulate_train(
-            args.n, fixm=args.fixm, fixz=args.fixz, fixalign=args.fixalign
+            args.n,
+            fixm=args.fixm,
+            fixz=args.fixz,
+            fixalign=args.fixalign,
+            n_workers=args.workers,
+            seed=seed,
+            skip_chunks=skip_chunks,
+            n_noise_realizations=args.realizations,
+            compact=args.compact,
+            fidelity=simulator["fidelity"],
         )
-    save(args.dir, name, results)
+    save(writer, results)
+
+    if args.compact and not (args.test or args.calibrate or args.calibrate_grid or args.calref):
+        verify_compact_sample("{}/data/samples".format(args.dir), name, n_verify=3)
+
+    if args.timing:
+        report_timer()
+        filename = "{}/data/samples/timing_{}.json".format(args.dir, name)
+        save_timer(filename, metadata={"name": name, "seed": seed, "workers": args.workers, "settings": settings})
+        logger.info("Saved timing summary at %s", filename)
 
     logger.info("All done! Have a nice day!")
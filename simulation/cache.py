@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import inspect
+import logging
+from collections import OrderedDict
+import numpy as np
+
+from simulation.wrapper import augmented_data
+
+logger = logging.getLogger(__name__)
+
+# Arguments of augmented_data() that do not change its results
+IGNORED_ARGUMENTS = ["n_workers", "chunk_size"]
+
+# Outputs of augmented_data() that are lists of arrays with different lengths
+LIST_OUTPUTS = ["sub_latents", "dx_dm"]
+
+
+class SimulationCache:
+    """
+    Content-addressed cache for the results of `augmented_data()`. The key of an entry is a hash of all arguments that
+    affect the results (simulator settings, priors, parameter points, seed, number of images), of the state of numpy's
+    global random number generator (from which parameter points and seeds are drawn), and of the source code of the
+    simulation package. Entries are stored as .npy files in {folder}/{key}/ and returned as read-only memory maps.
+    When the total size of the cache exceeds `max_size`, the least recently used entries are deleted.
+
+    Layout of an entry:
+        {key}/{output}.npy                Results, one file per key of the augmented_data() record
+        {key}/{output}_offsets.npy        Start index of every image for list outputs like "sub_latents"
+        {key}/random_state.npy            Global random state after the simulation
+        {key}/entry.json                  Description of the entry, the modification time is the last access
+    """
+
+    def __init__(self, folder, max_size=None):
+        """
+        :param folder: Cache directory. Can be shared by several processes.
+        :param max_size: Disk-size budget in bytes. If None, entries are never evicted.
+        """
+
+        self.folder = folder
+        self.max_size = max_size
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def augmented_data(self, **kwargs):
+        """ Returns the results of `simulation.wrapper.augmented_data(**kwargs)`, from the cache if possible.
+
+        On a hit, numpy's global random state is set to the state after the original simulation, so the rest of a run
+        continues exactly as if the simulation had been run. """
+
+        key = self.key(**kwargs)
+        results = self.get(key)
+        if results is not None:
+            logger.info("Found simulation results in cache entry %s", key)
+            return results
+
+        logger.info("No cache entry %s, simulating", key)
+        results = augmented_data(**kwargs)
+        self.put(key, results, kwargs)
+        self.evict()
+        return results
+
+    def key(self, **kwargs):
+        """ Content hash of all arguments of `augmented_data()` that affect the results, including the defaults """
+
+        arguments = inspect.signature(augmented_data).bind(**kwargs)
+        arguments.apply_defaults()
+
+        description = OrderedDict()
+        for name, value in arguments.arguments.items():
+            if name not in IGNORED_ARGUMENTS:
+                description[name] = _fingerprint(value)
+        description["random_state"] = _fingerprint(np.random.get_state())
+        description["code_version"] = code_version()
+
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """ Returns the cached results as OrderedDict of memory-mapped arrays, or None if there is no valid entry """
+
+        folder = self._entry_folder(key)
+        try:
+            with open("{}/entry.json".format(folder)) as f:
+                entry = json.load(f)
+
+            results = OrderedDict()
+            for output in entry["outputs"]:
+                data = np.load("{}/{}.npy".format(folder, output), mmap_mode="r")
+                if output in LIST_OUTPUTS:
+                    offsets = np.load("{}/{}_offsets.npy".format(folder, output))
+                    data = [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+                results[output] = data
+            random_state = np.load("{}/random_state.npy".format(folder))
+        except (IOError, ValueError, KeyError):
+            return None
+
+        np.random.set_state(
+            ("MT19937", random_state, entry["random_state_pos"], entry["has_gauss"], entry["cached_gaussian"])
+        )
+        os.utime("{}/entry.json".format(folder), None)
+        return results
+
+    def put(self, key, results, kwargs=None):
+        """ Stores the results of augmented_data() together with the current global random state """
+
+        # Write everything to a temporary folder first, so entries are never half-written
+        tmp_folder = "{}/tmp.{}".format(self.folder, uuid.uuid4().hex)
+        os.makedirs(tmp_folder)
+
+        for output, data in results.items():
+            if output in LIST_OUTPUTS:
+                offsets = np.cumsum([0] + [len(item) for item in data])
+                np.save("{}/{}_offsets.npy".format(tmp_folder, output), offsets)
+                data = np.concatenate(data, axis=0) if len(data) > 0 else np.zeros((0,))
+            np.save("{}/{}.npy".format(tmp_folder, output), data)
+
+        state = np.random.get_state()
+        np.save("{}/random_state.npy".format(tmp_folder), state[1])
+
+        entry = {
+            "key": key,
+            "outputs": list(results.keys()),
+            "random_state_pos": int(state[2]),
+            "has_gauss": int(state[3]),
+            "cached_gaussian": float(state[4]),
+            "arguments": {} if kwargs is None else {name: repr(value)[:200] for name, value in kwargs.items()},
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open("{}/entry.json".format(tmp_folder), "w") as f:
+            json.dump(entry, f, indent=2)
+
+        try:
+            os.rename(tmp_folder, self._entry_folder(key))
+            logger.info("Stored simulation results in cache entry %s", key)
+        except OSError:
+            # Another process stored the same entry in the meantime
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def entries(self):
+        """ Returns a list of (key, size in bytes, last access time) for all entries, least recently used first """
+
+        entries = []
+        for key in os.listdir(self.folder):
+            if key.startswith("tmp."):
+                continue
+            folder = self._entry_folder(key)
+            try:
+                last_access = os.path.getmtime("{}/entry.json".format(folder))
+                size = sum(os.path.getsize("{}/{}".format(folder, filename)) for filename in os.listdir(folder))
+            except (IOError, OSError):
+                continue
+            entries.append((key, size, last_access))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Deletes the least recently used entries until the cache fits into the disk-size budget """
+
+        if self.max_size is None:
+            return
+
+        entries = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            logger.info("Evicting cache entry %s (%.1f MB)", key, size / 1.0e6)
+            shutil.rmtree(self._entry_folder(key), ignore_errors=True)
+            total_size -= size
+
+    def _entry_folder(self, key):
+        return "{}/{}".format(self.folder, key)
+
+
+def code_version():
+    """ Hash of the source code of the simulation package """
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    sha = hashlib.sha1()
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".py"):
+            with open("{}/{}".format(folder, filename), "rb") as f:
+                sha.update(filename.encode("utf-8"))
+                sha.update(f.read())
+    return sha.hexdigest()
+
+
+def _fingerprint(value):
+    """ JSON-serializable representation of an argument that changes whenever the value changes """
+
+    if hasattr(value, "dist") and hasattr(value, "args") and hasattr(value, "kwds"):  # Frozen scipy distribution
+        return {"distribution": value.dist.name, "args": _fingerprint(value.args), "kwds": _fingerprint(value.kwds)}
+    if isinstance(value, dict):
+        return {str(key): _fingerprint(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_fingerprint(item) for item in value]
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return {
+            "dtype": str(value.dtype),
+            "shape": list(value.shape),
+            "sha1": hashlib.sha1(value.tobytes()).hexdigest(),
+        }
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise ValueError("Cannot use argument {} of type {} in a cache key".format(value, type(value)))
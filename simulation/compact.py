@@ -0,0 +1,129 @@
+import logging
+import numpy as np
+
+from simulation.wrapper import regenerate, FIDELITIES
+from simulation.storage import load_sample, read_manifest
+
+logger = logging.getLogger(__name__)
+
+# Simulator settings that are needed to regenerate the images of a sample, stored in the manifest metadata
+SIMULATOR_SETTINGS = ["draw_host_mass", "draw_host_redshift", "draw_alignment", "roi_size", "fidelity"]
+
+
+def _simulator_settings(settings):
+    """ Picks SIMULATOR_SETTINGS from the manifest metadata, samples from before the fidelity was stored are high
+    fidelity """
+
+    settings = dict(settings)
+    settings.setdefault("fidelity", "high")
+    return {key: settings[key] for key in SIMULATOR_SETTINGS}
+
+
+class RegeneratedImages:
+    """
+    Array-like stand-in for the images x of a compact sample, which stores the parameter points and seeds of the
+    samples instead of the images. The images are simulated again whenever they are accessed, which trades disk space
+    and IO for CPU time. Indexing with an integer returns an image as numpy array, indexing with a slice or an index
+    array returns another RegeneratedImages object for these samples, and np.asarray() simulates all of them.
+
+    Wrapped in a torch Dataset (see inference.trainer.NumpyDataset), the images are simulated in the data loader
+    workers.
+    """
+
+    def __init__(self, theta, seeds, simulator_settings, indices=None):
+        """
+        :param theta: Parameter points (f_sub, beta) with shape (n, 2)
+        :param seeds: Seeds with shape (n, 3), see the output "seed" of simulation.wrapper.augmented_data()
+        :param simulator_settings: Dict with the keys SIMULATOR_SETTINGS of the original simulation
+        :param indices: Indices of the samples in theta and seeds that are part of this object. Default: all.
+        """
+
+        self.theta = np.asarray(theta)
+        self.seeds = np.asarray(seeds, dtype=np.int64)
+        self.simulator_settings = _simulator_settings(simulator_settings)
+        self.indices = np.arange(self.theta.shape[0]) if indices is None else np.asarray(indices)
+        self.n_xy = FIDELITIES[self.simulator_settings["fidelity"]]["n_xy"]
+
+    @property
+    def shape(self):
+        return (len(self.indices), self.n_xy, self.n_xy)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            i = self.indices[index]
+            return self._regenerate(self.theta[i : i + 1], self.seeds[i : i + 1])[0]
+        return RegeneratedImages(self.theta, self.seeds, self.simulator_settings, self.indices[index])
+
+    def __array__(self, dtype=None):
+        images = self._regenerate(self.theta[self.indices], self.seeds[self.indices])
+        return images if dtype is None else images.astype(dtype)
+
+    def _regenerate(self, theta, seeds):
+        return regenerate(theta, seeds, outputs=["x"], **self.simulator_settings)["x"]
+
+
+def load_compact_images(folder, name):
+    """ Returns a RegeneratedImages object for the images of sample {name} in {folder}, which has to be simulated with
+    the output "seed" and simulator settings in its manifest (see simulate.py --compact) """
+
+    manifest = read_manifest(folder, name)
+    simulator_settings = manifest.get("metadata", {}).get("simulator")
+    if simulator_settings is None:
+        raise RuntimeError("The manifest of sample {} does not contain the simulator settings".format(name))
+
+    theta = load_sample(folder, "theta", name)
+    seeds = load_sample(folder, "seed", name)
+    logger.info("Images of sample %s with %s samples are simulated on demand", name, len(seeds))
+    return RegeneratedImages(theta, seeds, simulator_settings)
+
+
+def verify_compact_sample(folder, name, n_verify=10, keys=("x", "z", "pop"), rtol=1.0e-6):
+    """
+    Simulates randomly chosen samples of a sample with seeds again and compares them to the stored arrays of the keys
+    in `keys` that exist, for instance the global latents z and population statistics pop of a compact sample.
+
+    :return: True if all regenerated samples agree with the stored ones
+    """
+
+    manifest = read_manifest(folder, name)
+    simulator_settings = manifest["metadata"]["simulator"]
+    theta = load_sample(folder, "theta", name)
+    seeds = load_sample(folder, "seed", name)
+
+    stored = {}
+    for key in keys:
+        try:
+            stored[key] = load_sample(folder, key, name, mmap_mode="r")
+        except FileNotFoundError:
+            pass
+
+    indices = np.random.choice(len(seeds), size=min(n_verify, len(seeds)), replace=False)
+    simulator_settings = _simulator_settings(simulator_settings)
+    regenerated = regenerate(theta[indices], seeds[indices], outputs=list(stored.keys()), **simulator_settings)
+
+    passed = True
+    for key, values in regenerated.items():
+        for i, value in zip(indices, values):
+            if not np.allclose(value, stored[key][i], rtol=rtol, equal_nan=True):
+                logger.warning("Sample %s of %s: regenerated %s differs from stored one", i, name, key)
+                passed = False
+
+    logger.info(
+        "Regenerated %s samples of %s and compared %s: %s",
+        len(indices),
+        name,
+        ", ".join(stored.keys()),
+        "ok" if passed else "MISMATCH",
+    )
+    return passed
@@ -0,0 +1,184 @@
+import logging
+import numpy as np
+from scipy.special import logsumexp
+
+from simulation.units import M_s, M_MW
+from simulation.population_sim import SubhaloPopulation
+from simulation.prior import draw_params_from_prior
+
+logger = logging.getLogger(__name__)
+
+# Columns of the compact population latents stored with every simulated image. Together with the simulator settings
+# they are sufficient statistics for the joint likelihood p(z | f_sub, beta) of the subhalo population.
+POPULATION_STATISTICS = [
+    "n_sub_roi",  # Number of subhalos in the ROI
+    "sum_log_m_sub",  # Sum over subhalos of log(m_sub / M_s)
+    "M_200_hst",  # Host halo mass in units of M_s
+    "f_sub_roi",  # Fraction of the host halo contained in the ROI (cylindrical mass fraction)
+]
+
+
+def population_statistics(sim):
+    """ Extracts the compact population latents (see POPULATION_STATISTICS) from a LensingObservationWithSubhalos """
+
+    return np.array(
+        [
+            sim.n_sub_roi,
+            np.sum(np.log(sim.m_subs / M_s)),
+            sim.M_200_hst / M_s,
+            sim.f_sub_roi,
+        ]
+    )
+
+
+def joint_log_probs(
+    population,
+    params,
+    m_200_min_sub=1.0e7 * M_s,
+    m_200_max_sub_div_M_hst=0.01,
+    m_min_calib=1.0e7 * M_s,
+    m_max_sub_div_M_hst_calib=0.01,
+    m_0=1.0e9 * M_s,
+    eps=1.0e-6,
+):
+    """
+    Calculates log p(n_sub_roi, m_subs | f_sub, beta) for a batch of images from their population statistics,
+    vectorized over images and parameter points. Agrees with SubhaloPopulation._calculate_joint_log_probs().
+
+    :param population: Population statistics with shape (n_images, 4), see POPULATION_STATISTICS
+    :param params: Parameter points (f_sub, beta), either with shape (n_thetas, 2), which are then evaluated for all
+        images, or with shape (n_images, n_thetas, 2)
+    :param m_200_min_sub: Lowest mass of subhalos, as in LensingObservationWithSubhalos
+    :param m_200_max_sub_div_M_hst: Maximum mass of subhalos in units of host halo mass
+    :param m_min_calib: Minimum mass above which subhalo mass fraction is `f_sub`
+    :param m_max_sub_div_M_hst_calib: Maximum mass below which subhalo mass fraction is `f_sub`, in units of host mass
+    :return: Joint log likelihoods with shape (n_images, n_thetas)
+    """
+
+    population = np.asarray(population, dtype=np.float64).reshape((-1, len(POPULATION_STATISTICS)))
+    params = np.asarray(params, dtype=np.float64)
+    if params.ndim == 2:
+        params = params[np.newaxis, :, :]
+
+    n_sub = population[:, 0, np.newaxis]
+    sum_log_m = population[:, 1, np.newaxis]
+    M_hst = population[:, 2, np.newaxis] * M_s
+    f_sub_roi = population[:, 3, np.newaxis]
+    m_max = m_200_max_sub_div_M_hst * M_hst
+    m_max_calib = m_max_sub_div_M_hst_calib * M_hst
+    f_sub, beta = params[:, :, 0], params[:, :, 1]
+
+    # Poisson term
+    alpha = SubhaloPopulation._alpha_f_sub(f_sub, beta, m_min_calib, m_max_calib)
+    expected_n_sub = alpha / (-beta - 1.0) * m_0 * M_hst / M_MW
+    expected_n_sub *= (m_200_min_sub / m_0) ** (beta + 1.0) - (m_max / m_0) ** (beta + 1.0)
+    expected_n_sub = f_sub_roi * np.maximum(expected_n_sub, 0.0)
+    if np.any(expected_n_sub <= eps):
+        logger.warning("Expected number of subs in RoI is below %s for some parameter points, setting to %s", eps, eps)
+        expected_n_sub = np.maximum(expected_n_sub, eps)
+    log_p = n_sub * np.log(expected_n_sub) - expected_n_sub
+
+    # Power law for subhalo masses
+    log_p += beta * (sum_log_m - n_sub * np.log(m_0 / M_s))
+    log_p += n_sub * (
+        np.log(-beta - 1.0) - np.log(m_0) - np.log((m_200_min_sub / m_0) ** (beta + 1.0) - (m_max / m_0) ** (beta + 1.0))
+    )
+
+    return log_p
+
+
+def joint_scores(population, params, eps0=1.0e-5, eps1=1.0e-3, **kwargs):
+    """
+    Calculates grad_(f_sub, beta) log p(n_sub_roi, m_subs | f_sub, beta) with the same finite differences as
+    SubhaloPopulation._calculate_joint_scores().
+
+    :param population: Population statistics with shape (n_images, 4)
+    :param params: Parameter points (f_sub, beta) with shape (n_images, 2), one per image
+    :return: Joint scores with shape (n_images, 2)
+    """
+
+    params = np.asarray(params, dtype=np.float64).reshape((-1, 1, 2))
+    all_params = np.concatenate(
+        (params, params + np.array([eps0, 0.0]).reshape((1, 1, 2)), params + np.array([0.0, eps1]).reshape((1, 1, 2))),
+        axis=1,
+    )
+    log_probs = joint_log_probs(population, all_params, **kwargs)
+
+    score0 = (log_probs[:, 1] - log_probs[:, 0]) / eps0
+    score1 = (log_probs[:, 2] - log_probs[:, 0]) / eps1
+    return np.vstack((score0, score1)).T
+
+
+def log_r_from_log_probs(log_probs, i, n_thetas_marginal):
+    """
+    Calculates the joint log likelihood ratio log r(x, z | theta_i) = log p(x, z | theta_i) - log p_ref(x, z) for a
+    batch of images, where the reference model marginalizes over all other rows of the log probability matrix.
+
+    :param log_probs: Joint log likelihoods with shape (n_images, n_thetas)
+    :param i: Column of the numerator hypothesis
+    :param n_thetas_marginal: Normalization of the marginal (number of parameter points in it)
+    :return: log r with shape (n_images,)
+    """
+
+    log_probs = np.asarray(log_probs, dtype=np.float64)
+    log_p_xz_from_marginal = np.delete(log_probs, i, axis=1)
+    delta_log = log_p_xz_from_marginal - log_probs[:, i, np.newaxis] - np.log(float(n_thetas_marginal))
+    return -1.0 * logsumexp(delta_log, axis=1)
+
+
+def mine_gold(population, theta, theta_alt, params_ref, **kwargs):
+    """
+    Recalculates the augmented data (joint likelihood ratios and scores) for stored population statistics, new
+    parameter pairs, and a new reference set, without rerunning the image simulation.
+
+    :param population: Population statistics with shape (n_images, 4)
+    :param theta: Numerator hypotheses with shape (n_images, 2)
+    :param theta_alt: Alternate hypotheses with shape (n_images, 2)
+    :param params_ref: Parameter points (f_sub, beta) that, together with theta and theta_alt, define the reference
+        marginal model, shape (n_thetas_marginal - 1, 2)
+    :return: Tuple (log_r_xz, log_r_xz_alt, t_xz, t_xz_alt)
+    """
+
+    theta = np.asarray(theta, dtype=np.float64).reshape((-1, 1, 2))
+    theta_alt = np.asarray(theta_alt, dtype=np.float64).reshape((-1, 1, 2))
+    params_ref = np.asarray(params_ref, dtype=np.float64).reshape((1, -1, 2))
+    n_thetas_marginal = params_ref.shape[1] + 1
+
+    params_ref = np.repeat(params_ref, theta.shape[0], axis=0)
+    params_eval = np.concatenate((theta, theta_alt, params_ref), axis=1)
+    log_probs = joint_log_probs(population, params_eval, **kwargs)
+
+    log_r_xz = log_r_from_log_probs(log_probs, 0, n_thetas_marginal)
+    log_r_xz_alt = log_r_from_log_probs(log_probs, 1, n_thetas_marginal)
+    t_xz = joint_scores(population, theta, **kwargs)
+    t_xz_alt = joint_scores(population, theta_alt, **kwargs)
+
+    return log_r_xz, log_r_xz_alt, t_xz, t_xz_alt
+
+
+class ThetaAltSampler:
+    """
+    Draws new alternate hypotheses theta_alt from the prior for images with stored population statistics and re-mines
+    the corresponding augmented data. Used to pair every simulated image with fresh theta_alt values during training.
+    """
+
+    def __init__(self, n_thetas_marginal=1000, **kwargs):
+        """
+        :param n_thetas_marginal: Number of parameter points in the reference marginal model. The reference set is drawn
+            from the prior once and kept fixed.
+        :param kwargs: Simulator settings passed to joint_log_probs()
+        """
+        f_sub_ref, beta_ref = draw_params_from_prior(n_thetas_marginal - 1)
+        self.params_ref = np.vstack((f_sub_ref, beta_ref)).T
+        self.kwargs = kwargs
+
+    def __call__(self, theta, population):
+        """
+        :param theta: Numerator hypotheses with shape (n_images, 2)
+        :param population: Population statistics with shape (n_images, 4)
+        :return: Tuple (theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt)
+        """
+        f_sub_alt, beta_alt = draw_params_from_prior(len(theta))
+        theta_alt = np.vstack((f_sub_alt, beta_alt)).T
+        log_r_xz, log_r_xz_alt, t_xz, t_xz_alt = mine_gold(population, theta, theta_alt, self.params_ref, **self.kwargs)
+        return theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt
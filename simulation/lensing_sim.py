@@ -1,6 +1,6 @@
-from astropy.cosmology import Planck15
 from simulation.units import *
 from simulation.profiles import MassProfileSIE, MassProfileNFW, LightProfileSersic
+from simulation.timing import timer
 
 # import autograd.numpy as np
 import numpy as np
@@ -27,8 +27,18 @@ class LensingSim:
         self.z_s = self.global_dict["z_s"]
         self.z_l = self.global_dict["z_l"]
 
-        self.D_s = Planck15.angular_diameter_distance(z=self.z_s).value * Mpc
-        self.D_l = Planck15.angular_diameter_distance(z=self.z_l).value * Mpc
+        # Distances can be passed in to avoid recomputing them for every image of the same host
+        if "D_s" not in self.global_dict or "D_l" not in self.global_dict:
+            from astropy.cosmology import Planck15  # Slow import, only needed here
+
+        if "D_s" in self.global_dict:
+            self.D_s = self.global_dict["D_s"]
+        else:
+            self.D_s = Planck15.angular_diameter_distance(z=self.z_s).value * Mpc
+        if "D_l" in self.global_dict:
+            self.D_l = self.global_dict["D_l"]
+        else:
+            self.D_l = Planck15.angular_diameter_distance(z=self.z_l).value * Mpc
 
         self.Sigma_crit = 1.0 / (4 * np.pi * GN) * self.D_s / ((self.D_s - self.D_l) * self.D_l)
 
@@ -57,12 +67,39 @@ class LensingSim:
 
         self.pix_area = ((self.theta_x_lims[1] - self.theta_x_lims[0]) / self.n_x) * ((self.theta_y_lims[1] - self.theta_y_lims[0]) / self.n_y)
 
+    def deflection(self, lens_dict):
+        """ Get deflection map of a single lens. If the lens dict contains precomputed deflection maps `x_d` and
+        `y_d`, these are returned instead.
+        """
+
+        if "x_d" in lens_dict and "y_d" in lens_dict:
+            return lens_dict["x_d"], lens_dict["y_d"]
+
+        if lens_dict["profile"] == "SIE":
+            return MassProfileSIE(
+                x_0=lens_dict["theta_x_0"] * self.D_l * asctorad,
+                y_0=lens_dict["theta_y_0"] * self.D_l * asctorad,
+                r_E=lens_dict["theta_E"] * self.D_l * asctorad,
+                q=lens_dict["q"],
+            ).deflection(self.x, self.y)
+        elif lens_dict["profile"] == "NFW":
+            return MassProfileNFW(
+                x_0=lens_dict["theta_x_0"] * self.D_l * asctorad,
+                y_0=lens_dict["theta_y_0"] * self.D_l * asctorad,
+                M_200=lens_dict["M_200"],
+                kappa_s=lens_dict["rho_s"] * lens_dict["r_s"] / self.Sigma_crit,
+                r_s=lens_dict["r_s"],
+            ).deflection(self.x, self.y)
+        else:
+            raise Exception("Unknown lens profile specification!")
+
     def lensed_image(self, return_deflection_maps=False):
         """ Get strongly lensed image
         """
 
         # Get lensing potential gradients
 
+        timer(start="lensing: deflection")
         x_d, y_d = np.zeros((self.n_x, self.n_y)), np.zeros((self.n_x, self.n_y))
 
         if return_deflection_maps:
@@ -70,23 +107,7 @@ class LensingSim:
             x_d_sub, y_d_sub = np.zeros((self.n_x, self.n_y)), np.zeros((self.n_x, self.n_y))
 
         for lens_dict in self.lenses_list:
-            if lens_dict["profile"] == "SIE":
-                _x_d, _y_d = MassProfileSIE(
-                    x_0=lens_dict["theta_x_0"] * self.D_l * asctorad,
-                    y_0=lens_dict["theta_y_0"] * self.D_l * asctorad,
-                    r_E=lens_dict["theta_E"] * self.D_l * asctorad,
-                    q=lens_dict["q"],
-                ).deflection(self.x, self.y)
-            elif lens_dict["profile"] == "NFW":
-                _x_d, _y_d = MassProfileNFW(
-                    x_0=lens_dict["theta_x_0"] * self.D_l * asctorad,
-                    y_0=lens_dict["theta_y_0"] * self.D_l * asctorad,
-                    M_200=lens_dict["M_200"],
-                    kappa_s=lens_dict["rho_s"] * lens_dict["r_s"] / self.Sigma_crit,
-                    r_s=lens_dict["r_s"],
-                ).deflection(self.x, self.y)
-            else:
-                raise Exception("Unknown lens profile specification!")
+            _x_d, _y_d = self.deflection(lens_dict)
 
             x_d += _x_d
             y_d += _y_d
@@ -97,11 +118,14 @@ class LensingSim:
                 x_d_sub += _x_d
                 y_d_sub += _y_d
 
+        timer(stop="lensing: deflection")
+
         if return_deflection_maps:
             return (x_d, y_d), (x_d_host, y_d_host), (x_d_sub, y_d_sub), (self.x.flatten()**2 + self.y.flatten()**2)**2
 
         # Evaluate source image on deflected lens plane to get lensed image
 
+        timer(start="lensing: source evaluation")
         f_lens = np.zeros((self.n_x, self.n_y))
 
 
@@ -126,5 +150,6 @@ class LensingSim:
 
         f_iso = self.f_iso * np.ones((self.n_x, self.n_y))  # Isotropic background
         i_tot = (f_lens + f_iso) * self.exposure * self.pix_area  # Total lensed image
+        timer(stop="lensing: source evaluation")
 
         return i_tot
@@ -1,18 +1,69 @@
 import math
 import logging
+import functools
 from simulation.units import *
 from simulation.profiles import MassProfileNFW, MassProfileSIE
 from simulation.lensing_sim import LensingSim
-from astropy.cosmology import Planck15
-from astropy.convolution import convolve, Gaussian2DKernel
-from autograd import make_jvp
+from simulation.sampling import draw_truncated_lognormal10
+from simulation.timing import timer
+
+# astropy, autograd, and scipy.stats are slow to import and are imported where they are needed, so that scripts that
+# do not simulate (or only parts of the simulation) start quickly
 
 # from tqdm import *
 
 logger = logging.getLogger(__name__)
 
+# Stages of LensingObservationWithSubhalos that can be skipped: the observed image (with Poisson noise and PSF), the
+# noiseless lensed image, and latent variables like the ring statistics
+SIMULATION_OUTPUTS = ["image", "image_noiseless", "latents"]
+
+# Independent random number streams for the stages of a seeded simulation, see seed_random_state()
+RANDOM_STREAM_HOST = 0
+RANDOM_STREAM_N_SUB = 1
+RANDOM_STREAM_M_SUB = 2
+RANDOM_STREAM_POSITIONS = 3
+RANDOM_STREAM_NOISE = 4
+
+
+def seed_random_state(seed, stream, attempt=0):
+    """
+    Seeds numpy's global random state with an independent stream derived from `seed` and `stream`. Seeding every stage of
+    a simulation separately makes it reproducible and lets simulations with the same seed share common random numbers:
+    simulations at different parameter points then draw the same host, and the same quantiles for subhalo numbers,
+    masses, and positions. Does nothing if `seed` is None.
+
+    :param seed: None, int, or sequence of ints
+    :param stream: Index of the random number stream, one of the RANDOM_STREAM_* constants
+    :param attempt: Index of the attempt for stages that are repeated after a rejection
+    """
+    if seed is None:
+        return
+    key = list(np.atleast_1d(seed).astype(np.int64).flatten()) + [stream, attempt]
+    np.random.seed(np.asarray(key, dtype=np.int64) % 2 ** 32)
+
+
+def preserves_random_state(function):
+    """ Decorator for functions that take a keyword argument `seed` and call `seed_random_state()`: if a seed is
+    given, numpy's global random state is restored after the call. Otherwise the state after a seeded simulation would
+    be the one of its last stage, and random numbers drawn by the caller afterwards would depend on which simulations
+    ran in this process (e.g. on the number of simulator processes). """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if kwargs.get("seed") is None:
+            return function(*args, **kwargs)
+        state = np.random.get_state()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            np.random.set_state(state)
+
+    return wrapper
+
 
 class LensingObservationWithSubhalos:
+    @preserves_random_state
     def __init__(
         self,
         mag_zero=25.5,
@@ -36,6 +87,10 @@ class LensingObservationWithSubhalos:
         draw_host_redshift=True,
         draw_alignment=True,
         roi_size=2.,
+        seed=None,
+        host=None,
+        outputs=None,
+        n_noise_realizations=1,
     ):
         """
         Class to simulation an observation strong lensing image, with substructure sprinkled in.
@@ -43,7 +98,7 @@ class LensingObservationWithSubhalos:
         :param mag_zero: Zero-point magnitude of observation
         :param mag_iso: Magnitude of isotropic sky brightness
         :param exposure: Exposure time of observation, in seconds (including gain)
-        :param fwhm_psf: FWHM of Gaussian PSF, in arcsecs
+        :param fwhm_psf: FWHM of Gaussian PSF, in arcsecs. If None, the PSF convolution is skipped.
         :param pixel_size: Pixel side size, in arcsecs
         :param n_xy: Number of pixels (along x and y) of observation
 
@@ -61,7 +116,30 @@ class LensingObservationWithSubhalos:
         :param calculate_joint_score: Whether grad_params log p(x,z|params) will be calculated
         :param calculate_msub_derivatives: Whether to calculate derivatives of image wrt subhalos masses
         :param calculate_residuals: Whether to calculate residual images wrt subhalos
-        """
+
+        :param seed: If not None, every stage of the simulation draws from its own random number stream derived from
+            this seed (see `seed_random_state()`), and the global numpy random state is restored afterwards. Otherwise
+            the global numpy random state is used. Has to be given as keyword argument.
+        :param host: Host dictionary (the `host` attribute) of a previous simulation. If given, the host and source
+            properties, distances, and host deflection map are reused instead of drawn and calculated again. The
+            previous simulation has to have the same settings apart from f_sub, beta, and the parameters for the
+            augmented data.
+        :param outputs: Stages of the simulation whose results are needed, any of SIMULATION_OUTPUTS. Stages that are
+            not requested are skipped and the corresponding attributes are None. The subhalo population and the
+            augmented data (controlled by `params_eval` and `calculate_joint_score`) are always calculated. If None,
+            all outputs are calculated.
+        :param n_noise_realizations: Number of independent realizations of the Poisson noise and PSF convolution of the
+            noiseless image. They are stored in `image_poiss_psf_realizations` with shape (n_noise_realizations, n_xy,
+            n_xy), the first realization is also stored in `image_poiss` and `image_poiss_psf`. With a seed, the k-th
+            realization uses the noise stream with attempt k, so the first one is the same for any number of
+            realizations.
+        """
+
+        if outputs is None:
+            outputs = SIMULATION_OUTPUTS
+        for output in outputs:
+            if output not in SIMULATION_OUTPUTS:
+                raise ValueError("Unknown simulation output {}, has to be one of {}".format(output, SIMULATION_OUTPUTS))
 
         # beta = -2.0 is forbidden!
         if np.abs((beta + 2.)) < 1.e-3:
@@ -89,123 +167,125 @@ class LensingObservationWithSubhalos:
 
         self.coordinate_limit = pixel_size * n_xy / 2.0
 
-        # Draw lens properties consistent with Collett et al [1507.02657]
-
-        # Clip lens redshift `z_l` to be less than 1; high-redshift lenses no good for our purposes!
-
-        if self.draw_host_redshift:
-            self.z_l = 2.0
-            while self.z_l > 1.0:
-                self.z_l = 10 ** np.random.normal(-0.25, 0.25)
-        else:
-            self.z_l = 10.0 ** -0.25
-
-        if self.draw_host_mass:
-            self.sigma_v = np.random.normal(225, 50)
-        else:
-            self.sigma_v = 225.0
-
-        if self.draw_alignment:
-            self.theta_x_0 = np.random.normal(0, 0.2)
-            self.theta_y_0 = np.random.normal(0, 0.2)
-        else:
-            self.theta_x_0 = 0.0
-            self.theta_y_0 = 0.0
-
-        q = 1  # For now, hard-code host to be spherical
-
         # Fix the source properties to reasonable mean-ish values
         self.theta_s_e = 0.2
         self.z_s = 1.5
         self.mag_s = 23.0
 
-        # Get relevant distances
-        self.D_l = Planck15.angular_diameter_distance(z=self.z_l).value * Mpc
-        D_s = Planck15.angular_diameter_distance(z=self.z_s).value * Mpc
-        D_ls = Planck15.angular_diameter_distance_z1z2(z1=self.z_l, z2=self.z_s).value * Mpc
-
-        # Get properties for NFW host DM halo
-        if draw_host_mass:
-            self.M_200_hst = self.M_200_sigma_v(self.sigma_v * Kmps, scatter=M_200_sigma_v_scatter)
-        else:
-            self.M_200_hst = self.M_200_sigma_v(self.sigma_v * Kmps, scatter=0.0)
-
-        c_200_hst = MassProfileNFW.c_200_SCP(self.M_200_hst)
-        r_s_hst, rho_s_hst = MassProfileNFW.get_r_s_rho_s_NFW(self.M_200_hst, c_200_hst)
-
-        # Get properties for SIE host
-        self.theta_E = MassProfileSIE.theta_E(self.sigma_v * Kmps, D_ls, D_s)
-
-        # Don't consider configuration with subhalo fraction > 1!
-        self.f_sub_realiz = 2.0
-        while self.f_sub_realiz > 1.0:
-
-            # Generate a subhalo population...
-            ps = SubhaloPopulation(
-                f_sub=f_sub,
-                beta=beta,
-                M_hst=self.M_200_hst,
-                c_hst=c_200_hst,
-                m_min=m_200_min_sub,
-                m_max=m_200_max_sub_div_M_hst * self.M_200_hst,
-                m_min_calib=m_min_calib,
-                m_max_calib=m_max_sub_div_M_hst_calib * self.M_200_hst,
-                theta_s=r_s_hst / self.D_l,
-                theta_roi=roi_size * self.theta_E,
-                theta_E=self.theta_E,
-                params_eval=params_eval,
-                calculate_joint_score=calculate_joint_score,
-            )
-
-            # ... and grab its properties
-            self.m_subs = ps.m_sample
-            self.n_sub_roi = ps.n_sub_roi
-            self.theta_xs = ps.theta_x_sample
-            self.theta_ys = ps.theta_y_sample
-            self.f_sub_realiz = ps.f_sub_realiz
-            self.n_sub_in_ring = ps.n_sub_in_ring
-            self.f_sub_in_ring = ps.f_sub_in_ring
-            self.n_sub_near_ring = ps.n_sub_near_ring
-            self.f_sub_near_ring = ps.f_sub_near_ring
+        # Draw host properties, or reuse them
+        if host is None:
+            host = self._draw_host(seed)
+        self.host = host
+
+        self.z_l = host["z_l"]
+        self.sigma_v = host["sigma_v"]
+        self.theta_x_0 = host["theta_x_0"]
+        self.theta_y_0 = host["theta_y_0"]
+        self.D_l = host["D_l"]
+        self.M_200_hst = host["M_200_hst"]
+        self.theta_E = host["theta_E"]
+        q = host["q"]
+
+        # Generate a subhalo population, not considering configurations with subhalo fraction > 1...
+        ps = SubhaloPopulation(
+            f_sub=f_sub,
+            beta=beta,
+            M_hst=self.M_200_hst,
+            c_hst=host["c_200_hst"],
+            m_min=m_200_min_sub,
+            m_max=m_200_max_sub_div_M_hst * self.M_200_hst,
+            m_min_calib=m_min_calib,
+            m_max_calib=m_max_sub_div_M_hst_calib * self.M_200_hst,
+            theta_s=host["r_s_hst"] / self.D_l,
+            theta_roi=roi_size * self.theta_E,
+            theta_E=self.theta_E,
+            params_eval=params_eval,
+            calculate_joint_score=calculate_joint_score,
+            f_sub_realiz_max=1.0,
+            seed=seed,
+            calculate_ring_statistics="latents" in outputs,
+        )
+
+        # ... and grab its properties
+        self.m_subs = ps.m_sample
+        self.n_sub_roi = ps.n_sub_roi
+        self.f_sub_roi = ps.f_sub_roi
+        self.theta_xs = ps.theta_x_sample
+        self.theta_ys = ps.theta_y_sample
+        self.f_sub_realiz = ps.f_sub_realiz
+        self.n_sub_in_ring = ps.n_sub_in_ring
+        self.f_sub_in_ring = ps.f_sub_in_ring
+        self.n_sub_near_ring = ps.n_sub_near_ring
+        self.f_sub_near_ring = ps.f_sub_near_ring
+        self.n_rejected_populations = ps.n_rejected
 
         # Convert magnitude for source and isotropic component to expected counts
         self.S_tot = self._mag_to_flux(self.mag_s, self.mag_zero)
         self.f_iso = self._mag_to_flux(self.mag_iso, self.mag_zero)
 
-        # Set host properties. Host assumed to be at the center of the image.
-        self.hst_param_dict = {"profile": "SIE", "theta_x_0": 0.0, "theta_y_0": 0.0, "theta_E": self.theta_E, "q": q}
-
-        lens_list = [self.hst_param_dict]
-
-        # Set subhalo properties
-
-        for i_sub, (m, theta_x, theta_y) in enumerate(zip(self.m_subs, self.theta_xs, self.theta_ys)):
-            c = MassProfileNFW.c_200_SCP(m)
-            r_s, rho_s = MassProfileNFW.get_r_s_rho_s_NFW(m, c)
-            sub_param_dict = {"profile": "NFW", "theta_x_0": theta_x, "theta_y_0": theta_y, "M_200": m, "r_s": r_s, "rho_s": rho_s}
-            lens_list.append(sub_param_dict)
-
-        # Set source properties
-        src_param_dict = {"profile": "Sersic", "theta_x_0": self.theta_x_0, "theta_y_0": self.theta_y_0, "S_tot": self.S_tot, "theta_e": self.theta_s_e, "n_srsc": 1}
-
-        # Set observation and global properties
-        observation_dict = {
-            "n_x": n_xy,
-            "n_y": n_xy,
-            "theta_x_lims": (-self.coordinate_limit, self.coordinate_limit),
-            "theta_y_lims": (-self.coordinate_limit, self.coordinate_limit),
-            "exposure": exposure,
-            "f_iso": self.f_iso,
-        }
-
-        global_dict = {"z_s": self.z_s, "z_l": self.z_l}
-
-        # Inititalize lensing class and produce lensed image
-        lsi = LensingSim(lens_list, [src_param_dict], global_dict, observation_dict)
-
-        self.image = lsi.lensed_image()
-        self.image_poiss = np.random.poisson(self.image)  # Poisson fluctuate
-        self.image_poiss_psf = self._convolve_psf(self.image_poiss, fwhm_psf, pixel_size)  # Convolve with PSF
+        # The lensing calculation is only needed for the images (and the derivatives, which need the lens setup)
+        self.hst_param_dict = None
+        self.image, self.image_poiss, self.image_poiss_psf = None, None, None
+        self.image_poiss_psf_realizations = None
+
+        if "image" in outputs or "image_noiseless" in outputs or calculate_msub_derivatives or calculate_sub_residuals:
+            # Set host properties. Host assumed to be at the center of the image.
+            timer(start="lensing: setup")
+            self.hst_param_dict = {"profile": "SIE", "theta_x_0": 0.0, "theta_y_0": 0.0, "theta_E": self.theta_E, "q": q}
+
+            lens_list = [self.hst_param_dict]
+
+            # Set subhalo properties
+
+            for i_sub, (m, theta_x, theta_y) in enumerate(zip(self.m_subs, self.theta_xs, self.theta_ys)):
+                c = MassProfileNFW.c_200_SCP(m)
+                r_s, rho_s = MassProfileNFW.get_r_s_rho_s_NFW(m, c)
+                sub_param_dict = {"profile": "NFW", "theta_x_0": theta_x, "theta_y_0": theta_y, "M_200": m, "r_s": r_s, "rho_s": rho_s}
+                lens_list.append(sub_param_dict)
+
+            # Set source properties
+            src_param_dict = {"profile": "Sersic", "theta_x_0": self.theta_x_0, "theta_y_0": self.theta_y_0, "S_tot": self.S_tot, "theta_e": self.theta_s_e, "n_srsc": 1}
+
+            # Set observation and global properties
+            observation_dict = {
+                "n_x": n_xy,
+                "n_y": n_xy,
+                "theta_x_lims": (-self.coordinate_limit, self.coordinate_limit),
+                "theta_y_lims": (-self.coordinate_limit, self.coordinate_limit),
+                "exposure": exposure,
+                "f_iso": self.f_iso,
+            }
+
+            global_dict = {"z_s": self.z_s, "z_l": self.z_l, "D_s": host["D_s"], "D_l": self.D_l}
+
+            # Inititalize lensing class, reuse or calculate host deflection, and produce lensed image
+            lsi = LensingSim(lens_list, [src_param_dict], global_dict, observation_dict)
+
+            timer(stop="lensing: setup")
+            if "x_d" not in host:
+                timer(start="lensing: host deflection")
+                host["x_d"], host["y_d"] = lsi.deflection(self.hst_param_dict)
+                timer(stop="lensing: host deflection")
+            self.hst_param_dict["x_d"], self.hst_param_dict["y_d"] = host["x_d"], host["y_d"]
+
+            self.image = lsi.lensed_image()
+
+        if "image" in outputs:
+            realizations = []
+            for i_noise in range(n_noise_realizations):
+                timer(start="noise: Poisson")
+                seed_random_state(seed, RANDOM_STREAM_NOISE, i_noise)
+                image_poiss = np.random.poisson(self.image)  # Poisson fluctuate
+                timer(stop="noise: Poisson", start="noise: PSF convolution")
+                if fwhm_psf is None:
+                    realizations.append(image_poiss.astype(np.float64))
+                else:
+                    realizations.append(self._convolve_psf(image_poiss, fwhm_psf, pixel_size))  # Convolve with PSF
+                timer(stop="noise: PSF convolution")
+                if i_noise == 0:
+                    self.image_poiss = image_poiss
+            self.image_poiss_psf_realizations = np.array(realizations)
+            self.image_poiss_psf = self.image_poiss_psf_realizations[0]
 
         # Augmented data
         self.joint_log_probs = ps.joint_log_probs
@@ -219,6 +299,62 @@ class LensingObservationWithSubhalos:
         if calculate_sub_residuals:
             self._calculate_residuals()
 
+    def _draw_host(self, seed=None):
+        """
+        Draws host properties and calculates distances and host halo properties
+        """
+
+        timer(start="host: draw")
+        seed_random_state(seed, RANDOM_STREAM_HOST)
+        host = {}
+
+        # Draw lens properties consistent with Collett et al [1507.02657]
+
+        # Truncate lens redshift `z_l` to be less than 1; high-redshift lenses no good for our purposes!
+
+        if self.draw_host_redshift:
+            host["z_l"] = float(draw_truncated_lognormal10(-0.25, 0.25, high=1.0))
+        else:
+            host["z_l"] = 10.0 ** -0.25
+
+        if self.draw_host_mass:
+            host["sigma_v"] = np.random.normal(225, 50)
+        else:
+            host["sigma_v"] = 225.0
+
+        if self.draw_alignment:
+            host["theta_x_0"] = np.random.normal(0, 0.2)
+            host["theta_y_0"] = np.random.normal(0, 0.2)
+        else:
+            host["theta_x_0"] = 0.0
+            host["theta_y_0"] = 0.0
+
+        host["q"] = 1  # For now, hard-code host to be spherical
+
+        # Get relevant distances
+        timer(stop="host: draw", start="host: distances")
+        from astropy.cosmology import Planck15
+
+        host["D_l"] = Planck15.angular_diameter_distance(z=host["z_l"]).value * Mpc
+        host["D_s"] = Planck15.angular_diameter_distance(z=self.z_s).value * Mpc
+        host["D_ls"] = Planck15.angular_diameter_distance_z1z2(z1=host["z_l"], z2=self.z_s).value * Mpc
+
+        # Get properties for NFW host DM halo
+        timer(stop="host: distances", start="host: halo properties")
+        if self.draw_host_mass:
+            host["M_200_hst"] = self.M_200_sigma_v(host["sigma_v"] * Kmps, scatter=self.M_200_sigma_v_scatter)
+        else:
+            host["M_200_hst"] = self.M_200_sigma_v(host["sigma_v"] * Kmps, scatter=0.0)
+
+        host["c_200_hst"] = MassProfileNFW.c_200_SCP(host["M_200_hst"])
+        host["r_s_hst"], host["rho_s_hst"] = MassProfileNFW.get_r_s_rho_s_NFW(host["M_200_hst"], host["c_200_hst"])
+
+        # Get properties for SIE host
+        host["theta_E"] = MassProfileSIE.theta_E(host["sigma_v"] * Kmps, host["D_ls"], host["D_s"])
+        timer(stop="host: halo properties")
+
+        return host
+
     def _calculate_residuals(self):
         """
         Compute residual images wrt each subhalo
@@ -263,6 +399,8 @@ class LensingObservationWithSubhalos:
         # Loop over subhalos, setting the first element of subhalo properties arrays to a given subhalo,
         # then compute Jacobian (hacky, but seems to be fastest way currently with forward-pass Jacobian
         # vector product implementation in autograd...
+        from autograd import make_jvp
+
         for i_sub in range(self.n_sub_roi):
             self.theta_xs[[0, i_sub]] = self.theta_xs[[i_sub, 0]]
             self.theta_ys[[0, i_sub]] = self.theta_ys[[i_sub, 0]]
@@ -302,7 +440,7 @@ class LensingObservationWithSubhalos:
             "f_iso": self.f_iso,
         }
 
-        global_dict = {"z_s": self.z_s, "z_l": self.z_l}
+        global_dict = {"z_s": self.z_s, "z_l": self.z_l, "D_s": self.host["D_s"], "D_l": self.D_l}
 
         # Inititalize lensing class and produce lensed image
         lsi = LensingSim(lens_list, [src_param_dict], global_dict, observation_dict)
@@ -313,6 +451,8 @@ class LensingObservationWithSubhalos:
         """
         Convolve input map of pixel_size with Gaussian PSF of with FWHM `fwhm_psf`
         """
+        from astropy.convolution import convolve, Gaussian2DKernel
+
         sigma_psf = fwhm_psf / 2 ** 1.5 * np.sqrt(np.log(2))  # Convert FWHM to standard deviation
         kernel = Gaussian2DKernel(x_stddev=1.0 * sigma_psf / pixel_size)
 
@@ -341,6 +481,7 @@ class LensingObservationWithSubhalos:
 
 
 class SubhaloPopulation:
+    @preserves_random_state
     def __init__(
         self,
         f_sub=0.15,
@@ -356,6 +497,9 @@ class SubhaloPopulation:
         theta_E=1.0,
         params_eval=None,
         calculate_joint_score=False,
+        f_sub_realiz_max=None,
+        seed=None,
+        calculate_ring_statistics=True,
     ):
         """
         Calibrate number of subhalos and generate a mass sample within lensing ROI
@@ -375,6 +519,12 @@ class SubhaloPopulation:
         :param c_hst: Concentration parameter of host halo
         :param params_eval: Parameters (f_sub, beta) for which p(x,z|params) will be calculated
         :param calculate_joint_score: Whether grad_params log p(x,z|params) will be calculated
+        :param f_sub_realiz_max: If not None, subhalo samples with a realized substructure fraction above this value
+            are rejected and redrawn (before any augmented data is calculated). The number of rejected draws is
+            stored in `n_rejected`.
+        :param seed: If not None, the subhalo number, masses, and positions are drawn from independent random number
+            streams derived from this seed, see `seed_random_state()`
+        :param calculate_ring_statistics: Whether to count the subhalos in and near the Einstein ring
         """
 
         # Store settings
@@ -391,6 +541,7 @@ class SubhaloPopulation:
         self.c_hst = c_hst
 
         # Alpha corresponding to calibration configuration
+        timer(start="population: sampling")
         self.alpha = self._alpha_f_sub(f_sub, beta, m_min_calib, m_max_calib)
 
         # Total expected number of subhalos within virial radius of host halo
@@ -398,28 +549,47 @@ class SubhaloPopulation:
 
         # Fraction and number of subhalos within lensing region of interest specified by theta_roi
         self.f_sub_roi = max(MassProfileNFW.M_cyl_div_M0(self.theta_roi * asctorad / theta_s), 0.0)
-        self.n_sub_roi = np.random.poisson(self.f_sub_roi * self.n_sub_tot)
-        logger.debug("%s subhalos (%s expected)", self.n_sub_roi, self.f_sub_roi * self.n_sub_tot)
+        self.M_hst_roi = M_hst * MassProfileNFW.M_cyl_div_M0(self.theta_roi * asctorad / self.theta_s)
 
-        # Sample of subhalo masses drawn from subhalo mass function
-        self.m_sample = self._draw_m_sub(self.n_sub_roi, self.m_min, self.m_max, self.beta)
+        # Number of subhalos and sample of subhalo masses drawn from subhalo mass function, rejecting samples with
+        # too much mass in substructure. Only the count and the masses enter the rejection, so we only redraw those
+        self.n_rejected = 0
+        while True:
+            seed_random_state(seed, RANDOM_STREAM_N_SUB, self.n_rejected)
+            self.n_sub_roi = self._draw_n_sub(self.f_sub_roi * self.n_sub_tot)
+            seed_random_state(seed, RANDOM_STREAM_M_SUB, self.n_rejected)
+            self.m_sample = self._draw_m_sub(self.n_sub_roi, self.m_min, self.m_max, self.beta)
 
-        # Fraction of halo mass in subhalos, for diagnostic purposes
-        self.M_hst_roi = M_hst * MassProfileNFW.M_cyl_div_M0(self.theta_roi * asctorad / self.theta_s)
-        self.f_sub_realiz = np.sum(self.m_sample) / self.M_hst_roi
+            # Fraction of halo mass in subhalos
+            self.f_sub_realiz = np.sum(self.m_sample) / self.M_hst_roi
+
+            if f_sub_realiz_max is None or self.f_sub_realiz <= f_sub_realiz_max:
+                break
+            self.n_rejected += 1
+            logger.debug("Rejecting subhalo sample with substructure fraction %s", self.f_sub_realiz)
+
+        logger.debug("%s subhalos (%s expected)", self.n_sub_roi, self.f_sub_roi * self.n_sub_tot)
         logger.debug("%s substructure fraction (%s expected)", self.f_sub_realiz, self.f_sub)
 
         # Sample subhalo positions uniformly within ROI
+        seed_random_state(seed, RANDOM_STREAM_POSITIONS)
         self.theta_x_sample, self.theta_y_sample = self._draw_sub_coordinates(self.n_sub_roi, r_max=self.theta_roi)
 
         # For debugging: subhalos within Einstein ring and near it
-        self.n_sub_in_ring, self.f_sub_in_ring = self._count_subhalos_in_radius_range(0.0, 0.9 * self.theta_E)
-        self.n_sub_near_ring, self.f_sub_near_ring = self._count_subhalos_in_radius_range(0.9 * self.theta_E, 1.1 * self.theta_E)
+        if calculate_ring_statistics:
+            self.n_sub_in_ring, self.f_sub_in_ring = self._count_subhalos_in_radius_range(0.0, 0.9 * self.theta_E)
+            self.n_sub_near_ring, self.f_sub_near_ring = self._count_subhalos_in_radius_range(0.9 * self.theta_E, 1.1 * self.theta_E)
+        else:
+            self.n_sub_in_ring, self.f_sub_in_ring, self.n_sub_near_ring, self.f_sub_near_ring = None, None, None, None
 
         # Calculate augmented data
+        timer(stop="population: sampling", start="gold: joint likelihoods")
         self.joint_log_probs = self._calculate_joint_log_probs(params_eval)
+        timer(stop="gold: joint likelihoods")
         if calculate_joint_score:
+            timer(start="gold: joint scores")
             self.joint_scores = self._calculate_joint_scores(params_eval[:2, :])
+            timer(stop="gold: joint scores")
         else:
             self.joint_scores = None
 
@@ -457,6 +627,17 @@ class SubhaloPopulation:
         n_sub *= (m_min / m_0) ** (beta + 1.0) - (m_max / m_0) ** (beta + 1.0)
         return max(n_sub, 0.0)
 
+    @staticmethod
+    def _draw_n_sub(n_sub_expected):
+        """
+        Draw number of subhalos from a Poisson distribution by inverting its CDF, so that the number is monotonic in the
+        underlying uniform random number
+        """
+        from scipy.stats import poisson
+
+        u = np.random.uniform(0, 1)
+        return int(max(poisson.ppf(u, n_sub_expected), 0))
+
     @staticmethod
     def _draw_m_sub(n_sub, m_sub_min, m_sub_max, beta):
         """
@@ -470,19 +651,14 @@ class SubhaloPopulation:
     @staticmethod
     def _draw_sub_coordinates(n_sub, r_min=0.0, r_max=2.5):
         """
-        Draw subhalo n_sub coordinates uniformly within a ring r_min < r < r_max
+        Draw subhalo n_sub coordinates uniformly within a ring r_min < r < r_max. The random numbers for radius and
+        angle of each subhalo are drawn as consecutive pairs, so that the first positions are the same for any n_sub.
         """
-        x_sub = []
-        y_sub = []
-        while len(x_sub) < n_sub:
-            x_candidates = np.random.uniform(low=-r_max, high=r_max, size=n_sub - len(x_sub))
-            y_candidates = np.random.uniform(low=-r_max, high=r_max, size=n_sub - len(x_sub))
-            r2 = x_candidates ** 2 + y_candidates ** 2
-            good = (r2 <= r_max ** 2) * (r2 >= r_min ** 2)
-            x_sub += list(x_candidates[good])
-            y_sub += list(y_candidates[good])
+        u = np.random.uniform(0, 1, size=(n_sub, 2))
+        r = np.sqrt(r_min ** 2 + (r_max ** 2 - r_min ** 2) * u[:, 0])
+        phi = 2.0 * np.pi * u[:, 1]
 
-        return np.array(x_sub), np.array(y_sub)
+        return r * np.cos(phi), r * np.sin(phi)
 
     def _count_subhalos_in_radius_range(self, min_r, max_r):
         r = ((self.theta_x_sample ** 2 + self.theta_y_sample ** 2) ** 0.5).flatten()
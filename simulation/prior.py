@@ -1,13 +1,31 @@
 import numpy as np
-from scipy.stats import uniform, norm
+
+
+def get_prior():
+    """ Returns the priors on f_sub and beta as scipy.stats distributions """
+    from scipy.stats import uniform  # Slow import
+
+    return uniform(0.001, 0.199), uniform(-2.5, 1.0)
 
 
 def draw_params_from_prior(n):
-    f_sub = uniform(0.001, 0.199).rvs(size=n)
-    beta = uniform(-2.5, 1.0).rvs(size=n)
+    f_sub_prior, beta_prior = get_prior()
+    f_sub = f_sub_prior.rvs(size=n)
+    beta = beta_prior.rvs(size=n)
     return f_sub, beta
 
 
+def log_prior(theta, f_sub_prior=None, beta_prior=None):
+    """ Evaluates the log prior density for parameter points theta with shape (n, 2), by default for the standard prior """
+    if f_sub_prior is None or beta_prior is None:
+        f_sub_prior_default, beta_prior_default = get_prior()
+        f_sub_prior = f_sub_prior_default if f_sub_prior is None else f_sub_prior
+        beta_prior = beta_prior_default if beta_prior is None else beta_prior
+
+    theta = np.asarray(theta).reshape((-1, 2))
+    return f_sub_prior.logpdf(theta[:, 0]) + beta_prior.logpdf(theta[:, 1])
+
+
 def get_reference_point():
     return 0.05, -1.9
 
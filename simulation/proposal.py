@@ -0,0 +1,117 @@
+import logging
+import numpy as np
+from scipy.special import logsumexp
+
+from simulation.prior import get_prior, log_prior
+
+logger = logging.getLogger(__name__)
+
+
+class GridProposal:
+    """
+    Proposal distribution for the parameters (f_sub, beta) that concentrates simulations in interesting regions of
+    parameter space. It is a mixture of the prior, with weight `prior_fraction`, and a piecewise constant density on a
+    regular grid of cells that covers the support of the prior, in which every cell is drawn with a probability
+    proportional to a non-negative value like the disagreement of an ensemble of estimators. Mixing in the prior keeps
+    the importance weights prior / proposal bounded by 1 / prior_fraction.
+    """
+
+    def __init__(self, values=None, resolution=25, prior_fraction=0.5, f_sub_prior=None, beta_prior=None):
+        """
+        :param values: Non-negative values for every cell with shape (resolution ** 2,), in the order of
+            `cell_centers()`. If None, the proposal is the prior.
+        :param resolution: Number of cells along f_sub and along beta
+        :param prior_fraction: Weight of the prior in the mixture
+        :param f_sub_prior: Prior for f_sub as scipy.stats distribution with finite support, defaults to the standard
+            prior
+        :param beta_prior: Prior for beta as scipy.stats distribution with finite support, defaults to the standard
+            prior
+        """
+
+        f_sub_prior_default, beta_prior_default = get_prior()
+        self.f_sub_prior = f_sub_prior_default if f_sub_prior is None else f_sub_prior
+        self.beta_prior = beta_prior_default if beta_prior is None else beta_prior
+        self.resolution = resolution
+
+        self.f_sub_edges = np.linspace(*self.f_sub_prior.support(), resolution + 1)
+        self.beta_edges = np.linspace(*self.beta_prior.support(), resolution + 1)
+        self.cell_volume = (self.f_sub_edges[1] - self.f_sub_edges[0]) * (self.beta_edges[1] - self.beta_edges[0])
+
+        if values is None or not np.sum(values) > 0.0:
+            self.prior_fraction = 1.0
+            self.probabilities = np.ones(resolution ** 2) / resolution ** 2
+        else:
+            values = np.clip(np.asarray(values, dtype=np.float64).flatten(), 0.0, None)
+            if values.shape != (resolution ** 2,):
+                raise ValueError("Expected {} values, got shape {}".format(resolution ** 2, values.shape))
+            self.prior_fraction = prior_fraction
+            self.probabilities = values / np.sum(values)
+
+    def cell_centers(self):
+        """ Centers of the cells with shape (resolution ** 2, 2), with f_sub running fastest like in get_grid() """
+
+        f_sub_1d = 0.5 * (self.f_sub_edges[1:] + self.f_sub_edges[:-1])
+        beta_1d = 0.5 * (self.beta_edges[1:] + self.beta_edges[:-1])
+        theta0, theta1 = np.meshgrid(f_sub_1d, beta_1d)
+        return np.vstack((theta0.flatten(), theta1.flatten())).T
+
+    def rvs(self, n):
+        """ Draws n parameter points with shape (n, 2) """
+
+        from_prior = np.random.uniform(size=n) < self.prior_fraction
+        n_prior = np.sum(from_prior)
+
+        theta = np.empty((n, 2))
+        theta[from_prior, 0] = self.f_sub_prior.rvs(size=n_prior)
+        theta[from_prior, 1] = self.beta_prior.rvs(size=n_prior)
+
+        cells = np.random.choice(self.resolution ** 2, size=n - n_prior, p=self.probabilities)
+        i_f_sub, i_beta = cells % self.resolution, cells // self.resolution
+        theta[~from_prior, 0] = np.random.uniform(self.f_sub_edges[i_f_sub], self.f_sub_edges[i_f_sub + 1])
+        theta[~from_prior, 1] = np.random.uniform(self.beta_edges[i_beta], self.beta_edges[i_beta + 1])
+
+        return theta
+
+    def logpdf(self, theta):
+        """ Evaluates the log density of the proposal for parameter points theta with shape (n, 2) """
+
+        theta = np.asarray(theta).reshape((-1, 2))
+        i_f_sub = np.searchsorted(self.f_sub_edges, theta[:, 0], side="right") - 1
+        i_beta = np.searchsorted(self.beta_edges, theta[:, 1], side="right") - 1
+        inside = (i_f_sub >= 0) & (i_f_sub < self.resolution) & (i_beta >= 0) & (i_beta < self.resolution)
+
+        cells = np.clip(i_beta, 0, self.resolution - 1) * self.resolution + np.clip(i_f_sub, 0, self.resolution - 1)
+        density_grid = np.where(inside, self.probabilities[cells] / self.cell_volume, 0.0)
+        density_prior = np.exp(log_prior(theta, self.f_sub_prior, self.beta_prior))
+
+        with np.errstate(divide="ignore"):
+            return np.log(self.prior_fraction * density_prior + (1.0 - self.prior_fraction) * density_grid)
+
+
+def proposal_weights(theta, proposals, n_samples, theta_alt=None, f_sub_prior=None, beta_prior=None):
+    """
+    Calculates importance weights that reweight samples drawn from a sequence of proposals to the prior. All samples
+    are weighted with respect to the mixture of all proposals (the "balance heuristic"), which keeps the weights bounded
+    when later proposals concentrate on small regions. If theta_alt is given, the weights account for both hypotheses
+    of each training pair, which have to be drawn from the same proposal.
+
+    :param theta: Parameter points of all samples with shape (n, 2)
+    :param proposals: List of proposals with a logpdf() function, like GridProposal
+    :param n_samples: List with the number of samples drawn from each proposal
+    :param theta_alt: Alternate parameter points with shape (n, 2), or None
+    :return: Weights with shape (n,), normalized to mean 1
+    """
+
+    log_fractions = np.log(np.asarray(n_samples, dtype=np.float64) / np.sum(n_samples))
+
+    def log_mixture(theta_):
+        return logsumexp([log_f + proposal.logpdf(theta_) for log_f, proposal in zip(log_fractions, proposals)], axis=0)
+
+    log_w = log_prior(theta, f_sub_prior, beta_prior) - log_mixture(theta)
+    if theta_alt is not None:
+        log_w += log_prior(theta_alt, f_sub_prior, beta_prior) - log_mixture(theta_alt)
+
+    log_w = np.where(np.isnan(log_w), -np.inf, log_w)
+    weights = np.exp(log_w - np.max(log_w))
+    weights /= np.mean(weights)
+    return weights
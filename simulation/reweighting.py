@@ -0,0 +1,50 @@
+import logging
+import numpy as np
+
+from simulation.prior import log_prior
+
+logger = logging.getLogger(__name__)
+
+
+def prior_weights(
+    theta,
+    f_sub_prior_new,
+    beta_prior_new,
+    f_sub_prior_old=None,
+    beta_prior_old=None,
+    theta_alt=None,
+):
+    """
+    Calculates importance weights that reweight an existing sample bank, simulated with parameters drawn from the old
+    prior, to a new prior. Since the images only depend on the parameters through p(x | theta), the weight of each sample
+    is the ratio of the prior densities. If theta_alt is given, the weights account for both hypotheses of each
+    training pair.
+
+    :param theta: Parameter points of the sample bank with shape (n, 2)
+    :param f_sub_prior_new: New prior for f_sub as scipy.stats distribution
+    :param beta_prior_new: New prior for beta as scipy.stats distribution
+    :param f_sub_prior_old: Prior for f_sub that the sample bank was generated with, defaults to the standard prior
+    :param beta_prior_old: Prior for beta that the sample bank was generated with, defaults to the standard prior
+    :param theta_alt: Alternate parameter points of the sample bank with shape (n, 2), or None
+    :return: Weights with shape (n,), normalized to mean 1
+    """
+
+    log_w = log_prior(theta, f_sub_prior_new, beta_prior_new) - log_prior(theta, f_sub_prior_old, beta_prior_old)
+    if theta_alt is not None:
+        log_w += log_prior(theta_alt, f_sub_prior_new, beta_prior_new)
+        log_w -= log_prior(theta_alt, f_sub_prior_old, beta_prior_old)
+
+    log_w = np.where(np.isnan(log_w), -np.inf, log_w)
+    if not np.any(np.isfinite(log_w)):
+        raise RuntimeError("None of the samples is supported by the new prior")
+
+    weights = np.exp(log_w - np.max(log_w))
+    weights /= np.mean(weights)
+    return weights
+
+
+def effective_sample_size(weights):
+    """ Kish's effective sample size (sum w)^2 / sum w^2 """
+
+    weights = np.asarray(weights, dtype=np.float64).flatten()
+    return np.sum(weights) ** 2 / np.sum(weights ** 2)
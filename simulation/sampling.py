@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def draw_truncated_normal(mean, std, low=-np.inf, high=np.inf, size=None):
+    """
+    Draw from a normal distribution truncated to the interval [low, high] by inverting the CDF, so every uniform
+    random number yields an accepted sample. All arguments can be arrays that broadcast against `size`, which allows
+    drawing a whole batch of truncated samples with different parameters at once.
+
+    :param mean: Mean of the untruncated normal distribution
+    :param std: Standard deviation of the untruncated normal distribution
+    :param low: Lower truncation boundary
+    :param high: Upper truncation boundary
+    :param size: Output shape, as in np.random
+    :return: Samples from the truncated normal distribution
+    """
+    from scipy.stats import norm  # Slow import
+
+    mean, std = np.asarray(mean, dtype=np.float64), np.asarray(std, dtype=np.float64)
+    a = (np.asarray(low, dtype=np.float64) - mean) / std
+    b = (np.asarray(high, dtype=np.float64) - mean) / std
+
+    # Sample in the tail with the smaller CDF values to avoid loss of precision when the interval is far in the
+    # upper tail: for a > 0 we use the symmetry of the normal distribution and work with -x
+    flip = a > 0.0
+    a, b = np.where(flip, -b, a), np.where(flip, -a, b)
+
+    u = np.random.uniform(norm.cdf(a), norm.cdf(b), size=size)
+    x = np.clip(norm.ppf(u), a, b)
+    x = np.where(flip, -x, x)
+
+    return mean + std * x
+
+
+def draw_truncated_lognormal10(mean_log10, std_log10, low=0.0, high=np.inf, size=None):
+    """
+    Draw from a distribution that is normal in log10(x), truncated to low <= x <= high
+
+    :param mean_log10: Mean of log10(x)
+    :param std_log10: Standard deviation of log10(x)
+    :param low: Lower truncation boundary in x (not log10(x))
+    :param high: Upper truncation boundary in x (not log10(x))
+    :param size: Output shape, as in np.random
+    :return: Samples x
+    """
+    with np.errstate(divide="ignore"):
+        low_log10 = np.log10(low)
+        high_log10 = np.log10(high)
+    return 10.0 ** draw_truncated_normal(mean_log10, std_log10, low_log10, high_log10, size=size)
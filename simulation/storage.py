@@ -0,0 +1,543 @@
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Keys that samples can have, see simulate.py and simulation.wrapper.augmented_data()
+SAMPLE_KEYS = [
+    "theta",
+    "theta_alt",
+    "x",
+    "x_noiseless",
+    "seed",
+    "t_xz",
+    "t_xz_alt",
+    "log_r_xz",
+    "log_r_xz_alt",
+    "sub_latents",
+    "z",
+    "pop",
+    "dx_dm",
+    "group",
+    "i_grid",
+]
+
+
+class ChunkedWriter:
+    """
+    Streams chunks of simulation results to preallocated .npy files on disk, so that memory use does not grow with the
+    number of samples. Every key is written to {folder}/{key}_{name}.npy, as with np.save. After every chunk the
+    arrays are flushed and the manifest {folder}/manifest_{name}.json is updated with the finished chunks and their
+    checksums, so the output of a job that crashes halfway is still valid for these chunks (see `load_sample()`), and
+    the job can be resumed.
+    """
+
+    def __init__(self, folder, name, n_samples, metadata=None, resume=False):
+        """
+        :param folder: Folder in which the files are created
+        :param name: Sample name, like "train"
+        :param n_samples: Total number of samples. The .npy files are preallocated with this length.
+        :param metadata: Dict with additional information that is stored in the manifest, like the random seed
+        :param resume: If True and there is a manifest for this sample, the existing files are opened and the chunks
+            listed in the manifest are validated against their checksums. Valid chunks are kept, see
+            `completed_chunks`.
+        """
+
+        self.folder = folder
+        self.name = name
+        self.n_samples = n_samples
+        self.metadata = {} if metadata is None else metadata
+        self.keys = []
+        self.arrays = {}
+        self.chunks = {}
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if resume:
+            self._resume()
+
+    @property
+    def n_done(self):
+        return sum(chunk["n"] for chunk in self.chunks.values())
+
+    @property
+    def completed_chunks(self):
+        """ Set of the first sample indices of all chunks that are finished """
+        return set(self.chunks.keys())
+
+    def write(self, i_start, chunk):
+        """
+        Writes a chunk of results.
+
+        :param i_start: Index of the first sample in the chunk
+        :param chunk: Dict with the arrays to be saved, the first dimension running over the samples of this chunk.
+            Entries that are None are skipped.
+        """
+
+        n_chunk = None
+        checksums = {}
+        for key, value in chunk.items():
+            if value is None:
+                continue
+            value = np.asarray(value)
+            if n_chunk is None:
+                n_chunk = value.shape[0]
+            elif n_chunk != value.shape[0]:
+                raise RuntimeError("Inconsistent chunk lengths for key {}".format(key))
+
+            if key not in self.arrays:
+                self.arrays[key] = np.lib.format.open_memmap(
+                    self._filename(key), mode="w+", dtype=value.dtype, shape=(self.n_samples,) + value.shape[1:]
+                )
+                self.keys.append(key)
+            self.arrays[key][i_start : i_start + n_chunk] = value
+            checksums[key] = _checksum(self.arrays[key][i_start : i_start + n_chunk])
+
+        if n_chunk is None:
+            return
+
+        for array in self.arrays.values():
+            array.flush()
+
+        self.chunks[i_start] = {"i_start": i_start, "n": n_chunk, "checksums": checksums}
+        self._write_manifest()
+
+    def close(self):
+        """ Flushes and closes all files """
+
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+        self._write_manifest()
+
+    def _resume(self):
+        manifest = read_manifest(self.folder, self.name)
+        if not manifest:
+            logger.info("No manifest for sample %s found, starting from scratch", self.name)
+            return
+        if manifest["n_samples"] != self.n_samples:
+            raise RuntimeError(
+                "Cannot resume sample {} with {} samples, the manifest lists {}".format(
+                    self.name, self.n_samples, manifest["n_samples"]
+                )
+            )
+
+        try:
+            for key in manifest["keys"]:
+                self.arrays[key] = np.lib.format.open_memmap(self._filename(key), mode="r+")
+                self.keys.append(key)
+        except (IOError, ValueError):
+            logger.warning("Could not open all files of sample %s, starting from scratch", self.name)
+            self.arrays, self.keys = {}, []
+            return
+
+        for chunk in manifest["chunks"]:
+            i_start, n_chunk = chunk["i_start"], chunk["n"]
+            valid = all(
+                key in self.arrays and _checksum(self.arrays[key][i_start : i_start + n_chunk]) == checksum
+                for key, checksum in chunk["checksums"].items()
+            )
+            if valid:
+                self.chunks[i_start] = chunk
+            else:
+                logger.warning("Chunk starting at sample %s of sample %s is corrupted, will redo it", i_start, self.name)
+
+        logger.info(
+            "Resuming sample %s: %s of %s samples in %s valid chunks",
+            self.name,
+            self.n_done,
+            self.n_samples,
+            len(self.chunks),
+        )
+
+    def _filename(self, key):
+        return "{}/{}_{}.npy".format(self.folder, key, self.name)
+
+    def _write_manifest(self):
+        manifest = {
+            "name": self.name,
+            "n_samples": self.n_samples,
+            "n_done": self.n_done,
+            "complete": self.n_done == self.n_samples,
+            "keys": self.keys,
+            "metadata": self.metadata,
+            "chunks": [self.chunks[i_start] for i_start in sorted(self.chunks.keys())],
+        }
+
+        # Write to temporary file first so the manifest is never half-written
+        filename = manifest_filename(self.folder, self.name)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(filename + ".tmp", filename)
+
+
+def _checksum(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def manifest_filename(folder, name):
+    return "{}/manifest_{}.json".format(folder, name)
+
+
+def read_manifest(folder, name):
+    """ Returns the manifest of a sample written by ChunkedWriter as dict, or an empty dict if there is none """
+
+    try:
+        with open(manifest_filename(folder, name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_sample(folder, key, name, mmap_mode=None):
+    """
+    Loads {folder}/{key}_{name}.npy. If the sample was written by ChunkedWriter and is incomplete, only the samples in
+    finished chunks are returned. Samples in the sharded format (see ShardedWriter) are read from their shards.
+
+    :param folder: Folder with the sample files
+    :param key: Key, like "x" or "theta"
+    :param name: Sample name, like "train"
+    :param mmap_mode: Passed to np.load. For samples in the sharded format, any value other than None returns a
+        ShardedArray that only reads the shards when it is indexed.
+    :return: Array
+    """
+
+    if is_sharded(folder, name):
+        data = ShardedArray(folder, name, key)
+        return data if mmap_mode is not None else np.asarray(data)
+
+    data = np.load("{}/{}_{}.npy".format(folder, key, name), mmap_mode=mmap_mode)
+
+    done = completed_samples(folder, name)
+    if done is not None:
+        data = data[done]
+
+    return data
+
+
+def load_sample_row(folder, key, name, i):
+    """ Loads only the i-th sample of {key}_{name}, counting the samples like `load_sample()`, for instance one grid
+    point of a consolidated calibration grid, without reading the others into memory """
+
+    if is_sharded(folder, name):
+        return ShardedArray(folder, name, key)[i]
+
+    data = np.load("{}/{}_{}.npy".format(folder, key, name), mmap_mode="r")
+
+    done = completed_samples(folder, name)
+    if done is not None:
+        i = np.where(done)[0][i]
+
+    return np.array(data[i])
+
+
+def completed_samples(folder, name):
+    """ Returns a boolean mask of the samples in finished chunks if sample {name} was written by ChunkedWriter and is
+    incomplete, otherwise None """
+
+    if is_sharded(folder, name):
+        return None
+
+    manifest = read_manifest(folder, name)
+    if not manifest or manifest["complete"]:
+        return None
+
+    logger.warning(
+        "Sample %s is incomplete, only %s of %s samples are available", name, manifest["n_done"], manifest["n_samples"]
+    )
+    done = np.zeros(manifest["n_samples"], dtype=bool)
+    for chunk in manifest["chunks"]:
+        done[chunk["i_start"] : chunk["i_start"] + chunk["n"]] = True
+    return done
+
+
+class ShardedWriter:
+    """
+    Writes a sample in the sharded format: the samples are split into blocks of `shard_size` samples, the shards,
+    and every shard is a folder {folder}/{name}/shard_{i}/ with one {key}.npy file per key. The manifest
+    {folder}/{name}/manifest.json lists the shards with their sizes and checksums, and for every key the shape and
+    dtype, the number of samples with non-finite entries, and the mean and standard deviation of the finite samples
+    (per column for scalar and vector keys, over all entries for images). It is updated after every shard, so the
+    sample can be counted, checked for NaNs, and normalized without opening the arrays (see `read_sharded_manifest()`).
+
+    Rows are buffered until a shard is full, so the memory use is bounded by the shard size.
+    """
+
+    def __init__(self, folder, name, shard_size=10000, metadata=None):
+        """
+        :param folder: Folder in which the sample folder is created
+        :param name: Sample name, like "train"
+        :param shard_size: Number of samples per shard
+        :param metadata: Dict with additional information that is stored in the manifest
+        """
+
+        self.folder = folder
+        self.name = name
+        self.shard_size = shard_size
+        self.metadata = {} if metadata is None else metadata
+        self.keys = OrderedDict()
+        self.shards = []
+        self.buffer = OrderedDict()
+        self.n_buffered = 0
+        self.complete = False
+
+        if not os.path.exists(sharded_folder(folder, name)):
+            os.makedirs(sharded_folder(folder, name))
+
+    @property
+    def n_samples(self):
+        return sum(shard["n"] for shard in self.shards)
+
+    def write(self, chunk):
+        """
+        Appends samples.
+
+        :param chunk: Dict with the arrays to be saved, the first dimension running over the samples of this chunk.
+            Every chunk has to have the same keys. Entries that are None are skipped.
+        """
+
+        chunk = OrderedDict([(key, np.asarray(value)) for key, value in chunk.items() if value is not None])
+        if len(chunk) == 0:
+            return
+        if len(set(value.shape[0] for value in chunk.values())) > 1:
+            raise RuntimeError("Inconsistent chunk lengths")
+        if self.buffer and set(chunk.keys()) != set(self.buffer.keys()):
+            raise RuntimeError(
+                "Keys {} differ from earlier keys {}".format(list(chunk.keys()), list(self.buffer.keys()))
+            )
+
+        n_chunk = next(iter(chunk.values())).shape[0]
+        i = 0
+        while i < n_chunk:
+            n_take = min(self.shard_size - self.n_buffered, n_chunk - i)
+            for key, value in chunk.items():
+                self.buffer.setdefault(key, []).append(value[i : i + n_take])
+            self.n_buffered += n_take
+            i += n_take
+            if self.n_buffered >= self.shard_size:
+                self._write_shard()
+
+    def close(self):
+        """ Writes the last shard and marks the sample as complete """
+
+        if self.n_buffered > 0:
+            self._write_shard()
+        self.complete = True
+        self._write_manifest()
+
+    def _write_shard(self):
+        path = "shard_{:05d}".format(len(self.shards))
+        if not os.path.exists("{}/{}".format(sharded_folder(self.folder, self.name), path)):
+            os.makedirs("{}/{}".format(sharded_folder(self.folder, self.name), path))
+
+        shard = {"path": path, "n": self.n_buffered, "checksums": {}}
+        for key, values in self.buffer.items():
+            values = np.concatenate(values, axis=0)
+            np.save("{}/{}/{}.npy".format(sharded_folder(self.folder, self.name), path, key), values)
+            shard["checksums"][key] = _checksum(values)
+            self._update_key_statistics(key, values)
+
+        self.shards.append(shard)
+        self.buffer = OrderedDict([(key, []) for key in self.buffer.keys()])
+        self.n_buffered = 0
+        self._write_manifest()
+
+    def _update_key_statistics(self, key, values):
+        """ Updates the running mean and variance of the finite samples with the parallel algorithm by Chan et al. """
+
+        finite = np.all(np.isfinite(values.reshape(values.shape[0], -1)), axis=1)
+        finite_values = values[finite].astype(np.float64)
+        if values.ndim > 2:
+            finite_values = finite_values.reshape(-1)
+        n = finite_values.shape[0]
+        mean = np.mean(finite_values, axis=0) if n > 0 else 0.0
+        m2 = np.sum((finite_values - mean) ** 2, axis=0) if n > 0 else 0.0
+
+        if key not in self.keys:
+            self.keys[key] = {
+                "shape": list(values.shape[1:]),
+                "dtype": values.dtype.str,
+                "n_nonfinite": 0,
+                "n_stats": 0,
+                "mean": 0.0,
+                "m2": 0.0,
+            }
+        stats = self.keys[key]
+        stats["n_nonfinite"] += int(values.shape[0] - np.sum(finite))
+
+        n_total = stats["n_stats"] + n
+        if n_total > 0:
+            delta = mean - np.asarray(stats["mean"])
+            stats["mean"] = np.asarray(stats["mean"]) + delta * n / n_total
+            stats["m2"] = np.asarray(stats["m2"]) + m2 + delta ** 2 * stats["n_stats"] * n / n_total
+        stats["n_stats"] = n_total
+
+    def _write_manifest(self):
+        keys = OrderedDict()
+        for key, stats in self.keys.items():
+            n_stats = max(stats["n_stats"], 1)
+            keys[key] = OrderedDict(
+                [
+                    ("shape", stats["shape"]),
+                    ("dtype", stats["dtype"]),
+                    ("n_nonfinite", stats["n_nonfinite"]),
+                    ("mean", np.asarray(stats["mean"]).tolist()),
+                    ("std", np.sqrt(np.asarray(stats["m2"]) / n_stats).tolist()),
+                ]
+            )
+
+        manifest = OrderedDict(
+            [
+                ("name", self.name),
+                ("format", "sharded"),
+                ("n_samples", self.n_samples),
+                ("complete", self.complete),
+                ("shard_size", self.shard_size),
+                ("keys", keys),
+                ("metadata", self.metadata),
+                ("shards", self.shards),
+            ]
+        )
+
+        # Write to temporary file first so the manifest is never half-written
+        filename = sharded_manifest_filename(self.folder, self.name)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(filename + ".tmp", filename)
+
+
+class ShardedArray:
+    """
+    Array-like view of one key of a sample in the sharded format (see ShardedWriter). The shards are memory-mapped
+    when they are first accessed. Indexing with an integer returns the sample as numpy array, indexing with a slice or
+    an index array returns another ShardedArray for these samples, and np.asarray() reads all of them.
+
+    Wrapped in a torch Dataset (see inference.trainer.NumpyDataset), the shards are read in the data loader workers.
+    """
+
+    def __init__(self, folder, name, key, indices=None, manifest=None):
+        """
+        :param folder: Folder with the sample folder
+        :param name: Sample name
+        :param key: Key, like "x"
+        :param indices: Indices of the samples that are part of this object. Default: all.
+        :param manifest: Manifest of the sample, read from disk if None
+        """
+
+        self.folder = folder
+        self.name = name
+        self.key = key
+        self.manifest = read_sharded_manifest(folder, name) if manifest is None else manifest
+        if key not in self.manifest["keys"]:
+            raise FileNotFoundError("Sample {} does not contain {}".format(name, key))
+
+        self.shard_offsets = np.cumsum([0] + [shard["n"] for shard in self.manifest["shards"]])
+        self.indices = np.arange(self.shard_offsets[-1]) if indices is None else np.asarray(indices)
+        self._shards = {}
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.manifest["keys"][self.key]["shape"])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(self.manifest["keys"][self.key]["dtype"])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            i = self.indices[index]
+            i_shard = np.searchsorted(self.shard_offsets, i, side="right") - 1
+            return np.array(self._shard(i_shard)[i - self.shard_offsets[i_shard]])
+        return ShardedArray(self.folder, self.name, self.key, self.indices[index], self.manifest)
+
+    def __array__(self, dtype=None):
+        result = np.empty(self.shape, dtype=self.dtype)
+        i_shards = np.searchsorted(self.shard_offsets, self.indices, side="right") - 1
+        for i_shard in np.unique(i_shards):
+            selected = i_shards == i_shard
+            result[selected] = self._shard(i_shard)[self.indices[selected] - self.shard_offsets[i_shard]]
+        return result if dtype is None else result.astype(dtype)
+
+    def __getstate__(self):
+        # Memory maps are not sent to data loader workers, every worker opens the shards again
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def _shard(self, i_shard):
+        if i_shard not in self._shards:
+            path = self.manifest["shards"][i_shard]["path"]
+            filename = "{}/{}/{}.npy".format(sharded_folder(self.folder, self.name), path, self.key)
+            self._shards[i_shard] = np.load(filename, mmap_mode="r")
+        return self._shards[i_shard]
+
+
+def sharded_folder(folder, name):
+    return "{}/{}".format(folder, name)
+
+
+def sharded_manifest_filename(folder, name):
+    return "{}/manifest.json".format(sharded_folder(folder, name))
+
+
+def is_sharded(folder, name):
+    """ Whether sample {name} in {folder} is stored in the sharded format """
+
+    return os.path.exists(sharded_manifest_filename(folder, name))
+
+
+def read_sharded_manifest(folder, name):
+    """ Returns the manifest of a sample in the sharded format as dict, or an empty dict if there is none """
+
+    try:
+        with open(sharded_manifest_filename(folder, name)) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except FileNotFoundError:
+        return {}
+
+
+def sample_keys(folder, name):
+    """ Returns the keys that are available for sample {name} in {folder}, in either format. The keys are read from the
+    manifest if there is one. Otherwise the known keys SAMPLE_KEYS are checked for a file {key}_{name}.npy, since the
+    file names alone are ambiguous (x_pre_train.npy could belong to the sample train or pre_train). """
+
+    if is_sharded(folder, name):
+        return list(read_sharded_manifest(folder, name)["keys"].keys())
+
+    manifest = read_manifest(folder, name)
+    keys = manifest["keys"] if manifest else SAMPLE_KEYS
+    return [key for key in keys if os.path.exists("{}/{}_{}.npy".format(folder, key, name))]
+
+
+def verify_sharded(folder, name):
+    """ Compares the checksums of all shards of a sample in the sharded format to the ones in the manifest
+
+    :return: True if all shards are intact
+    """
+
+    manifest = read_sharded_manifest(folder, name)
+    passed = True
+    for shard in manifest["shards"]:
+        for key, checksum in shard["checksums"].items():
+            filename = "{}/{}/{}.npy".format(sharded_folder(folder, name), shard["path"], key)
+            try:
+                valid = _checksum(np.load(filename, mmap_mode="r")) == checksum
+            except (IOError, ValueError):
+                valid = False
+            if not valid:
+                logger.warning("Shard %s of sample %s: %s is corrupted", shard["path"], name, key)
+                passed = False
+    return passed
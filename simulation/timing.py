@@ -0,0 +1,89 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Stage timers of the simulation, aggregated per process. They work like the timers of inference.trainer.Trainer, but
+# are module-level so that all simulator objects in a process contribute to the same summary.
+_enabled = False
+_timer = OrderedDict()
+_calls = OrderedDict()
+_time_started = OrderedDict()
+
+
+def enable_timing(enabled=True):
+    """ Switches the stage timers on or off. When they are off, `timer()` returns immediately. """
+
+    global _enabled
+    _enabled = enabled
+
+
+def timing_enabled():
+    return _enabled
+
+
+def timer(start=None, stop=None):
+    """ Starts and / or stops the timer of a simulation stage. Stopping a stage adds the elapsed time to its total. """
+
+    if not _enabled:
+        return
+
+    if stop is not None:
+        if stop not in _time_started:
+            logger.warning("Timer for stage %s has been stopped without being started before", stop)
+        else:
+            dt = time.time() - _time_started.pop(stop)
+            _timer[stop] = _timer.get(stop, 0.0) + dt
+            _calls[stop] = _calls.get(stop, 0) + 1
+
+    if start is not None:
+        _time_started[start] = time.time()
+
+
+def timer_summary():
+    """ Returns an OrderedDict {stage: {"seconds": total time, "calls": number of calls}} """
+
+    return OrderedDict([(key, {"seconds": _timer[key], "calls": _calls[key]}) for key in _timer])
+
+
+def pop_timer():
+    """ Returns the summary and resets the totals, for instance to send the timings of a worker process back. Timers
+    that are running keep running. """
+
+    summary = timer_summary()
+    _timer.clear()
+    _calls.clear()
+    return summary
+
+
+def merge_timer(summary):
+    """ Adds a summary from `timer_summary()` or `pop_timer()` (e.g. from a worker process) to the timers """
+
+    if summary is None:
+        return
+    for key, value in summary.items():
+        _timer[key] = _timer.get(key, 0.0) + value["seconds"]
+        _calls[key] = _calls.get(key, 0) + value["calls"]
+
+
+def report_timer():
+    logger.info("Simulation time spent on:")
+    for key, value in timer_summary().items():
+        logger.info("  {:>32s}: {:8.2f}s in {:>7d} calls".format(key, value["seconds"], value["calls"]))
+
+
+def save_timer(filename, metadata=None):
+    """ Saves the summary as JSON file, together with an optional dict of metadata """
+
+    total = sum(_timer.values())
+    summary = OrderedDict()
+    summary["metadata"] = {} if metadata is None else metadata
+    summary["total_seconds"] = total
+    summary["stages"] = timer_summary()
+    for value in summary["stages"].values():
+        value["fraction"] = value["seconds"] / total if total > 0.0 else 0.0
+
+    with open(filename, "w") as f:
+        json.dump(summary, f, indent=2)
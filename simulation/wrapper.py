@@ -1,13 +1,67 @@
 import numpy as np
 import logging
-from scipy.stats import norm, uniform
-import scipy.special
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from simulation.population_sim import LensingObservationWithSubhalos
+from simulation.gold import population_statistics, log_r_from_log_probs
 from simulation.units import M_s
+from simulation.prior import get_prior
+from simulation.timing import timer, timing_enabled, enable_timing, pop_timer, merge_timer
 
 logger = logging.getLogger(__name__)
 
+# Outputs that can be requested from augmented_data(): observed images, noiseless images, augmented data ("gold",
+# i.e. joint scores and likelihood ratios), per-subhalo latents, global latents, population statistics, derivatives
+# of the image with respect to the subhalo masses, and the seeds from which every sample can be simulated again (see
+# regenerate())
+OUTPUTS = ["x", "x_noiseless", "gold", "sub_latents", "z", "pop", "dx_dm", "seed"]
+
+# Fidelities of the simulator. The high-fidelity simulation is the standard one. The low-fidelity simulation renders
+# the same field of view with a quarter of the pixels, only draws subhalos above 1e8 solar masses (which dominate the
+# lensing signal, while the much more numerous light ones dominate the cost), and skips the PSF convolution. With the
+# same calibration mass range, f_sub has the same meaning in both. It is meant for pretraining, see train.py --pretrain.
+FIDELITIES = OrderedDict(
+    [
+        (
+            "high",
+            {
+                "n_xy": 64,
+                "pixel_size": 0.1,
+                "fwhm_psf": 0.18,
+                "m_200_min_sub": 1.0e7 * M_s,
+                "m_200_max_sub_div_M_hst": 0.01,
+                "m_min_calib": 1.0e7 * M_s,
+                "m_max_sub_div_M_hst_calib": 0.01,
+            },
+        ),
+        (
+            "low",
+            {
+                "n_xy": 32,
+                "pixel_size": 0.2,
+                "fwhm_psf": None,
+                "m_200_min_sub": 1.0e8 * M_s,
+                "m_200_max_sub_div_M_hst": 0.01,
+                "m_min_calib": 1.0e7 * M_s,
+                "m_max_sub_div_M_hst_calib": 0.01,
+            },
+        ),
+    ]
+)
+
+# Settings of FIDELITIES that define the subhalo mass function, and with it the joint likelihood
+MASS_FUNCTION_SETTINGS = ["m_200_min_sub", "m_200_max_sub_div_M_hst", "m_min_calib", "m_max_sub_div_M_hst_calib"]
+
+
+def mass_function_settings(fidelity="high"):
+    """ Returns the subhalo mass function settings of a fidelity, which are the keyword arguments of
+    simulation.gold.joint_log_probs(), mine_gold(), and ThetaAltSampler """
+
+    if fidelity not in FIDELITIES:
+        raise ValueError("Unknown fidelity {}, has to be one of {}".format(fidelity, list(FIDELITIES.keys())))
+    return {key: FIDELITIES[fidelity][key] for key in MASS_FUNCTION_SETTINGS}
+
 
 def augmented_data(
     f_sub=None,
@@ -16,8 +70,8 @@ def augmented_data(
     beta_alt=None,
     f_sub_ref=None,
     beta_ref=None,
-    f_sub_prior=uniform(0.001, 0.199),
-    beta_prior=uniform(-2.5, 1.0),
+    f_sub_prior=None,
+    beta_prior=None,
     n_images=None,
     n_thetas_marginal=1000,
     draw_host_mass=True,
@@ -27,131 +81,504 @@ def augmented_data(
     calculate_dx_dm=False,
     return_dx_dm=False,
     roi_size=2.,
+    n_workers=1,
+    seed=None,
+    chunk_size=100,
+    outputs=None,
+    n_noise_realizations=1,
+    fidelity="high",
 ):
     """ Wraps around the population simulation, starts the simulation with parameters drawn from the prior and
-    "mines the gold" appropriately """
+    "mines the gold" appropriately. Besides the images and augmented data, the compact population statistics of every
+    image are returned, which allow re-mining the gold for new parameter points with `simulation.gold.mine_gold()`.
+
+    The results are returned as an OrderedDict with the keys "theta" and "theta_alt" and one or more keys for every
+    requested output (see OUTPUTS): "x", "x_noiseless", "t_xz", "t_xz_alt", "log_r_xz", "log_r_xz_alt", "sub_latents",
+    "z", "pop", "dx_dm", "seed". If `outputs` is None, they are determined by `mine_gold` and `return_dx_dm` as
+    before. Simulation stages whose results are not requested are skipped. "seed" has shape (n, 3) and contains the
+    seed of the run, the image index, and the index of the noise realization of every sample, from which
+    `regenerate()` can simulate the images again.
+
+    With `n_noise_realizations > 1`, every noiseless image is rendered once and observed with that many independent
+    realizations of the Poisson noise and PSF. Every realization is returned as a separate sample, so all results have
+    n_images * n_noise_realizations entries, and the realizations of one image share their parameters, latents, and
+    augmented data. The additional key "group" then contains the index of the image every sample belongs to, which
+    allows keeping all realizations of an image on the same side of a train / validation split.
+
+    `fidelity` is one of the keys of FIDELITIES and selects the resolution, PSF, and subhalo mass range of the
+    simulator. "low" is much cheaper than the default "high" and returns 32 x 32 images of the same field of view.
+
+    If the stage timers in `simulation.timing` are enabled, the time spent in the stages of the simulation is added
+    to them, including the time spent in worker processes.
+
+    Every image is simulated with its own random number streams derived from [seed, i_image], so the results do not
+    depend on `n_workers`. With `n_workers > 1`, chunks of images are simulated in a process pool, and only the
+    arrays that are returned are sent back from the workers. If `seed` is None, it is drawn from numpy's global random
+    state. To process the results chunk by chunk instead of keeping all of them in memory, use
+    `augmented_data_chunks()`. """
+
+    results = OrderedDict()
+    for _, chunk in augmented_data_chunks(
+        f_sub=f_sub,
+        beta=beta,
+        f_sub_alt=f_sub_alt,
+        beta_alt=beta_alt,
+        f_sub_ref=f_sub_ref,
+        beta_ref=beta_ref,
+        f_sub_prior=f_sub_prior,
+        beta_prior=beta_prior,
+        n_images=n_images,
+        n_thetas_marginal=n_thetas_marginal,
+        draw_host_mass=draw_host_mass,
+        draw_host_redshift=draw_host_redshift,
+        draw_alignment=draw_alignment,
+        mine_gold=mine_gold,
+        calculate_dx_dm=calculate_dx_dm,
+        return_dx_dm=return_dx_dm,
+        roi_size=roi_size,
+        n_workers=n_workers,
+        seed=seed,
+        chunk_size=chunk_size,
+        outputs=outputs,
+        n_noise_realizations=n_noise_realizations,
+        fidelity=fidelity,
+    ):
+        for key, value in chunk.items():
+            results.setdefault(key, []).append(value)
+
+    for key, values in results.items():
+        if key in ["sub_latents", "dx_dm"]:
+            results[key] = [item for value in values for item in value]
+        else:
+            results[key] = np.concatenate(values, axis=0)
+
+    return results
+
+
+def augmented_data_chunks(
+    f_sub=None,
+    beta=None,
+    f_sub_alt=None,
+    beta_alt=None,
+    f_sub_ref=None,
+    beta_ref=None,
+    f_sub_prior=None,
+    beta_prior=None,
+    n_images=None,
+    n_thetas_marginal=1000,
+    draw_host_mass=True,
+    draw_host_redshift=True,
+    draw_alignment=True,
+    mine_gold=True,
+    calculate_dx_dm=False,
+    return_dx_dm=False,
+    roi_size=2.,
+    n_workers=1,
+    seed=None,
+    chunk_size=100,
+    outputs=None,
+    n_noise_realizations=1,
+    skip_chunks=None,
+    fidelity="high",
+):
+    """ Generator version of augmented_data(): simulates the images in chunks of at most `chunk_size` images and yields
+    tuples (i_start, chunk) as soon as each chunk is finished, in order. `chunk` is an OrderedDict with the same keys
+    as the results of augmented_data(). The entries are arrays whose first dimension runs over the images of this
+    chunk, except for "sub_latents" and "dx_dm", which are lists.
+
+    The chunk boundaries only depend on `n_images` and `chunk_size`. Chunks whose first index is in `skip_chunks` are
+    not simulated, which together with the same `seed` and parameters allows to resume an interrupted run. With
+    `n_noise_realizations > 1`, i_start and `skip_chunks` count samples (i.e. noise realizations), not images. """
 
     # Input
     if (f_sub is None or beta is None) and n_images is None:
         raise ValueError("Either f_sub and beta or n_images have to be different from None")
     if n_images is None:
         n_images = len(f_sub)
-    n_verbose = max(1, n_images // 100)
+    if fidelity not in FIDELITIES:
+        raise ValueError("Unknown fidelity {}, has to be one of {}".format(fidelity, list(FIDELITIES.keys())))
+    chunk_size = max(1, min(chunk_size, n_images // 100))
+
+    # Requested outputs
+    if outputs is None:
+        outputs = ["x", "sub_latents", "z", "pop"]
+        if mine_gold:
+            outputs.append("gold")
+        if calculate_dx_dm and return_dx_dm:
+            outputs.append("dx_dm")
+    for output in outputs:
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output {}, has to be one of {}".format(output, OUTPUTS))
+    mine_gold = "gold" in outputs
+    calculate_dx_dm = calculate_dx_dm or "dx_dm" in outputs
+
+    # Priors, by default the standard ones from simulation.prior
+    if f_sub_prior is None or beta_prior is None:
+        f_sub_prior_default, beta_prior_default = get_prior()
+        f_sub_prior = f_sub_prior_default if f_sub_prior is None else f_sub_prior
+        beta_prior = beta_prior_default if beta_prior is None else beta_prior
 
     # Hypothesis for sampling
     beta, f_sub = _draw_params(beta, beta_prior, f_sub, f_sub_prior, n_images)
+    params = np.vstack((np.broadcast_to(f_sub, (n_images,)), np.broadcast_to(beta, (n_images,)))).T
 
     # Alternate hypothesis (test hypothesis when swapping num - den)
     beta_alt, f_sub_alt = _draw_params(beta_alt, beta_prior, f_sub_alt, f_sub_prior, n_images)
+    params_alt = np.vstack((np.broadcast_to(f_sub_alt, (n_images,)), np.broadcast_to(beta_alt, (n_images,)))).T
 
     # Reference hypothesis
-    beta_ref, f_sub_ref = _draw_params(beta_alt, beta_prior, f_sub_alt, f_sub_prior, n_thetas_marginal - 1)
+    beta_ref, f_sub_ref = _draw_params(None, beta_prior, None, f_sub_prior, n_thetas_marginal - 1)
     params_ref = np.vstack((f_sub_ref, beta_ref)).T
 
-    # Output
-    all_params, all_params_alt, all_images = [], [], []
-    all_t_xz, all_t_xz_alt, all_log_r_xz, all_log_r_xz_alt = [], [], [], []
-    all_sub_latents, all_global_latents = [], []
-    all_dx_dm = []
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+
+    # Chunks of images
+    settings = {
+        "outputs": outputs,
+        "draw_host_mass": draw_host_mass,
+        "draw_host_redshift": draw_host_redshift,
+        "draw_alignment": draw_alignment,
+        "calculate_dx_dm": calculate_dx_dm,
+        "roi_size": roi_size,
+        "n_noise_realizations": n_noise_realizations,
+        "fidelity": fidelity,
+        "timing": timing_enabled(),
+    }
+    chunks = [
+        (i_start, params[i_start : i_start + chunk_size], params_alt[i_start : i_start + chunk_size], params_ref, seed, settings)
+        for i_start in range(0, n_images, chunk_size)
+        if skip_chunks is None or i_start * n_noise_realizations not in skip_chunks
+    ]
+    n_rejected_populations = 0
 
     # Main loop
-    for i_sim in range(n_images):
-        if (i_sim + 1) % n_verbose == 0:
-            logger.info("Simulating image %s / %s", i_sim + 1, n_images)
-        else:
-            logger.debug("Simulating image %s / %s", i_sim + 1, n_images)
+    if n_workers > 1:
+        logger.info("Simulating %s images in %s chunks with %s workers", n_images, len(chunks), n_workers)
+        pool = Pool(n_workers)
+        results = pool.imap(_simulate_chunk, chunks)
+    else:
+        pool = None
+        results = map(_simulate_chunk, chunks)
 
-        # Prepare params
-        this_f_sub = _pick_param(f_sub, i_sim, n_images)
-        this_beta = _pick_param(beta, i_sim, n_images)
-        this_f_sub_alt = _pick_param(f_sub_alt, i_sim, n_images)
-        this_beta_alt = _pick_param(beta_alt, i_sim, n_images)
+    try:
+        for (i_start, this_params, this_params_alt, _, _, _), result in zip(chunks, results):
+            i_end = i_start + len(this_params)
+            logger.info("Simulated image %s / %s", i_end, n_images)
+            n_rejected_populations += result.pop("n_rejected_populations")
+            merge_timer(result.pop("timing"))
 
-        params = np.asarray([this_f_sub, this_beta]).reshape((1, 2))
-        params_alt = np.asarray([this_f_sub_alt, this_beta_alt]).reshape((1, 2))
-        params_eval = np.vstack((params, params_alt, params_ref)) if mine_gold else None
+            chunk = OrderedDict()
+            chunk["theta"] = this_params
+            chunk["theta_alt"] = this_params_alt
+            for key in ["x", "x_noiseless", "t_xz", "t_xz_alt"]:
+                if key in result:
+                    chunk[key] = np.array(result[key])
 
-        logger.debug("Numerator hypothesis: f_sub = %s, beta = %s", this_f_sub, this_beta)
+            # Joint likelihood ratios for the whole chunk
+            if mine_gold:
+                timer(start="gold: likelihood ratios")
+                log_probs = np.array(result["log_probs"])
+                chunk["log_r_xz"] = log_r_from_log_probs(log_probs, 0, n_thetas_marginal)
+                chunk["log_r_xz_alt"] = log_r_from_log_probs(log_probs, 1, n_thetas_marginal)
+                timer(stop="gold: likelihood ratios")
 
+            if "sub_latents" in result:
+                chunk["sub_latents"] = result["sub_latents"]
+            for key in ["z", "pop"]:
+                if key in result:
+                    chunk[key] = np.array(result[key])
+            if "dx_dm" in result:
+                chunk["dx_dm"] = result["dx_dm"]
+            if "seed" in outputs:
+                chunk["seed"] = np.array([[seed, i, 0] for i in range(i_start, i_end)], dtype=np.int64)
+
+            if n_noise_realizations > 1:
+                chunk = _expand_noise_realizations(chunk, n_noise_realizations)
+                chunk["group"] = np.repeat(np.arange(i_start, i_end), n_noise_realizations)
+                if "seed" in chunk:
+                    chunk["seed"][:, 2] = np.tile(np.arange(n_noise_realizations), i_end - i_start)
+
+            yield i_start * n_noise_realizations, chunk
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    logger.info(
+        "Rejected %s subhalo populations with f_sub_realiz > 1 (%.1f%% of all population draws)",
+        n_rejected_populations,
+        100.0 * n_rejected_populations / max(n_rejected_populations + n_images, 1),
+    )
+
+
+def _simulate_chunk(args):
+    """ Simulates a chunk of images for augmented_data() and returns only the requested arrays, so that no simulator
+    objects have to be sent back from worker processes """
+
+    i_start, params, params_alt, params_ref, seed, settings = args
+    outputs = settings["outputs"]
+    mine_gold = "gold" in outputs
+    calculate_dx_dm = settings["calculate_dx_dm"]
+
+    # The timings of this chunk are sent back separately, also when it runs in the main process
+    enable_timing(settings["timing"])
+    previous_timings = pop_timer()
+
+    # Stages of the simulator that are needed
+    sim_outputs = []
+    if "x" in outputs:
+        sim_outputs.append("image")
+    if "x_noiseless" in outputs:
+        sim_outputs.append("image_noiseless")
+    if "z" in outputs:
+        sim_outputs.append("latents")
+
+    result = {"n_rejected_populations": 0}
+    for key in outputs:
+        if key == "gold":
+            result.update({"log_probs": [], "t_xz": [], "t_xz_alt": []})
+        elif key != "seed":
+            result[key] = []
+
+    for i, (this_params, this_params_alt) in enumerate(zip(params, params_alt)):
+        i_sim = i_start + i
+        logger.debug("Simulating image %s", i_sim + 1)
+        logger.debug("Numerator hypothesis: f_sub = %s, beta = %s", this_params[0], this_params[1])
+
+        params_eval = np.vstack((this_params, this_params_alt, params_ref)) if mine_gold else None
         if mine_gold:
             logger.debug("Evaluating joint log likelihood at %s", params_eval)
 
         # Simulate
         sim = LensingObservationWithSubhalos(
-            m_200_min_sub=1.0e7 * M_s,
-            m_200_max_sub_div_M_hst=0.01,
-            m_min_calib=1.0e7 * M_s,
-            m_max_sub_div_M_hst_calib=0.01,
-            f_sub=this_f_sub,
-            beta=this_beta,
+            f_sub=this_params[0],
+            beta=this_params[1],
             params_eval=params_eval,
             calculate_joint_score=mine_gold,
-            draw_host_mass=draw_host_mass,
-            draw_host_redshift=draw_host_redshift,
-            draw_alignment=draw_alignment,
+            draw_host_mass=settings["draw_host_mass"],
+            draw_host_redshift=settings["draw_host_redshift"],
+            draw_alignment=settings["draw_alignment"],
             calculate_msub_derivatives=calculate_dx_dm,
-            roi_size=roi_size,
+            roi_size=settings["roi_size"],
+            seed=[seed, i_sim],
+            outputs=sim_outputs,
+            n_noise_realizations=settings["n_noise_realizations"],
+            **FIDELITIES[settings["fidelity"]]
         )
+        result["n_rejected_populations"] += sim.n_rejected_populations
 
         # Store information
-        if calculate_dx_dm:
-            sum_abs_dx_dm = np.sum(np.abs(sim.grad_msub_image).reshape(sim.grad_msub_image.shape[0], -1), axis=1)
-            sub_latents = np.vstack((sim.m_subs, sim.theta_xs, sim.theta_ys, sum_abs_dx_dm)).T
-            if return_dx_dm:
-                all_dx_dm.append(sim.grad_msub_image)
+        if "x" in outputs:
+            result["x"] += list(sim.image_poiss_psf_realizations)
+        if "x_noiseless" in outputs:
+            result["x_noiseless"].append(sim.image)
+        if "sub_latents" in outputs:
+            if calculate_dx_dm:
+                sum_abs_dx_dm = np.sum(np.abs(sim.grad_msub_image).reshape(sim.grad_msub_image.shape[0], -1), axis=1)
+                sub_latents = np.vstack((sim.m_subs, sim.theta_xs, sim.theta_ys, sum_abs_dx_dm)).T
+            else:
+                sub_latents = np.vstack((sim.m_subs, sim.theta_xs, sim.theta_ys)).T
+            result["sub_latents"].append(sub_latents)
+        if "z" in outputs:
+            result["z"].append(_global_latents(sim))
+        if "pop" in outputs:
+            result["pop"].append(population_statistics(sim))
+        if "dx_dm" in outputs:
+            result["dx_dm"].append(sim.grad_msub_image)
+        if mine_gold:
+            result["log_probs"].append(sim.joint_log_probs)
+            result["t_xz"].append(sim.joint_scores[0])
+            result["t_xz_alt"].append(sim.joint_scores[1])
+
+    result["timing"] = pop_timer()
+    merge_timer(previous_timings)
+    return result
+
+
+def augmented_data_grid(
+    thetas,
+    n_images,
+    seed=None,
+    draw_host_mass=True,
+    draw_host_redshift=True,
+    draw_alignment=True,
+    roi_size=2.,
+    fidelity="high",
+):
+    """ Simulates the same set of `n_images` hosts for every parameter point in `thetas` with common random numbers:
+    for the j-th image, all parameter points share the host draw (and its distances and deflection map, which are
+    only calculated once), the quantiles of the subhalo number and masses, the subhalo positions, and the noise
+    stream. This reduces the variance between grid points in calibration histograms and avoids duplicated work. With
+    the same seed, the results for every parameter point are the same as those of augmented_data().
+
+    :param thetas: Parameter points (f_sub, beta) with shape (n_grid, 2)
+    :param n_images: Number of hosts / images per parameter point
+    :param seed: Entropy for the random number streams. The streams of the j-th host are derived from [seed, j]. If
+        None, a random seed is drawn.
+    :param fidelity: Simulator settings, one of the keys of FIDELITIES
+    :return: OrderedDict with the keys "theta", "x", "z" (global latents), and "pop" (population statistics), each
+        with shape (n_grid, n_images, ...)
+    """
+
+    if fidelity not in FIDELITIES:
+        raise ValueError("Unknown fidelity {}, has to be one of {}".format(fidelity, list(FIDELITIES.keys())))
+
+    thetas = np.asarray(thetas).reshape((-1, 2))
+    n_grid = thetas.shape[0]
+    beta, f_sub = _draw_params(thetas[:, 1], None, thetas[:, 0], None, n_grid)
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+    n_verbose = max(1, n_images // 100)
+
+    all_params = np.repeat(np.vstack((f_sub, beta)).T[:, np.newaxis, :], n_images, axis=1)
+    all_images, all_global_latents, all_population = [], [], []
+    n_rejected_populations = 0
+
+    for i_host in range(n_images):
+        if (i_host + 1) % n_verbose == 0:
+            logger.info("Simulating host %s / %s for %s parameter points", i_host + 1, n_images, n_grid)
         else:
-            sub_latents = np.vstack((sim.m_subs, sim.theta_xs, sim.theta_ys)).T
-        global_latents = [
-                sim.M_200_hst,  # Host mass
-                sim.D_l,  # Host distance
-                sim.z_l,  # Host redshift
-                sim.sigma_v,  # sigma_V
-                sim.theta_x_0,  # Source offset x
-                sim.theta_y_0,  # Source offset y
-                sim.theta_E,  # Host Einstein radius
-                sim.n_sub_roi,  # Number of subhalos
-                sim.f_sub_realiz,  # Fraction of halo mass in subhalos
-                sim.n_sub_in_ring,  # Number of subhalos with r < 90% of host Einstein radius
-                sim.f_sub_in_ring,  # Fraction of halo mass in subhalos with r < 90% of host Einstein radius
-                sim.n_sub_near_ring,  # Number of subhalos with r within 10% of host Einstein radius
-                sim.f_sub_near_ring,  # Fraction of halo mass in subhalos with r within 10% of host Einstein radius
-            ]
-        global_latents = np.asarray(global_latents)
-
-        all_params.append(params)
-        all_params_alt.append(params_alt)
-        all_images.append(sim.image_poiss_psf)
-        all_sub_latents.append(sub_latents)
+            logger.debug("Simulating host %s / %s for %s parameter points", i_host + 1, n_images, n_grid)
+
+        host = None
+        images, global_latents, population = [], [], []
+
+        for i_grid in range(n_grid):
+            sim = LensingObservationWithSubhalos(
+                f_sub=f_sub[i_grid],
+                beta=beta[i_grid],
+                calculate_joint_score=False,
+                draw_host_mass=draw_host_mass,
+                draw_host_redshift=draw_host_redshift,
+                draw_alignment=draw_alignment,
+                roi_size=roi_size,
+                seed=[seed, i_host],
+                host=host,
+                **FIDELITIES[fidelity]
+            )
+            host = sim.host
+            n_rejected_populations += sim.n_rejected_populations
+
+            images.append(sim.image_poiss_psf)
+            global_latents.append(_global_latents(sim))
+            population.append(population_statistics(sim))
+
+        all_images.append(images)
         all_global_latents.append(global_latents)
+        all_population.append(population)
 
-        if mine_gold:
-            all_log_r_xz.append(_extract_log_r(sim, 0, n_thetas_marginal))
-            all_log_r_xz_alt.append(_extract_log_r(sim, 1, n_thetas_marginal))
-            all_t_xz.append(sim.joint_scores[0])
-            all_t_xz_alt.append(sim.joint_scores[1])
-
-    if calculate_dx_dm and return_dx_dm:
-        return (
-            np.array(all_params).reshape((-1, 2)),
-            np.array(all_params_alt).reshape((-1, 2)),
-            np.array(all_images),
-            np.array(all_t_xz) if mine_gold else None,
-            np.array(all_t_xz_alt) if mine_gold else None,
-            np.array(all_log_r_xz) if mine_gold else None,
-            np.array(all_log_r_xz_alt) if mine_gold else None,
-            all_sub_latents,
-            np.array(all_global_latents),
+    logger.info(
+        "Rejected %s subhalo populations with f_sub_realiz > 1 (%.1f%% of all population draws)",
+        n_rejected_populations,
+        100.0 * n_rejected_populations / max(n_rejected_populations + n_grid * n_images, 1),
+    )
+
+    results = OrderedDict()
+    results["theta"] = all_params
+    results["x"] = np.swapaxes(np.array(all_images), 0, 1)
+    results["z"] = np.swapaxes(np.array(all_global_latents), 0, 1)
+    results["pop"] = np.swapaxes(np.array(all_population), 0, 1)
+    return results
+
+
+def regenerate(
+    theta,
+    seeds,
+    draw_host_mass=True,
+    draw_host_redshift=True,
+    draw_alignment=True,
+    roi_size=2.,
+    outputs=None,
+    fidelity="high",
+):
+    """ Simulates samples of augmented_data() again from their parameter points and seeds. Every stage of the
+    simulation draws from its own random number stream, so the results are identical to the original ones. The
+    augmented data is not calculated.
+
+    :param theta: Parameter points (f_sub, beta) with shape (n, 2), as returned by augmented_data()
+    :param seeds: Seeds with shape (n, 3), as returned by augmented_data() for the output "seed"
+    :param draw_host_mass: Has to be the same as in the original simulation, as the other simulator settings
+    :param outputs: List of any of "x", "x_noiseless", "z", and "pop". Default: ["x"].
+    :param fidelity: Fidelity of the original simulation, see FIDELITIES
+    :return: OrderedDict with an array of shape (n, ...) for every output
+    """
+
+    theta = np.asarray(theta).reshape((-1, 2))
+    seeds = np.asarray(seeds, dtype=np.int64).reshape((-1, 3))
+    if outputs is None:
+        outputs = ["x"]
+
+    sim_outputs = []
+    if "x" in outputs:
+        sim_outputs.append("image")
+    if "x_noiseless" in outputs:
+        sim_outputs.append("image_noiseless")
+    if "z" in outputs:
+        sim_outputs.append("latents")
+
+    results = OrderedDict([(key, []) for key in outputs])
+    for this_theta, (seed, i_image, i_noise) in zip(theta, seeds):
+        sim = LensingObservationWithSubhalos(
+            f_sub=this_theta[0],
+            beta=this_theta[1],
+            calculate_joint_score=False,
+            draw_host_mass=draw_host_mass,
+            draw_host_redshift=draw_host_redshift,
+            draw_alignment=draw_alignment,
+            roi_size=roi_size,
+            seed=[seed, i_image],
+            outputs=sim_outputs,
+            n_noise_realizations=i_noise + 1,
+            **FIDELITIES[fidelity]
         )
-    return (
-        np.array(all_params).reshape((-1, 2)),
-        np.array(all_params_alt).reshape((-1, 2)),
-        np.array(all_images),
-        np.array(all_t_xz) if mine_gold else None,
-        np.array(all_t_xz_alt) if mine_gold else None,
-        np.array(all_log_r_xz) if mine_gold else None,
-        np.array(all_log_r_xz_alt) if mine_gold else None,
-        all_sub_latents,
-        np.array(all_global_latents),
+
+        if "x" in outputs:
+            results["x"].append(sim.image_poiss_psf_realizations[i_noise])
+        if "x_noiseless" in outputs:
+            results["x_noiseless"].append(sim.image)
+        if "z" in outputs:
+            results["z"].append(_global_latents(sim))
+        if "pop" in outputs:
+            results["pop"].append(population_statistics(sim))
+
+    for key, values in results.items():
+        results[key] = np.array(values)
+    return results
+
+
+def _expand_noise_realizations(chunk, n_noise_realizations):
+    """ Repeats all entries of a chunk except the observed images "x", which already contain all noise realizations,
+    so that every noise realization becomes a separate sample """
+
+    expanded = OrderedDict()
+    for key, value in chunk.items():
+        if key == "x":
+            expanded[key] = value
+        elif isinstance(value, list):
+            expanded[key] = [item for item in value for _ in range(n_noise_realizations)]
+        else:
+            expanded[key] = np.repeat(value, n_noise_realizations, axis=0)
+    return expanded
+
+
+def _global_latents(sim):
+    return np.asarray(
+        [
+            sim.M_200_hst,  # Host mass
+            sim.D_l,  # Host distance
+            sim.z_l,  # Host redshift
+            sim.sigma_v,  # sigma_V
+            sim.theta_x_0,  # Source offset x
+            sim.theta_y_0,  # Source offset y
+            sim.theta_E,  # Host Einstein radius
+            sim.n_sub_roi,  # Number of subhalos
+            sim.f_sub_realiz,  # Fraction of halo mass in subhalos
+            sim.n_sub_in_ring,  # Number of subhalos with r < 90% of host Einstein radius
+            sim.f_sub_in_ring,  # Fraction of halo mass in subhalos with r < 90% of host Einstein radius
+            sim.n_sub_near_ring,  # Number of subhalos with r within 10% of host Einstein radius
+            sim.f_sub_near_ring,  # Fraction of halo mass in subhalos with r within 10% of host Einstein radius
+        ]
     )
 
 
@@ -164,17 +591,3 @@ def _draw_params(beta, beta_prior, f_sub, f_sub_prior, n_images):
     beta = np.clip(beta, None, -1.01)
     return beta, f_sub
 
-
-def _pick_param(xs, i, n):
-    try:
-        assert len(xs) == n
-        return xs[i]
-    except TypeError:
-        return xs
-
-
-def _extract_log_r(sim, i, n_thetas_marginal):
-    log_p_xz_from_marginal = np.delete(sim.joint_log_probs, i, axis=0)
-    delta_log = np.asarray(log_p_xz_from_marginal - sim.joint_log_probs[i] - np.log(float(n_thetas_marginal)), dtype=np.float128)
-    log_r_xz = -1.0 * scipy.special.logsumexp(delta_log)
-    return log_r_xz
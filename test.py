@@ -11,6 +11,7 @@ sys.path.append("./")
 
 from inference.estimator import ParameterizedRatioEstimator
 from inference.utils import load_and_check
+from simulation.storage import load_sample, load_sample_row
 from simulation.prior import (
     draw_params_from_prior,
     get_reference_point,
@@ -39,11 +40,12 @@ def evaluate(
     estimator = ParameterizedRatioEstimator()
     estimator.load("{}/models/{}".format(data_dir, model_filename))
 
+    # Samples can be stored as .npy files or in the sharded format
+    sample_folder = "{}/samples".format(data_dir)
+
     if grid:
-        x = np.load("{}/samples/x_{}.npy".format(data_dir, sample_filename))
-        aux_data, n_aux = load_aux(
-            "{}/samples/z_{}.npy".format(data_dir, sample_filename), aux
-        )
+        x = load_sample(sample_folder, "x", sample_filename)
+        aux_data, n_aux = load_aux(sample_folder, sample_filename, aux)
         if small:
             x = x[:100]
             if aux_data is not None:
@@ -60,15 +62,25 @@ def evaluate(
         )
 
     else:
-        x = np.load("{}/samples/x_{}.npy".format(data_dir, sample_filename))
-        aux_data, n_aux = load_aux(
-            "{}/samples/z_{}.npy".format(data_dir, sample_filename), aux
-        )
+        x = load_sample(sample_folder, "x", sample_filename, mmap_mode="r")
+        i_row = None
+        if i_theta_grid is not None and x.ndim == 4:
+            # Consolidated calibration grid from simulate.py --calibrate-grid, of which only one row is read
+            i_grid = load_sample(sample_folder, "i_grid", sample_filename)
+            rows = np.where(i_grid == i_theta_grid)[0]
+            if len(rows) == 0:
+                raise ValueError(
+                    "Grid point {} is not in the (finished part of the) calibration grid {}, which has the grid points "
+                    "{}".format(i_theta_grid, sample_filename, list(i_grid))
+                )
+            i_row = int(rows[0])
+            x = load_sample_row(sample_folder, "x", sample_filename, i_row)
+        aux_data, n_aux = load_aux(sample_folder, sample_filename, aux, i_row)
         if i_theta_grid is not None:
             theta = np.asarray([get_grid_point(i_theta_grid) for _ in range(x.shape[0])])
             logging.info("Determined grid theta %s = %s", i_theta_grid, theta[0])
         else:
-            theta = np.load("{}/samples/theta_{}.npy".format(data_dir, sample_filename))
+            theta = load_sample(sample_folder, "theta", sample_filename)
         if shuffle:
             np.random.shuffle(theta)
 
@@ -88,9 +100,11 @@ def evaluate(
         np.save("{}/results/grad_x_{}.npy".format(data_dir, result_filename), grad_x)
 
 
-def load_aux(filename, aux=False):
-    if aux:
-        return load_and_check(filename)[:, 2].reshape(-1, 1), 1
+def load_aux(folder, sample_filename, aux=False, i_row=None):
+    if aux and i_row is not None:
+        return load_and_check(load_sample_row(folder, "z", sample_filename, i_row))[:, 2].reshape(-1, 1), 1
+    elif aux:
+        return load_and_check(load_sample(folder, "z", sample_filename))[:, 2].reshape(-1, 1), 1
     else:
         return None, 0
 
@@ -136,6 +150,8 @@ def parse_args():
     parser.add_argument(
         "--igrid",
         type=int, default=None,
+        help="Evaluate at this grid point. If the sample is a consolidated calibration grid (simulate.py "
+        "--calibrate-grid), only the images simulated at this grid point are evaluated.",
     )
 
     return parser.parse_args()
@@ -3,15 +3,23 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import sys, os
+import json
+import glob
 
 sys.path.append("./")
 
 import logging
 import argparse
+from functools import partial
 import numpy as np
 
 from inference.estimator import ParameterizedRatioEstimator
 from inference.utils import load_and_check
+from simulation.gold import ThetaAltSampler
+from simulation.prior import draw_params_from_prior
+from simulation.wrapper import augmented_data, mass_function_settings
+from simulation.compact import load_compact_images
+from simulation.storage import load_sample, sample_keys, manifest_filename
 
 
 def train(
@@ -31,12 +39,21 @@ def train(
     limit_samplesize=None,
     load=None,
     zero_bias=False,
+    resample_theta_alt=False,
+    weights=None,
+    pretrain_sample=None,
+    pretrain_epochs=10,
+    augment=False,
 ):
-    aux_data, n_aux = load_aux("{}/samples/z_{}.npy".format(data_dir, sample_name), aux)
-    if aux_data is None:
-        logging.info("%s aux variables", n_aux)
-    else:
-        logging.info("%s aux variables with shape %s", n_aux, aux_data.shape)
+    """ Trains an estimator on the sample `sample_name`. If `pretrain_sample` is given, the estimator is first trained
+    for `pretrain_epochs` epochs on that sample, typically a cheap low-fidelity sample (simulate.py --lowfidelity)
+    whose images are interpolated to the resolution of the model, and then fine-tuned on `sample_name`. The input
+    rescaling is fixed in the first stage. With `augment`, the training images are randomly rotated and reflected.
+
+    Sample names with the wildcards *, ?, or [], like "train_*", select all samples whose files match; they are read
+    from these files as one sample (see inference.trainer.MultiFileDataset) without combining them first. """
+
+    n_aux = 1 if aux else 0
 
     logging.info("")
     logging.info("")
@@ -59,16 +76,165 @@ def train(
         )
         estimator.load("{}/models/{}".format(data_dir, load))
 
-    estimator.train(
+    stages = [(sample_name, n_epochs)]
+    if pretrain_sample is not None:
+        stages.insert(0, (pretrain_sample, pretrain_epochs))
+
+    for i_stage, (this_sample, this_n_epochs) in enumerate(stages):
+        if len(stages) > 1:
+            logging.info("")
+            logging.info("%s on sample %s", "Pretraining" if i_stage == 0 else "Fine-tuning", this_sample)
+            logging.info("")
+
+        if is_pattern(this_sample):
+            sample = multi_file_sample(data_dir, this_sample)
+            aux_data, n_aux = load_aux(sample["x"].load("z"), aux)
+        else:
+            sample = single_sample(data_dir, this_sample, resample_theta_alt)
+            aux_data, n_aux = load_aux(sample_data(data_dir, "z", this_sample), aux)
+        if aux_data is None:
+            logging.info("%s aux variables", n_aux)
+        else:
+            logging.info("%s aux variables with shape %s", n_aux, aux_data.shape)
+
+        # The augmented data of resampled theta_alt has to be calculated with the mass function of the sample
+        theta_alt_sampler = None
+        if resample_theta_alt:
+            fidelity = sample_fidelity(data_dir, this_sample, default="low" if this_sample != sample_name else "high")
+            logging.info("Resampling theta_alt with the subhalo mass function of the %s-fidelity simulator", fidelity)
+            theta_alt_sampler = ThetaAltSampler(**mass_function_settings(fidelity))
+
+        # The sample weights belong to the main sample
+        weights_filename = None
+        if weights is not None and this_sample == sample_name:
+            weights_filename = "{}/samples/w_{}.npy".format(data_dir, weights)
+
+        estimator.train(
+            method,
+            aux=aux_data,
+            theta_alt_sampler=theta_alt_sampler,
+            sample_weights=weights_filename,
+            augment=augment,
+            alpha=alpha,
+            optimizer=optimizer,
+            n_epochs=this_n_epochs,
+            batch_size=batch_size,
+            initial_lr=initial_lr,
+            final_lr=final_lr,
+            nesterov_momentum=0.9,
+            validation_split=0.25,
+            early_stopping=True,
+            limit_samplesize=limit_samplesize,
+            update_input_rescaling=i_stage == 0,
+            verbose="all",
+            **sample
+        )
+
+    estimator.save("{}/models/{}".format(data_dir, model_filename))
+
+
+def single_sample(data_dir, sample_name, resample_theta_alt=False):
+    """ Returns the arguments x, theta, theta_alt, log_r_xz, log_r_xz_alt, t_xz, t_xz_alt, pop, and group of
+    ParameterizedRatioEstimator.train() for one sample """
+
+    keys = sample_keys("{}/samples".format(data_dir), sample_name)
+    sample = {
+        key: sample_data(data_dir, key, sample_name)
+        for key in ["theta", "theta_alt", "log_r_xz", "log_r_xz_alt", "t_xz", "t_xz_alt"]
+    }
+    sample["pop"] = sample_data(data_dir, "pop", sample_name) if resample_theta_alt else None
+
+    # Samples with several noise realizations per image come with the image index, which keeps all realizations of
+    # an image on the same side of the validation split
+    sample["group"] = sample_data(data_dir, "group", sample_name) if "group" in keys else None
+
+    # Compact samples store seeds instead of images, which are then simulated again when they are needed
+    if "x" in keys:
+        sample["x"] = sample_data(data_dir, "x", sample_name, lazy=True)
+    else:
+        sample["x"] = load_compact_images("{}/samples".format(data_dir), sample_name)
+
+    return sample
+
+
+def multi_file_sample(data_dir, pattern):
+    """ Returns the arguments of ParameterizedRatioEstimator.train() for all samples whose names match the pattern:
+    a MultiFileDataset as x, from which the estimator takes the other keys """
+
+    from inference.trainer import MultiFileDataset  # Slow import (torch)
+
+    return {"x": MultiFileDataset("{}/samples/{{key}}_{}.npy".format(data_dir, pattern))}
+
+
+def is_pattern(sample_name):
+    return any(char in sample_name for char in "*?[")
+
+
+def train_online(
+    method,
+    alpha,
+    data_dir,
+    model_filename,
+    aux=False,
+    architecture="resnet",
+    log_input=False,
+    batch_size=128,
+    n_epochs=50,
+    optimizer="adam",
+    initial_lr=1.0e-4,
+    final_lr=1.0e-6,
+    load=None,
+    zero_bias=False,
+    n_workers=1,
+    seed=None,
+    samples_per_epoch=10000,
+    buffer_size=10000,
+    n_reuse=1,
+    chunk_size=100,
+    fixm=False,
+    fixz=False,
+    fixalign=False,
+    augment=False,
+):
+    """ Trains on images that are simulated in background processes during training instead of loaded from disk """
+
+    estimator = ParameterizedRatioEstimator(
+        resolution=64,
+        n_parameters=2,
+        n_aux=1 if aux else 0,
+        architecture=architecture,
+        log_input=log_input,
+        rescale_inputs=True,
+        zero_bias=zero_bias,
+    )
+
+    if load is not None:
+        logging.info("Loading pre-trained model from %s", "{}/models/{}".format(data_dir, load))
+        estimator.load("{}/models/{}".format(data_dir, load))
+
+    simulator = partial(
+        simulate_training_chunk,
+        n_images=chunk_size,
+        aux=aux,
+        draw_host_mass=not fixm,
+        draw_host_redshift=not fixz,
+        draw_alignment=not fixalign,
+    )
+
+    from inference.trainer import SimulationStream  # Slow import (torch)
+
+    stream = SimulationStream(
+        simulator,
+        n_workers=n_workers,
+        seed=seed,
+        buffer_size=buffer_size,
+        n_reuse=n_reuse,
+        samples_per_epoch=samples_per_epoch,
+    )
+
+    estimator.train_online(
         method,
-        x="{}/samples/x_{}.npy".format(data_dir, sample_name),
-        theta="{}/samples/theta_{}.npy".format(data_dir, sample_name),
-        theta_alt="{}/samples/theta_alt_{}.npy".format(data_dir, sample_name),
-        log_r_xz="{}/samples/log_r_xz_{}.npy".format(data_dir, sample_name),
-        log_r_xz_alt="{}/samples/log_r_xz_alt_{}.npy".format(data_dir, sample_name),
-        t_xz="{}/samples/t_xz_{}.npy".format(data_dir, sample_name),
-        t_xz_alt="{}/samples/t_xz_alt_{}.npy".format(data_dir, sample_name),
-        aux=aux_data,
+        stream,
         alpha=alpha,
         optimizer=optimizer,
         n_epochs=n_epochs,
@@ -78,13 +244,59 @@ def train(
         nesterov_momentum=0.9,
         validation_split=0.25,
         early_stopping=True,
-        limit_samplesize=limit_samplesize,
         verbose="all",
+        augment=augment,
     )
 
     estimator.save("{}/models/{}".format(data_dir, model_filename))
 
 
+def simulate_training_chunk(seed, n_images=100, aux=False, **kwargs):
+    """ Simulates a chunk of training data with parameters drawn from the prior, as simulate.py does """
+
+    np.random.seed(seed)
+    f_sub, beta = draw_params_from_prior(n_images)
+    f_sub_alt, beta_alt = draw_params_from_prior(n_images)
+    data = augmented_data(
+        f_sub=f_sub,
+        beta=beta,
+        f_sub_alt=f_sub_alt,
+        beta_alt=beta_alt,
+        n_images=n_images,
+        outputs=["x", "gold", "z"] if aux else ["x", "gold"],
+        seed=seed,
+        **kwargs
+    )
+    if aux:
+        data["aux"] = data.pop("z")[:, 2].reshape(-1, 1)
+    return data
+
+
+def sample_data(data_dir, key, sample_name, lazy=False):
+    """ Loads {key}_{sample_name} with simulation.storage.load_sample(), so only the finished chunks of an interrupted
+    or resumed simulation run are used, and samples in the sharded format are read from their shards. With lazy, the
+    data is memory-mapped and only read when it is used. """
+
+    return load_sample("{}/samples".format(data_dir), key, sample_name, mmap_mode="r" if lazy else None)
+
+
+def sample_fidelity(data_dir, sample_name, default="high"):
+    """ Returns the simulator fidelity (see simulation.wrapper.FIDELITIES) of a sample, or of all samples matching a
+    pattern, from the simulator settings in the manifests written by simulate.py. Samples without them, like combined
+    samples, get `default`. """
+
+    fidelities = set()
+    for filename in glob.glob(manifest_filename("{}/samples".format(data_dir), sample_name)):
+        with open(filename) as f:
+            simulator = json.load(f).get("metadata", {}).get("simulator")
+        if simulator is not None:
+            fidelities.add(simulator.get("fidelity", "high"))
+
+    if len(fidelities) > 1:
+        raise ValueError("Samples {} were simulated with different fidelities {}".format(sample_name, fidelities))
+    return fidelities.pop() if fidelities else default
+
+
 def load_aux(filename, aux=False):
     if aux:
         return load_and_check(filename)[:, 2].reshape(-1, 1), 1
@@ -102,7 +314,12 @@ def parse_args():
         "method",
         help='Inference method: "carl", "rolr", "alice", "cascal", "rascal", "alices".',
     )
-    parser.add_argument("sample", type=str, help='Sample name, like "train".')
+    parser.add_argument(
+        "sample",
+        type=str,
+        help='Sample name, like "train", or a pattern like "train_*" that selects several samples, which are then '
+        "read as one sample without combining them. Ignored with --online, but has to be given.",
+    )
     parser.add_argument(
         "name", type=str, help="Model name. Defaults to the name of the method."
     )
@@ -145,9 +362,68 @@ def parse_args():
     parser.add_argument(
         "--zerobias", action="store_true", help="Initialize with zero bias."
     )
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help="Pair every training image with fresh theta_alt values drawn from the prior in every batch, recomputing "
+        "the joint likelihood ratios and scores from the stored population statistics.",
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default=None,
+        help="Name of per-sample loss weights, as calculated by reweight.py, that are loaded from the "
+        "data/samples/w_{NAME}.npy file.",
+    )
     parser.add_argument(
         "--epochs", type=int, default=100, help="Number of epochs. Default: 100."
     )
+    parser.add_argument(
+        "--augment",
+        action="store_true",
+        help="Rotate and reflect every training image with a random symmetry of the pixel grid whenever it is used.",
+    )
+    parser.add_argument(
+        "--pretrain",
+        type=str,
+        default=None,
+        help="Name of a sample, typically simulated with simulate.py --lowfidelity, on which the model is pretrained "
+        "before it is fine-tuned on the main sample.",
+    )
+    parser.add_argument(
+        "--pretrainepochs", type=int, default=10, help="Number of epochs of pretraining with --pretrain. Default: 10."
+    )
+
+    # Online training options
+    parser.add_argument(
+        "--online",
+        action="store_true",
+        help="Simulate the training data in background processes during training instead of loading it.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of simulator processes for --online. Default: 1."
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Random seed for the simulations with --online."
+    )
+    parser.add_argument(
+        "--samples", type=int, default=10000, help="Training samples per epoch with --online. Default: 10000."
+    )
+    parser.add_argument(
+        "--buffer", type=int, default=10000, help="Size of the replay buffer with --online. Default: 10000."
+    )
+    parser.add_argument(
+        "--reuse",
+        type=int,
+        default=1,
+        help="Number of times every simulated image is used for training with --online. Default: 1.",
+    )
+    parser.add_argument(
+        "--chunk", type=int, default=100, help="Images per simulator call with --online. Default: 100."
+    )
+    parser.add_argument("--fixm", action="store_true", help="Fix host halo mass with --online")
+    parser.add_argument("--fixz", action="store_true", help="Fix lens redshift with --online")
+    parser.add_argument("--fixalign", action="store_true", help="Fix alignment between lens and source with --online")
     parser.add_argument(
         "--optimizer",
         default="adam",
@@ -189,22 +465,55 @@ if __name__ == "__main__":
     else:
         architecture = "resnet"
 
-    train(
-        method=args.method,
-        aux=args.z,
-        alpha=args.alpha,
-        data_dir="{}/data/".format(args.dir),
-        sample_name=args.sample,
-        model_filename=args.name,
-        log_input=args.log,
-        batch_size=args.batchsize,
-        initial_lr=args.lr,
-        final_lr=args.lrdecay * args.lr,
-        n_epochs=args.epochs,
-        optimizer=args.optimizer,
-        architecture=architecture,
-        zero_bias=args.zerobias,
-        load=args.load,
-    )
+    if args.online:
+        train_online(
+            method=args.method,
+            aux=args.z,
+            alpha=args.alpha,
+            data_dir="{}/data/".format(args.dir),
+            model_filename=args.name,
+            log_input=args.log,
+            batch_size=args.batchsize,
+            initial_lr=args.lr,
+            final_lr=args.lrdecay * args.lr,
+            n_epochs=args.epochs,
+            optimizer=args.optimizer,
+            architecture=architecture,
+            zero_bias=args.zerobias,
+            load=args.load,
+            n_workers=args.workers,
+            seed=args.seed,
+            samples_per_epoch=args.samples,
+            buffer_size=args.buffer,
+            n_reuse=args.reuse,
+            chunk_size=args.chunk,
+            fixm=args.fixm,
+            fixz=args.fixz,
+            fixalign=args.fixalign,
+            augment=args.augment,
+        )
+    else:
+        train(
+            method=args.method,
+            aux=args.z,
+            alpha=args.alpha,
+            data_dir="{}/data/".format(args.dir),
+            sample_name=args.sample,
+            model_filename=args.name,
+            log_input=args.log,
+            batch_size=args.batchsize,
+            initial_lr=args.lr,
+            final_lr=args.lrdecay * args.lr,
+            n_epochs=args.epochs,
+            optimizer=args.optimizer,
+            architecture=architecture,
+            zero_bias=args.zerobias,
+            load=args.load,
+            resample_theta_alt=args.resample,
+            weights=args.weights,
+            pretrain_sample=args.pretrain,
+            pretrain_epochs=args.pretrainepochs,
+            augment=args.augment,
+        )
 
     logging.info("All done! Have a nice day!")
@@ -0,0 +1,388 @@
+#! /usr/bin/env python
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import json
+import uuid
+import signal
+import socket
+import argparse
+import logging
+import threading
+import subprocess
+from multiprocessing import Process
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """
+    Task queue that only relies on a shared filesystem. Tasks are shell commands. Workers claim a task by atomically
+    creating a lease file, keep the lease alive with a heartbeat while the task runs, and mark the task as done or
+    failed when it finishes. Leases that have not been refreshed for `lease_timeout` seconds (for instance because the
+    node went down) expire, and the task is picked up again by another worker. Failed tasks are retried until they
+    have failed `max_attempts` times.
+
+    Layout of the queue folder:
+        tasks/{id}.json           Task definitions
+        leases/{id}.lease         Lease of a running task, modification time is the last heartbeat
+        done/{id}                 Marker for finished tasks
+        failed/{id}.{random}      Marker for failed attempts, one per attempt
+        logs/{id}.log             Output of the task
+    """
+
+    def __init__(self, folder, lease_timeout=600.0, max_attempts=3):
+        self.folder = folder
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        for subfolder in ["tasks", "leases", "done", "failed", "logs"]:
+            os.makedirs("{}/{}".format(folder, subfolder), exist_ok=True)
+
+    def add(self, commands):
+        """ Adds tasks (shell commands) to the queue and returns their ids. Several processes can add tasks at the
+        same time: a task file is only created under an id that is not taken yet, otherwise the next id is tried. """
+
+        ids = self.task_ids()
+        i_next = int(ids[-1]) + 1 if ids else 0
+
+        new_ids = []
+        for command in commands:
+            while True:
+                task_id = "{:06d}".format(i_next)
+                i_next += 1
+                if _create_exclusively(
+                    self._filename("tasks", task_id + ".json"), json.dumps({"id": task_id, "command": command})
+                ):
+                    break
+            new_ids.append(task_id)
+        return new_ids
+
+    def task_ids(self):
+        return sorted(filename[:-5] for filename in os.listdir(self._filename("tasks")) if filename.endswith(".json"))
+
+    def command(self, task_id):
+        with open(self._filename("tasks", task_id + ".json")) as f:
+            return json.load(f)["command"]
+
+    def is_done(self, task_id):
+        return os.path.exists(self._filename("done", task_id))
+
+    def n_attempts(self, task_id):
+        return len([filename for filename in os.listdir(self._filename("failed")) if filename.split(".")[0] == task_id])
+
+    def is_failed(self, task_id):
+        return self.n_attempts(task_id) >= self.max_attempts
+
+    def is_leased(self, task_id):
+        try:
+            return time.time() - os.path.getmtime(self._lease_filename(task_id)) <= self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def status(self):
+        """ Returns a dict with the number of done, failed, running, and pending tasks """
+
+        status = {"done": 0, "failed": 0, "running": 0, "pending": 0}
+        for task_id in self.task_ids():
+            if self.is_done(task_id):
+                status["done"] += 1
+            elif self.is_failed(task_id):
+                status["failed"] += 1
+            elif self.is_leased(task_id):
+                status["running"] += 1
+            else:
+                status["pending"] += 1
+        return status
+
+    def is_finished(self):
+        status = self.status()
+        return status["running"] == 0 and status["pending"] == 0
+
+    def claim(self, worker_id):
+        """ Tries to lease the next open task. Returns (task_id, token) or (None, None) if no task is available. """
+
+        for task_id in self.task_ids():
+            if self.is_done(task_id) or self.is_failed(task_id):
+                continue
+            token = self._acquire_lease(task_id, worker_id)
+            if token is not None:
+                return task_id, token
+        return None, None
+
+    def heartbeat(self, task_id, token):
+        """ Refreshes the lease, returns False if the lease was lost """
+
+        if not self._owns_lease(task_id, token):
+            return False
+        os.utime(self._lease_filename(task_id), None)
+        return True
+
+    def finish(self, task_id, token, success):
+        """ Marks the task as done or records a failed attempt, and releases the lease. Returns False and does nothing
+        if the lease was lost, in which case another worker has taken over the task. """
+
+        if not self._owns_lease(task_id, token):
+            return False
+
+        if success:
+            _write_atomically(self._filename("done", task_id), token)
+        else:
+            with open(self._filename("failed", "{}.{}".format(task_id, uuid.uuid4().hex)), "w") as f:
+                f.write(token)
+
+        if self._owns_lease(task_id, token):
+            try:
+                os.remove(self._lease_filename(task_id))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def run(self, task_id, token, heartbeat_interval=60.0):
+        """ Runs a leased task with heartbeats and returns whether it succeeded. If the lease is lost while the task
+        runs (because the heartbeats were delayed for longer than the lease timeout and another worker took over the
+        task), the task is stopped and neither marked as done nor as failed. """
+
+        command = self.command(task_id)
+        logger.info("Starting task %s: %s", task_id, command)
+
+        stop = threading.Event()
+        lost = threading.Event()
+
+        with open(self._filename("logs", task_id + ".log"), "a") as log:
+            # The task runs in its own process group, so that the shell and everything it started can be stopped
+            process = subprocess.Popen(
+                command, shell=True, stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+
+            def _heartbeat():
+                while not stop.wait(heartbeat_interval):
+                    if not self.heartbeat(task_id, token):
+                        logger.warning("Lost lease on task %s, stopping it", task_id)
+                        lost.set()
+                        _stop_process_group(process)
+                        return
+
+            thread = threading.Thread(target=_heartbeat)
+            thread.daemon = True
+            thread.start()
+
+            try:
+                returncode = process.wait()
+            finally:
+                stop.set()
+                thread.join()
+
+        if lost.is_set():
+            return False
+
+        success = returncode == 0
+        if not self.finish(task_id, token, success):
+            logger.warning("Lost lease on task %s, leaving it to the worker that took it over", task_id)
+            return False
+        if success:
+            logger.info("Finished task %s", task_id)
+        else:
+            logger.warning(
+                "Task %s failed with return code %s (attempt %s / %s)",
+                task_id,
+                returncode,
+                self.n_attempts(task_id),
+                self.max_attempts,
+            )
+        return success
+
+    def _acquire_lease(self, task_id, worker_id):
+        filename = self._lease_filename(task_id)
+
+        # Break expired lease. Renaming is atomic, so only one worker can break it.
+        if os.path.exists(filename) and not self.is_leased(task_id):
+            expired_filename = "{}.expired.{}".format(filename, uuid.uuid4().hex)
+            try:
+                os.rename(filename, expired_filename)
+            except FileNotFoundError:
+                return None
+
+            # Another worker might have broken the lease and taken the task between our check and the rename
+            if time.time() - os.path.getmtime(expired_filename) <= self.lease_timeout:
+                try:
+                    os.link(expired_filename, filename)
+                except FileExistsError:
+                    pass
+                os.remove(expired_filename)
+                return None
+
+            os.remove(expired_filename)
+            logger.info("Lease on task %s expired", task_id)
+
+        token = "{}.{}".format(worker_id, uuid.uuid4().hex)
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+
+        # Task might have been finished since we checked
+        if self.is_done(task_id):
+            os.remove(filename)
+            return None
+        return token
+
+    def _owns_lease(self, task_id, token):
+        try:
+            with open(self._lease_filename(task_id)) as f:
+                return f.read() == token
+        except FileNotFoundError:
+            return False
+
+    def _lease_filename(self, task_id):
+        return self._filename("leases", task_id + ".lease")
+
+    def _filename(self, *parts):
+        return "/".join((self.folder,) + parts)
+
+
+def _create_exclusively(filename, content):
+    """ Creates a file with the content, unless it already exists. Returns whether the file was created. The content
+    is written to a temporary file first, so other processes never see a partially written file. """
+
+    tmp_filename = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+    with open(tmp_filename, "w") as f:
+        f.write(content)
+    try:
+        os.link(tmp_filename, filename)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_filename)
+
+
+def _stop_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _write_atomically(filename, content):
+    with open(filename + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(filename + ".tmp", filename)
+
+
+def work(folder, lease_timeout=600.0, max_attempts=3, heartbeat_interval=60.0, poll_interval=10.0):
+    """ Worker loop: runs tasks from the queue until all of them are done or failed """
+
+    queue = WorkQueue(folder, lease_timeout, max_attempts)
+    worker_id = "{}.{}".format(socket.gethostname(), os.getpid())
+    logger.info("Worker %s started", worker_id)
+
+    while True:
+        task_id, token = queue.claim(worker_id)
+        if task_id is not None:
+            queue.run(task_id, token, heartbeat_interval)
+        elif queue.is_finished():
+            break
+        else:
+            time.sleep(poll_interval)
+
+    logger.info("Worker %s finished, no tasks left", worker_id)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Work queue on a shared filesystem. Tasks are shell commands, any number of workers on any number "
+        "of nodes can process them."
+    )
+    parser.add_argument("queue", type=str, help="Queue folder. Has to be on a filesystem shared by all workers.")
+    subparsers = parser.add_subparsers(dest="action")
+
+    add_parser = subparsers.add_parser("add", help="Add tasks to the queue.")
+    add_parser.add_argument(
+        "command",
+        type=str,
+        nargs="?",
+        default=None,
+        help='Shell command. With --range, "{i}" is replaced by the task index.',
+    )
+    add_parser.add_argument(
+        "--range",
+        type=int,
+        nargs=2,
+        default=None,
+        metavar=("START", "STOP"),
+        help='Add one task for every i in range(START, STOP), replacing "{i}" in the command.',
+    )
+    add_parser.add_argument("--file", type=str, default=None, help="File with one shell command per line.")
+
+    work_parser = subparsers.add_parser("work", help="Start workers that process the tasks.")
+    work_parser.add_argument("--workers", type=int, default=1, help="Number of parallel workers. Default: 1.")
+    work_parser.add_argument(
+        "--lease",
+        type=float,
+        default=600.0,
+        help="Seconds after which a lease without heartbeat expires. Default: 600.",
+    )
+    work_parser.add_argument(
+        "--heartbeat", type=float, default=60.0, help="Seconds between heartbeats of a running task. Default: 60."
+    )
+    work_parser.add_argument("--attempts", type=int, default=3, help="Maximal number of attempts per task. Default: 3.")
+    work_parser.add_argument(
+        "--poll", type=float, default=10.0, help="Seconds to wait when all open tasks are leased. Default: 10."
+    )
+
+    subparsers.add_parser("status", help="Show the status of the queue.")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s",
+        datefmt="%H:%M",
+        level=logging.INFO,
+    )
+    args = parse_args()
+
+    if args.action == "add":
+        commands = []
+        if args.command is not None and args.range is not None:
+            commands += [args.command.replace("{i}", str(i)) for i in range(*args.range)]
+        elif args.command is not None:
+            commands.append(args.command)
+        if args.file is not None:
+            with open(args.file) as f:
+                commands += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        ids = WorkQueue(args.queue).add(commands)
+        logger.info("Added %s tasks to queue %s", len(ids), args.queue)
+
+    elif args.action == "work":
+        workers = [
+            Process(target=work, args=(args.queue, args.lease, args.attempts, args.heartbeat, args.poll))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        logger.info("All done! Have a nice day!")
+
+    elif args.action == "status":
+        status = WorkQueue(args.queue).status()
+        logger.info(
+            "Queue %s: %s done, %s running, %s pending, %s failed",
+            args.queue,
+            status["done"],
+            status["running"],
+            status["pending"],
+            status["failed"],
+        )
+
+    else:
+        logger.error("Please specify an action: add, work, or status")
+        sys.exit(1)